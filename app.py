@@ -1,29 +1,44 @@
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 # --- IMPORTACIONES CORREGIDAS ---
-from dash import Dash, html, dcc, callback_context, Input, Output, State
+from dash import Dash, html, dcc, callback_context, no_update, Patch, Input, Output, State
 import datetime
 from dash.exceptions import PreventUpdate 
 # --- LÍNEA CORREGIDA (de 'sqlalchzemy') ---
-from sqlalchemy import create_engine 
+from sqlalchemy import text, inspect
 import os
+import re
+import select
+import threading
+import time
+from collections import OrderedDict
+import cache_frames # Caché de DataFrames en disco compartida entre workers
+import conexion_db # Engine compartido: pool, pre-ping y métricas
+import metricas # Tramos por etapa: /metrics y una línea JSON por callback
+import exportar # Descarga en streaming de anuncios y velas (CSV/Parquet)
 from dateutil.relativedelta import relativedelta # Esta línea necesita 'python-dateutil'
 
 # --- CONFIGURACIÓN DE BASE DE DATOS ---
 TABLE_NAME = 'p2p_anuncios'
+TABLE_VELAS = 'p2p_velas' # Velas OHLCV pre-agregadas por el scraper
+TABLE_METODOS = 'p2p_metodos_pago' # Diccionario id -> nombre de método de pago
+TABLE_PRESENCIA = 'p2p_presencia' # Ids de los anuncios visibles en cada ciclo
 DATABASE_URL = os.environ.get("DATABASE_URL")
-
-# Forzar prefijo 'postgresql://'
-if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# LISTEN necesita una sesión propia: detrás de PgBouncer en modo transacción se escucha directamente en la BD
+DATABASE_URL_DIRECTA = os.environ.get("DATABASE_URL_DIRECTA") or DATABASE_URL
     
 try:
-    ENGINE = create_engine(DATABASE_URL)
+    ENGINE = conexion_db.crear_engine(DATABASE_URL, 'dashboard')
+    # Solo abre la conexión de la escucha de ciclos (fuera de cualquier pool)
+    ENGINE_ESCUCHA = conexion_db.crear_engine(DATABASE_URL_DIRECTA, 'dashboard-escucha', modo='sin_pool')
+    # Exportaciones: una conexión propia por descarga, fuera del pool de los callbacks
+    ENGINE_EXPORTAR = conexion_db.crear_engine(DATABASE_URL, 'dashboard-exportar', modo='sin_pool')
     print(f"[{datetime.datetime.now()}] Conexión a PostgreSQL establecida.")
 except Exception as e:
     print(f"[{datetime.datetime.now()}] ERROR FATAL: No se pudo crear engine de SQLAlchemy: {e}")
-    ENGINE = None
+    ENGINE = ENGINE_ESCUCHA = ENGINE_EXPORTAR = None
 
 # --- CONSTANTES DE COLOR ---
 COLOR_BACKGROUND_APP = '#0d0d0d'
@@ -52,6 +67,27 @@ DEFAULT_CHART_TYPE = 'tab-velas'
 # Bajamos de 12 a 6 horas para el intento final.
 HOURS_TO_LOAD = 6
 
+# Las velas vienen pre-agregadas por el scraper, así que su histórico no depende de la RAM.
+# Días a leer por intervalo (mantiene cada gráfico en unos cientos de velas).
+VELAS_DAYS_TO_LOAD = {'15t': 3, '1h': 14, '4h': 60, '1d': 365}
+# Máximo de velas/puntos por gráfico: el intervalo se elige según el zoom y, si aun así sobran,
+# se agrupan velas consecutivas. Cualquier rango se dibuja en tiempo y memoria acotados.
+MAX_PUNTOS_GRAFICO = int(os.environ.get("MAX_PUNTOS_GRAFICO", 500))
+# Exchange cuyas velas se muestran (las velas se guardan por Tipo y Exchange_Name)
+EXCHANGE_VELAS = os.environ.get("EXCHANGE_VELAS", "Binance")
+# Mercado que muestra el dashboard (el scraper puede recolectar varios, ver P2P_MERCADOS)
+_mercado_dashboard = re.match(r'^([A-Z0-9]{2,10})/([A-Z0-9]{2,10})$', os.environ.get("P2P_MERCADO_DASHBOARD", "USDT/VES").strip().upper())
+if not _mercado_dashboard:
+    raise ValueError(f"P2P_MERCADO_DASHBOARD='{os.environ.get('P2P_MERCADO_DASHBOARD')}' no es válido; usa la forma ASSET/FIAT (p.ej. USDT/VES).")
+ASSET_DASHBOARD, FIAT_DASHBOARD = _mercado_dashboard.groups()
+# El scraper anuncia cada ciclo confirmado con NOTIFY en este canal. Cada cliente pregunta cada
+# pocos segundos si llegó uno nuevo; el refresco de 15 minutos queda de respaldo.
+CANAL_CICLOS = os.environ.get("P2P_CANAL_CICLOS", "p2p_ciclos")
+SEGUNDOS_AVISO_CICLO = int(os.environ.get("SEGUNDOS_AVISO_CICLO", 5))
+# "local": cada worker de gunicorn carga los agregados y los publica en la caché.
+# "externo": los publica un único proceso (worker_precalculo.py) y los workers solo mapean la caché.
+DASHBOARD_PRECALCULO = os.environ.get("DASHBOARD_PRECALCULO", "local")
+
 # --- DEFINICIÓN DE ESTILOS CSS ---
 EXTERNAL_STYLESHEET = [
     'https://fonts.googleapis.com/css2?family=Roboto:wght@300;400;700&display=swap'
@@ -154,92 +190,361 @@ APP_CSS = f"""
 
 # --- 1. PROCESAMIENTO DE DATOS (¡OPTIMIZADO!) ---
 
-def cargar_datos_crudos(hours_to_load=HOURS_TO_LOAD):
+# Estado de la carga incremental (por proceso): últimos agregados cargados y su bucket más reciente.
+# En cada refresco solo se piden a la BD los buckets desde 'ultimo_bucket' (el último podía estar a medias).
+_carga_lock = threading.Lock()
+_carga_incremental = {'hours': None, 'ultimo_bucket': None, 'df_ohlc': None, 'df_metodos': None, 'exchange_name': None}
+
+# --- CAPA DE AGREGACIÓN EN SQL ---
+# PostgreSQL agrega las fotos del libro en buckets de 15 minutos y el dashboard solo recibe esos
+# resultados (cientos de filas): la RAM del proceso ya no crece con la ventana ni con el libro.
+# Las velas de 1h/4h/1d y los gráficos de métodos se derivan de estos buckets.
+SEGUNDOS_BUCKET = 15 * 60
+BUCKET = pd.Timedelta(seconds=SEGUNDOS_BUCKET)
+INTERVALOS_SEGUNDOS = {'15t': 15 * 60, '1h': 60 * 60, '4h': 4 * 60 * 60, '1d': 24 * 60 * 60}
+
+# Ancho del bucket como parámetro (:paso): la misma sentencia sirve para 15 minutos y para los
+# buckets del zoom. date_bin alinea al epoch, como p2p_velas.
+SQL_BUCKET = "date_bin(CAST(:paso AS interval), {columna}, TIMESTAMP 'epoch')"
+
+# El scraper solo guarda los anuncios nuevos o cambiados; la foto de cada ciclo se
+# reconstruye desde p2p_presencia (ids de los anuncios visibles en ese ciclo, en orden del libro)
+FROM_FOTOS = f"""FROM {TABLE_PRESENCIA} AS p
+    CROSS JOIN LATERAL UNNEST(p."Anuncio_Ids") WITH ORDINALITY AS u(anuncio_id, orden)
+    JOIN {TABLE_NAME} AS a ON a.id = u.anuncio_id"""
+# Edad máxima de una versión referenciada desde la presencia (EDAD_MAXIMA_VERSION del scraper).
+# Acotar a."Timestamp" con ella hace que PostgreSQL solo lea las particiones diarias necesarias.
+EDAD_MAXIMA_VERSION = datetime.timedelta(hours=24)
+
+# WHERE común de las consultas sobre las fotos: ventana de tiempo, poda de particiones y mercado
+FILTRO_FOTOS = """WHERE p."Timestamp" >= :desde AND p."Timestamp" <= :hasta
+      AND a."Timestamp" >= :desde_version
+      AND p."Asset" = :asset AND p."Fiat" = :fiat"""
+
+# Las consultas son constantes con parámetros enlazados: SQLAlchemy compila cada una una sola vez
+# y los valores nunca se interpolan en el texto.
+# OHLCV por bucket y Tipo. Open/Close: primer/último precio del bucket en el orden del libro.
+SQL_OHLC = text(f"""
+    SELECT {SQL_BUCKET.format(columna='p."Timestamp"')} AS "Timestamp", p."Tipo",
+           (ARRAY_AGG(a."Precio" ORDER BY p."Timestamp", u.orden))[1] AS "Open",
+           MAX(a."Precio") AS "High", MIN(a."Precio") AS "Low",
+           (ARRAY_AGG(a."Precio" ORDER BY p."Timestamp" DESC, u.orden DESC))[1] AS "Close",
+           SUM(a."Volumen") AS "Volume", MIN(p."Exchange_Name") AS "Exchange_Name"
+    {FROM_FOTOS}
+    {FILTRO_FOTOS}
+    GROUP BY 1, 2
+    ORDER BY 1
+    """)
+
+# Volumen, suma de precios y nº de anuncios por bucket, Tipo y método (un anuncio cuenta en cada uno de sus métodos)
+SQL_METODOS = text(f"""
+    SELECT {SQL_BUCKET.format(columna='p."Timestamp"')} AS "Timestamp", p."Tipo", COALESCE(m.metodo_id, 0) AS "Metodo_Id",
+           SUM(a."Volumen") AS "Volumen", SUM(a."Precio") AS "Precio_Suma", COUNT(*) AS "N"
+    {FROM_FOTOS}
+    LEFT JOIN LATERAL UNNEST(a."Metodos_Ids") AS m(metodo_id) ON TRUE
+    {FILTRO_FOTOS}
+    GROUP BY 1, 2, 3
+    ORDER BY 1
+    """)
+
+# OHLCV sobre el esquema antiguo: cada ciclo guardaba el libro completo en p2p_anuncios
+SQL_OHLC_LEGACY = text(f"""
+    SELECT {SQL_BUCKET.format(columna='"Timestamp"')} AS "Timestamp", "Tipo",
+           (ARRAY_AGG("Precio" ORDER BY "Timestamp", id))[1] AS "Open",
+           MAX("Precio") AS "High", MIN("Precio") AS "Low",
+           (ARRAY_AGG("Precio" ORDER BY "Timestamp" DESC, id DESC))[1] AS "Close",
+           SUM("Volumen") AS "Volume"
+    FROM {TABLE_NAME}
+    WHERE "Timestamp" >= :desde AND "Timestamp" <= :hasta
+    GROUP BY 1, 2
+    ORDER BY 1
+    """)
+
+# Agregado de métodos sobre el esquema antiguo: los métodos se parten desde el texto de Metodos_Pago
+SQL_METODOS_LEGACY = text(f"""
+    SELECT {SQL_BUCKET.format(columna='"Timestamp"')} AS "Timestamp", "Tipo",
+           COALESCE(NULLIF(BTRIM(metodo), ''), 'Indefinido') AS "Metodos_Pago",
+           SUM("Volumen") AS "Volumen", SUM("Precio") AS "Precio_Suma", COUNT(*) AS "N"
+    FROM {TABLE_NAME}
+    CROSS JOIN LATERAL REGEXP_SPLIT_TO_TABLE(COALESCE("Metodos_Pago", ''), ',') AS metodo
+    WHERE "Timestamp" >= :desde AND "Timestamp" <= :hasta
+    GROUP BY 1, 2, 3
+    ORDER BY 1
+    """)
+
+SQL_DICCIONARIO_METODOS = text(f'SELECT id, "Nombre" FROM {TABLE_METODOS} ORDER BY id')
+
+def _parametros_fotos(desde, hasta=None, segundos=SEGUNDOS_BUCKET):
+    return {'desde': desde, 'hasta': hasta or datetime.datetime.max, 'desde_version': desde - EDAD_MAXIMA_VERSION,
+            'asset': ASSET_DASHBOARD, 'fiat': FIAT_DASHBOARD, 'paso': datetime.timedelta(seconds=segundos)}
+
+# --- DETECCIÓN DEL ESQUEMA ---
+# Se comprueba en el catálogo qué esquema hay en lugar de lanzar la consulta y repetirla con la
+# antigua si falla. El esquema con fotos no vuelve atrás, así que se recuerda; el antiguo se vuelve
+# a comprobar en cada carga completa porque el scraper lo migra al arrancar.
+_esquema = {'fotos': None}
+
+def _esquema_con_fotos():
     """
-    Carga datos desde PostgreSQL, limitando el histórico para ahorrar RAM.
+    True si la BD tiene p2p_presencia y las columnas Metodos_Ids/Asset del scraper actual.
+    False en esquemas anteriores (fix_db.py, o scraper sin migrar: solo texto de métodos y USDT/VES).
+    """
+    if not _esquema['fotos']:
+        inspector = inspect(ENGINE)
+        columnas = {c['name'] for c in inspector.get_columns(TABLE_NAME)} if inspector.has_table(TABLE_NAME) else set()
+        _esquema['fotos'] = inspector.has_table(TABLE_PRESENCIA) and {'Metodos_Ids', 'Asset'} <= columnas
+        if not _esquema['fotos']:
+            print(f"[{datetime.datetime.now()}] Advertencia: Esquema sin '{TABLE_PRESENCIA}' o 'Metodos_Ids'. Se usa el texto de métodos.")
+    return _esquema['fotos']
+
+def _decodificar_metodos(df_metodos):
+    """Sustituye Metodo_Id por un Categorical con el nombre del método: el groupby de los gráficos trabaja sobre enteros."""
+    # El diccionario se lee después: así contiene todos los ids que aparecen en la consulta
+    df_dic = pd.read_sql(SQL_DICCIONARIO_METODOS, con=ENGINE)
+    ids = np.concatenate([[0], df_dic['id'].to_numpy()]) # 0 = anuncio sin métodos
+    categorias = ['Indefinido'] + df_dic['Nombre'].tolist()
+    codigos = np.searchsorted(ids, df_metodos['Metodo_Id'].to_numpy())
+    df_metodos['Metodos_Pago'] = pd.Categorical.from_codes(codigos, categories=categorias)
+    return df_metodos.drop(columns='Metodo_Id')
+
+# Tipos compactos de los frames de agregados: el lado como categoría (1 byte por fila), el tiempo a
+# resolución de segundos, volúmenes en float32 y conteos en int32. Los precios siguen en float64:
+# el premium compara medias de precios que difieren en centésimas.
+TIPO_LADO = pd.CategoricalDtype(['Demanda', 'Oferta'])
+TIPOS_COMPACTOS = {'Timestamp': 'datetime64[s]', 'Tipo': TIPO_LADO, 'Volume': 'float32', 'Volumen': 'float32', 'N': 'int32'}
+
+def _compactar(df):
+    """Aplica TIPOS_COMPACTOS a las columnas presentes (Metodos_Pago ya es un Categorical)."""
+    return df.astype({c: t for c, t in TIPOS_COMPACTOS.items() if c in df.columns})
+
+def _informe_memoria(nombre, df):
+    bytes_df = int(df.memory_usage(deep=True).sum())
+    return f"{nombre} {len(df)} filas, {bytes_df / 1024:.1f} KiB ({bytes_df / max(len(df), 1):.0f} B/fila)"
+
+def _concatenar_metodos(df_anterior, df_nuevo):
+    """Concatena frames de métodos conservando el Categorical (el diccionario solo crece)."""
+    if isinstance(df_anterior['Metodos_Pago'].dtype, pd.CategoricalDtype) and isinstance(df_nuevo['Metodos_Pago'].dtype, pd.CategoricalDtype):
+        df_anterior = df_anterior.assign(Metodos_Pago=df_anterior['Metodos_Pago'].cat.set_categories(df_nuevo['Metodos_Pago'].cat.categories))
+    return pd.concat([df_anterior, df_nuevo], ignore_index=True)
+
+def cargar_agregados(hours_to_load=HOURS_TO_LOAD, incremental=True):
+    """
+    Carga desde PostgreSQL los agregados por bucket de 15 minutos de la ventana:
+    (df_ohlc, df_metodos, exchange_name). Con incremental=True, tras la primera carga solo se
+    piden los buckets desde el último cargado, se reemplazan y se descartan los que salieron de la ventana.
     """
     if ENGINE is None:
-        print(f"[{datetime.datetime.now()}] cargar_datos_crudos abortado: No hay conexión a DB.")
+        print(f"[{datetime.datetime.now()}] cargar_agregados abortado: No hay conexión a DB.")
         return pd.DataFrame(), pd.DataFrame(), "P2P (Error)"
 
-    try:
-        # --- CAMBIO A 6 HORAS ---
-        start_date = datetime.datetime.now() - relativedelta(hours=hours_to_load) 
-        start_date_str = start_date.strftime("%Y-%m-%d %H:%M:%S")
-
-        exchange_name = "P2P"
-        df_raw = pd.DataFrame()
-        
+    with _carga_lock:
+        estado = _carga_incremental
+        es_delta = incremental and estado['ultimo_bucket'] is not None and estado['hours'] == hours_to_load
         try:
-            sql_query = f"""
-            SELECT "Timestamp", "Tipo", "Precio", "Volumen", "Metodos_Pago", "Exchange_Name"
-            FROM {TABLE_NAME}
-            WHERE "Timestamp" >= '{start_date_str}'
-            ORDER BY "Timestamp"
-            """
-            print(f"[{datetime.datetime.now()}] Cargando datos (ÚLTIMAS {hours_to_load} HORAS): Desde {start_date_str}...")
-            df_raw = pd.read_sql(sql_query, con=ENGINE)
-            if not df_raw.empty and 'Exchange_Name' in df_raw.columns and not df_raw['Exchange_Name'].empty:
-                 first_valid_name = df_raw['Exchange_Name'].dropna().iloc[0]
-                 if first_valid_name:
-                     exchange_name = first_valid_name
-                 else:
-                     exchange_name = "P2P (Nombre no disp.)"
-
-        except Exception as e_col:
-            # Esto se ejecuta si la DB fue creada por el script de "reparación" (fix_db.py)
-            # que borró la tabla y el scraper aún no ha guardado la columna Exchange_Name.
-            print(f"[{datetime.datetime.now()}] Advertencia: Columna 'Exchange_Name' no encontrada. Reintentando sin ella. {e_col}")
-            sql_query_fallback = f"""
-            SELECT "Timestamp", "Tipo", "Precio", "Volumen", "Metodos_Pago"
-            FROM {TABLE_NAME}
-            WHERE "Timestamp" >= '{start_date_str}'
-            ORDER BY "Timestamp"
-            """
-            df_raw = pd.read_sql(sql_query_fallback, con=ENGINE)
-            exchange_name = "P2P (Fallback)" 
+            now = datetime.datetime.now()
+            inicio_ventana = now - relativedelta(hours=hours_to_load)
+            if es_delta:
+                # El último bucket se vuelve a pedir entero: pudo recibir ciclos desde la carga anterior
+                start_date = estado['ultimo_bucket']
+                exchange_name = estado['exchange_name']
+            else:
+                # --- CAMBIO A 6 HORAS ---
+                start_date = inicio_ventana
+                exchange_name = "P2P"
+            start_date_str = start_date.strftime("%Y-%m-%d %H:%M:%S.%f")
 
-        
-        if df_raw.empty:
-            print(f"[{datetime.datetime.now()}] No hay datos recientes en el rango.")
-            return pd.DataFrame(), pd.DataFrame(), exchange_name
+            df_metodos_nuevo = pd.DataFrame()
+            params = _parametros_fotos(start_date)
+
+            if es_delta:
+                print(f"[{datetime.datetime.now()}] Cargando delta: buckets desde {start_date_str}...")
+            else:
+                print(f"[{datetime.datetime.now()}] Cargando agregados (ÚLTIMAS {hours_to_load} HORAS): Desde {start_date_str}...")
+            con_fotos = _esquema_con_fotos()
+            # Las dos consultas leen la misma foto de la BD (REPEATABLE READ): un ciclo confirmado entre
+            # ambas no puede quedar en los métodos y faltar en el OHLC, cuyo último bucket marca el siguiente delta
+            with ENGINE.connect() as conexion:
+                conexion.execution_options(isolation_level='REPEATABLE READ')
+                if con_fotos:
+                    with metricas.tramo('sql_ohlc') as t:
+                        df_ohlc_nuevo = pd.read_sql(SQL_OHLC, con=conexion, params=params)
+                        t['filas'] = len(df_ohlc_nuevo)
+                    if not df_ohlc_nuevo.empty:
+                        with metricas.tramo('sql_metodos') as t:
+                            df_metodos_nuevo = _decodificar_metodos(pd.read_sql(SQL_METODOS, con=conexion, params=params))
+                            t['filas'] = len(df_metodos_nuevo)
+                        if not es_delta:
+                            first_valid_name = df_ohlc_nuevo['Exchange_Name'].dropna()
+                            exchange_name = first_valid_name.iloc[0] if not first_valid_name.empty else "P2P (Nombre no disp.)"
+                    df_ohlc_nuevo = df_ohlc_nuevo.drop(columns='Exchange_Name')
+                else:
+                    # Esquema anterior (p.ej. creado por el script de "reparación" fix_db.py): sin Exchange_Name
+                    # fiable, métodos como texto y sin p2p_presencia (cada ciclo guardaba el libro completo).
+                    with metricas.tramo('sql_ohlc') as t:
+                        df_ohlc_nuevo = pd.read_sql(SQL_OHLC_LEGACY, con=conexion, params=params)
+                        t['filas'] = len(df_ohlc_nuevo)
+                    exchange_name = "P2P (Fallback)" 
+                    if not df_ohlc_nuevo.empty:
+                        with metricas.tramo('sql_metodos') as t:
+                            df_metodos_nuevo = pd.read_sql(SQL_METODOS_LEGACY, con=conexion, params=params)
+                            df_metodos_nuevo['Metodos_Pago'] = df_metodos_nuevo['Metodos_Pago'].astype('category')
+                            t['filas'] = len(df_metodos_nuevo)
+
+            if not df_ohlc_nuevo.empty:
+                with metricas.tramo('compactar') as t:
+                    df_ohlc_nuevo = _compactar(df_ohlc_nuevo)
+                    df_metodos_nuevo = _compactar(df_metodos_nuevo)
+                    t['filas'] = len(df_ohlc_nuevo) + len(df_metodos_nuevo)
+                    t['bytes'] = int(df_ohlc_nuevo.memory_usage(deep=True).sum() + df_metodos_nuevo.memory_usage(deep=True).sum())
+                print(f"[{datetime.datetime.now()}] ✅ Cargados {len(df_ohlc_nuevo)} buckets OHLC y {len(df_metodos_nuevo)} de métodos {'(delta)' if es_delta else 'recientes'}.")
+                ultimo_bucket = df_ohlc_nuevo['Timestamp'].max()
+            else:
+                ultimo_bucket = estado['ultimo_bucket'] if es_delta else None
+
+            if es_delta:
+                # Reemplazar los buckets re-consultados y desalojar los que quedaron fuera de la ventana
+                df_ohlc, df_metodos = estado['df_ohlc'], estado['df_metodos']
+                if not df_ohlc_nuevo.empty:
+                    df_ohlc = pd.concat([df_ohlc[df_ohlc['Timestamp'] < start_date], df_ohlc_nuevo], ignore_index=True)
+                    df_metodos = _concatenar_metodos(df_metodos[df_metodos['Timestamp'] < start_date], df_metodos_nuevo)
+                if not df_ohlc.empty and df_ohlc['Timestamp'].iloc[0] + BUCKET <= inicio_ventana:
+                    df_ohlc = df_ohlc[df_ohlc['Timestamp'] + BUCKET > inicio_ventana].reset_index(drop=True)
+                    df_metodos = df_metodos[df_metodos['Timestamp'] + BUCKET > inicio_ventana].reset_index(drop=True)
+            else:
+                df_ohlc, df_metodos = df_ohlc_nuevo, df_metodos_nuevo
+
+            estado.update(hours=hours_to_load, ultimo_bucket=ultimo_bucket, df_ohlc=df_ohlc, df_metodos=df_metodos, exchange_name=exchange_name)
+
+            if df_ohlc.empty:
+                print(f"[{datetime.datetime.now()}] No hay datos recientes en el rango.")
+                return pd.DataFrame(), pd.DataFrame(), exchange_name
+            print(f"[{datetime.datetime.now()}] Memoria: {_informe_memoria('OHLC', df_ohlc)}; {_informe_memoria('métodos', df_metodos)}.")
             
-        print(f"[{datetime.datetime.now()}] ✅ Cargados {len(df_raw)} registros recientes.")
-
-        # Convertir tipos
-        df_raw['Timestamp'] = pd.to_datetime(df_raw['Timestamp'])
-        df_raw['Precio'] = pd.to_numeric(df_raw['Precio'], errors='coerce')
-        df_raw['Volumen'] = pd.to_numeric(df_raw['Volumen'], errors='coerce')
-        df_raw.dropna(subset=['Precio', 'Volumen'], inplace=True) 
-
-        # Procesar métodos de pago
-        # Usamos .copy() para evitar SettingWithCopyWarning
-        df_metodos = df_raw.copy() 
-        df_metodos['Metodos_Pago'] = df_metodos['Metodos_Pago'].fillna('')
-        df_metodos['Metodos_Pago'] = df_metodos['Metodos_Pago'].str.split(r',\s*')
-        
-        df_metodos_expl = df_metodos.explode('Metodos_Pago')
-        df_metodos_expl['Metodos_Pago'] = df_metodos_expl['Metodos_Pago'].str.strip()
-        df_metodos_expl['Metodos_Pago'] = df_metodos_expl['Metodos_Pago'].replace('', 'Indefinido')
-        
-        return df_raw, df_metodos_expl, exchange_name
+            return df_ohlc, df_metodos, exchange_name
+
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] ❌ ERROR de DB en cargar_agregados: {e}")
+            return pd.DataFrame(), pd.DataFrame(), "P2P (Error)"
+
+SQL_VELAS = text(f"""
+    SELECT "Bucket", "Tipo", "Open", "High", "Low", "Close", "Volume"
+    FROM {TABLE_VELAS}
+    WHERE "Intervalo" = :intervalo AND "Exchange_Name" = :exchange
+      AND "Asset" = :asset AND "Fiat" = :fiat AND "Bucket" > :desde AND "Bucket" <= :hasta
+    ORDER BY "Bucket"
+    """)
 
+def cargar_velas(interval, exchange_name=EXCHANGE_VELAS, desde=None, hasta=None):
+    """
+    Lee las velas OHLCV pre-agregadas del intervalo (cientos de filas en lugar de todo el crudo).
+    Sin rango se leen los últimos VELAS_DAYS_TO_LOAD días; con 'desde'/'hasta' (zoom del gráfico),
+    las velas que se solapan con ese rango. Devuelve (df_demanda, df_oferta) con el formato de crear_datos_ohlc.
+    """
+    if ENGINE is None or interval not in VELAS_DAYS_TO_LOAD:
+        return pd.DataFrame(), pd.DataFrame()
+    try:
+        if desde is None:
+            start_date = datetime.datetime.now() - relativedelta(days=VELAS_DAYS_TO_LOAD[interval])
+        else:
+            # Incluye la vela que contiene 'desde'
+            start_date = desde - datetime.timedelta(seconds=INTERVALOS_SEGUNDOS[interval])
+        params = {'intervalo': interval, 'exchange': exchange_name, 'asset': ASSET_DASHBOARD, 'fiat': FIAT_DASHBOARD,
+                  'desde': start_date, 'hasta': hasta or datetime.datetime.max}
+        with metricas.tramo('sql_velas') as t:
+            df_velas = pd.read_sql(SQL_VELAS, con=ENGINE, params=params)
+            t['filas'] = len(df_velas)
     except Exception as e:
-        print(f"[{datetime.datetime.now()}] ❌ ERROR de DB en cargar_datos_crudos: {e}")
-        return pd.DataFrame(), pd.DataFrame(), "P2P (Error)"
+        print(f"[{datetime.datetime.now()}] Advertencia: No se pudieron leer las velas de '{TABLE_VELAS}': {e}")
+        return pd.DataFrame(), pd.DataFrame()
 
-def crear_datos_ohlc(df_raw, interval):
-    if df_raw.empty: return pd.DataFrame(), pd.DataFrame()
-    df_raw_indexed = df_raw.set_index('Timestamp')
-    ohlcv_agg = {'Precio': 'ohlc', 'Volumen': 'sum'}
+    if df_velas.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    df_velas['Bucket'] = pd.to_datetime(df_velas['Bucket'])
+    df_velas = df_velas.set_index('Bucket').rename_axis('Timestamp')
+    columnas = ['Open', 'High', 'Low', 'Close', 'Volume']
+    df_demanda = df_velas.loc[df_velas['Tipo'] == 'Demanda', columnas]
+    df_oferta = df_velas.loc[df_velas['Tipo'] == 'Oferta', columnas]
+    return df_demanda, df_oferta
+
+# Cómo se combinan velas consecutivas en una vela mayor
+AGREGACION_OHLC = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+def crear_datos_ohlc(df_ohlc, interval):
+    """Combina los buckets OHLCV de 15 minutos en velas del intervalo (si p2p_velas no está disponible)."""
+    if df_ohlc.empty: return pd.DataFrame(), pd.DataFrame()
+    df_ohlc_indexed = df_ohlc.set_index('Timestamp')
     
-    # El 'interval' (ej. '1h') viene del RadioItems, ya está en minúsculas
-    df_demanda = df_raw_indexed[df_raw_indexed['Tipo'] == 'Demanda'].resample(interval).agg(ohlcv_agg).dropna()
-    df_demanda.columns = ['Open', 'High', 'Low', 'Close', 'Volume']
-    df_oferta = df_raw_indexed[df_raw_indexed['Tipo'] == 'Oferta'].resample(interval).agg(ohlcv_agg).dropna()
-    df_oferta.columns = ['Open', 'High', 'Low', 'Close', 'Volume']
+    # El 'interval' (ej. '1h') viene del RadioItems; se pasa a segundos ('15t' ya no es una frecuencia válida)
+    regla = f"{INTERVALOS_SEGUNDOS.get(interval, SEGUNDOS_BUCKET)}s"
+    df_demanda = df_ohlc_indexed[df_ohlc_indexed['Tipo'] == 'Demanda'].resample(regla).agg(AGREGACION_OHLC).dropna()
+    df_oferta = df_ohlc_indexed[df_ohlc_indexed['Tipo'] == 'Oferta'].resample(regla).agg(AGREGACION_OHLC).dropna()
     return df_demanda, df_oferta
 
+# --- NIVEL DE DETALLE SEGÚN EL ZOOM ---
+def elegir_intervalo(fecha_inicio, fecha_fin):
+    """Intervalo más fino cuyo número de velas en el rango no supera MAX_PUNTOS_GRAFICO."""
+    segundos_rango = (fecha_fin - fecha_inicio).total_seconds()
+    for intervalo, segundos in INTERVALOS_SEGUNDOS.items(): # de más fino a más grueso
+        if segundos_rango / segundos <= MAX_PUNTOS_GRAFICO:
+            return intervalo
+    return '1d'
+
+def decimar_ohlc(df_ohlc, max_puntos=MAX_PUNTOS_GRAFICO):
+    """
+    Reduce un frame OHLCV a como mucho max_puntos velas uniendo velas consecutivas.
+    Es un diezmado min/max: a diferencia de un muestreo, cada grupo conserva su High y su Low.
+    """
+    if len(df_ohlc) <= max_puntos:
+        return df_ohlc
+    tamano_grupo = -(-len(df_ohlc) // max_puntos) # división redondeando hacia arriba
+    grupos = np.arange(len(df_ohlc)) // tamano_grupo
+    df_decimado = df_ohlc.groupby(grupos).agg(AGREGACION_OHLC)
+    df_decimado.index = df_ohlc.index[::tamano_grupo] # cada grupo se fecha con su primera vela
+    return df_decimado
+
+def cargar_metodos_rango(fecha_inicio, fecha_fin):
+    """
+    Agregado de métodos para un rango fuera de la ventana cargada (zoom sobre el histórico).
+    Los buckets son del intervalo elegido para el zoom, así el número de filas no depende del rango.
+    """
+    segundos = INTERVALOS_SEGUNDOS[elegir_intervalo(fecha_inicio, fecha_fin)]
+    try:
+        if not _esquema_con_fotos():
+            return pd.DataFrame() # El esquema antiguo no guarda histórico fuera de la ventana con métodos codificados
+        params = _parametros_fotos(fecha_inicio, fecha_fin, segundos)
+        with metricas.tramo('sql_metodos_rango') as t:
+            df_metodos = _decodificar_metodos(pd.read_sql(SQL_METODOS, con=ENGINE, params=params))
+            t['filas'] = len(df_metodos)
+    except Exception as e:
+        print(f"[{datetime.datetime.now()}] Advertencia: No se pudieron agregar los métodos del rango: {e}")
+        return pd.DataFrame()
+    # El primer bucket solo contiene datos desde fecha_inicio: se fecha ahí para que el filtro de rango lo incluya
+    df_metodos['Timestamp'] = pd.to_datetime(df_metodos['Timestamp']).clip(lower=fecha_inicio)
+    return _compactar(df_metodos)
+
+def vista_zoom_cubierto(vista, version, intervalo, fecha_inicio, fecha_fin):
+    """
+    Vista para un zoom que las velas dibujadas ya cubren con la resolución adecuada, o None si hay que
+    cargar velas. Sigue siendo un zoom: si sale de la ventana cargada, los métodos se agregan para su rango.
+    """
+    if (vista and vista['version'] == version and vista['intervalo'] == intervalo and not vista['decimado']
+            and pd.Timestamp(vista['cargado_desde']) <= fecha_inicio and fecha_fin <= pd.Timestamp(vista['cargado_hasta'])):
+        return dict(vista, zoom=True, desde=fecha_inicio.isoformat(), hasta=fecha_fin.isoformat())
+    return None
+
+def metodos_de_vista(vista, df_metodos_ventana):
+    """
+    Métodos a dibujar para la vista del gráfico principal y la fecha desde la que se muestran.
+    Solo un zoom que sale de la ventana cargada agrega los métodos del rango en PostgreSQL.
+    Sin zoom, el rango es el de las velas (días): los métodos se limitan a la ventana cargada.
+    """
+    fecha_inicio, fecha_fin = pd.Timestamp(vista['desde']), pd.Timestamp(vista['hasta'])
+    if vista['zoom'] and (df_metodos_ventana.empty or fecha_inicio < df_metodos_ventana['Timestamp'].iloc[0]):
+        return cargar_metodos_rango(fecha_inicio, fecha_fin), fecha_inicio
+    if df_metodos_ventana.empty:
+        return df_metodos_ventana, fecha_inicio
+    return df_metodos_ventana, max(fecha_inicio, df_metodos_ventana['Timestamp'].iloc[0])
+
 # --- 2. CREACIÓN DE GRÁFICOS (Funciones de Visualización) ---
 
 def _crear_grafico_vacio(mensaje="Cargando datos..."):
@@ -253,10 +558,11 @@ def crear_figura_velas(df_demanda_ohlc, df_oferta_ohlc, interval):
     if df_demanda_ohlc.empty and df_oferta_ohlc.empty:
         return _crear_grafico_vacio(f"No hay datos para el intervalo {interval}")
     fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_heights=[0.8, 0.2])
-    fig.add_trace(go.Candlestick(x=df_demanda_ohlc.index, open=df_demanda_ohlc['Open'], high=df_demanda_ohlc['High'], low=df_demanda_ohlc['Low'], close=df_demanda_ohlc['Close'], name='Demanda (Compra)', increasing_line_color=COLOR_PRECIO_COMPRA, decreasing_line_color=COLOR_PRECIO_COMPRA, line=dict(width=1.5)), row=1, col=1)
-    fig.add_trace(go.Candlestick(x=df_oferta_ohlc.index, open=df_oferta_ohlc['Open'], high=df_oferta_ohlc['High'], low=df_oferta_ohlc['Low'], close=df_oferta_ohlc['Close'], name='Oferta (Venta)', increasing_line_color=COLOR_PRECIO_VENTA, decreasing_line_color=COLOR_PRECIO_VENTA, line=dict(width=1.5)), row=1, col=1)
-    fig.add_trace(go.Bar(x=df_demanda_ohlc.index, y=df_demanda_ohlc['Volume'], name='Vol. Compra', marker_color=COLOR_VOL_COMPRA, showlegend=False), row=2, col=1)
-    fig.add_trace(go.Bar(x=df_oferta_ohlc.index, y=df_oferta_ohlc['Volume'], name='Vol. Venta', marker_color=COLOR_VOL_VENTA, showlegend=False), row=2, col=1)
+    # Listas y no arrays: plotly codificaría los arrays en binario y los parches de refresco no podrían extenderlos
+    fig.add_trace(go.Candlestick(x=df_demanda_ohlc.index, open=df_demanda_ohlc['Open'].tolist(), high=df_demanda_ohlc['High'].tolist(), low=df_demanda_ohlc['Low'].tolist(), close=df_demanda_ohlc['Close'].tolist(), name='Demanda (Compra)', increasing_line_color=COLOR_PRECIO_COMPRA, decreasing_line_color=COLOR_PRECIO_COMPRA, line=dict(width=1.5)), row=1, col=1)
+    fig.add_trace(go.Candlestick(x=df_oferta_ohlc.index, open=df_oferta_ohlc['Open'].tolist(), high=df_oferta_ohlc['High'].tolist(), low=df_oferta_ohlc['Low'].tolist(), close=df_oferta_ohlc['Close'].tolist(), name='Oferta (Venta)', increasing_line_color=COLOR_PRECIO_VENTA, decreasing_line_color=COLOR_PRECIO_VENTA, line=dict(width=1.5)), row=1, col=1)
+    fig.add_trace(go.Bar(x=df_demanda_ohlc.index, y=df_demanda_ohlc['Volume'].tolist(), name='Vol. Compra', marker_color=COLOR_VOL_COMPRA, showlegend=False), row=2, col=1)
+    fig.add_trace(go.Bar(x=df_oferta_ohlc.index, y=df_oferta_ohlc['Volume'].tolist(), name='Vol. Venta', marker_color=COLOR_VOL_VENTA, showlegend=False), row=2, col=1)
     fig.update_layout(height=600, template="plotly_dark", hovermode="x unified", title={'text': f'Estilo Trading (Intervalo: {interval})'}, legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5), xaxis_rangeslider_visible=False, plot_bgcolor=COLOR_CARD_BACKGROUND, paper_bgcolor=COLOR_BACKGROUND_APP, barmode='overlay')
     fig.update_yaxes(title_text="Precio USDT (VES)", row=1, col=1, gridcolor='rgba(255,255,255,0.08)')
     fig.update_yaxes(title_text="Volumen USDT", row=2, col=1, showgrid=False)
@@ -265,17 +571,22 @@ def crear_figura_velas(df_demanda_ohlc, df_oferta_ohlc, interval):
     return fig
 
 # --- VISTA 2: Estilo Analítico (Área de Spread) ---
-def crear_figura_spread(df_demanda_ohlc, df_oferta_ohlc, interval):
-    if df_demanda_ohlc.empty and df_oferta_ohlc.empty:
-        return _crear_grafico_vacio(f"No hay datos para el intervalo {interval}")
-    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_heights=[0.8, 0.2])
+def _combinar_spread(df_demanda_ohlc, df_oferta_ohlc):
+    """Cierre de compra y venta (rellenados hacia delante) y volumen total sobre un mismo eje de tiempo."""
     df_combinado = pd.merge(df_demanda_ohlc[['Close', 'Volume']], df_oferta_ohlc[['Close', 'Volume']], left_index=True, right_index=True, how='outer', suffixes=('_D', '_O'))
     df_combinado['Close_D'] = df_combinado['Close_D'].ffill()
     df_combinado['Close_O'] = df_combinado['Close_O'].ffill()
     df_combinado['Volumen_Total'] = df_combinado['Volume_D'].fillna(0) + df_combinado['Volume_O'].fillna(0)
-    fig.add_trace(go.Scatter(x=df_combinado.index, y=df_combinado['Close_D'], mode='lines', line=dict(color=COLOR_PRECIO_COMPRA, width=1.5), name='Demanda (Compra)', hovertemplate='Compra: <b>%{y:.2f} VES</b><extra></extra>'), row=1, col=1)
-    fig.add_trace(go.Scatter(x=df_combinado.index, y=df_combinado['Close_O'], mode='lines', line=dict(color=COLOR_PRECIO_VENTA, width=1.5), fill='tonexty', fillcolor=COLOR_SPREAD, name='Oferta (Venta)', hovertemplate='Venta: <b>%{y:.2f} VES</b><extra></extra>'), row=1, col=1)
-    fig.add_trace(go.Bar(x=df_combinado.index, y=df_combinado['Volumen_Total'], name='Volumen Total', marker_color=COLOR_VOL_TOTAL, showlegend=False), row=2, col=1)
+    return df_combinado
+
+def crear_figura_spread(df_demanda_ohlc, df_oferta_ohlc, interval):
+    if df_demanda_ohlc.empty and df_oferta_ohlc.empty:
+        return _crear_grafico_vacio(f"No hay datos para el intervalo {interval}")
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_heights=[0.8, 0.2])
+    df_combinado = _combinar_spread(df_demanda_ohlc, df_oferta_ohlc)
+    fig.add_trace(go.Scatter(x=df_combinado.index, y=df_combinado['Close_D'].tolist(), mode='lines', line=dict(color=COLOR_PRECIO_COMPRA, width=1.5), name='Demanda (Compra)', hovertemplate='Compra: <b>%{y:.2f} VES</b><extra></extra>'), row=1, col=1)
+    fig.add_trace(go.Scatter(x=df_combinado.index, y=df_combinado['Close_O'].tolist(), mode='lines', line=dict(color=COLOR_PRECIO_VENTA, width=1.5), fill='tonexty', fillcolor=COLOR_SPREAD, name='Oferta (Venta)', hovertemplate='Venta: <b>%{y:.2f} VES</b><extra></extra>'), row=1, col=1)
+    fig.add_trace(go.Bar(x=df_combinado.index, y=df_combinado['Volumen_Total'].tolist(), name='Volumen Total', marker_color=COLOR_VOL_TOTAL, showlegend=False), row=2, col=1)
     fig.update_layout(height=600, template="plotly_dark", hovermode="x unified", title={'text': f'Estilo Analítico (Intervalo: {interval})'}, legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5), xaxis_rangeslider_visible=False, plot_bgcolor=COLOR_CARD_BACKGROUND, paper_bgcolor=COLOR_BACKGROUND_APP)
     fig.update_yaxes(title_text="Precio USDT (VES)", row=1, col=1, gridcolor='rgba(255,255,255,0.08)')
     fig.update_yaxes(title_text="Volumen USDT", row=2, col=1, showgrid=False)
@@ -305,13 +616,27 @@ def crear_figura_burbuja(df_demanda_ohlc, df_oferta_ohlc, interval):
     return fig
 
 # --- GRÁFICOS DE MÉTODOS (Funciones) ---
+# Trabajan sobre el agregado por bucket de 15 minutos (ver SQL_METODOS), no sobre anuncios sueltos
+
+def _filtrar_rango(df_metodos, fecha_inicio, fecha_fin):
+    """
+    Buckets que se solapan con [fecha_inicio, fecha_fin]. El frame está ordenado por Timestamp,
+    así que el rango se corta con dos búsquedas binarias en lugar de comparar todas las filas.
+    """
+    tiempos = df_metodos['Timestamp'].to_numpy()
+    inicio = np.searchsorted(tiempos, (pd.Timestamp(fecha_inicio) - BUCKET).to_datetime64(), side='right')
+    fin = np.searchsorted(tiempos, pd.Timestamp(fecha_fin).to_datetime64(), side='right')
+    return df_metodos.iloc[inicio:fin]
+
 def crear_grafico_premium(df_metodos_expl, fecha_inicio, fecha_fin):
     if df_metodos_expl.empty: return _crear_grafico_vacio("No hay datos de métodos")
-    df_filtrado_tiempo = df_metodos_expl[(df_metodos_expl['Timestamp'] >= fecha_inicio) & (df_metodos_expl['Timestamp'] <= fecha_fin)]
+    df_filtrado_tiempo = _filtrar_rango(df_metodos_expl, fecha_inicio, fecha_fin)
     if df_filtrado_tiempo.empty: return _crear_grafico_vacio("No hay datos de métodos de pago en este rango")
-    top_10_metodos_por_volumen = df_filtrado_tiempo.groupby('Metodos_Pago')['Volumen'].sum().nlargest(10).index
+    top_10_metodos_por_volumen = df_filtrado_tiempo.groupby('Metodos_Pago', observed=True)['Volumen'].sum().nlargest(10).index
     df_top_10 = df_filtrado_tiempo[df_filtrado_tiempo['Metodos_Pago'].isin(top_10_metodos_por_volumen)]
-    df_precios_promedio = df_top_10.groupby(['Metodos_Pago', 'Tipo'])['Precio'].mean().reset_index()
+    # Media por anuncio = suma de precios / nº de anuncios de todos los buckets del rango
+    df_sumas = df_top_10.groupby(['Metodos_Pago', 'Tipo'], observed=True)[['Precio_Suma', 'N']].sum()
+    df_precios_promedio = (df_sumas['Precio_Suma'] / df_sumas['N']).rename('Precio').reset_index()
     df_demanda = df_precios_promedio[df_precios_promedio['Tipo'] == 'Demanda'].sort_values('Precio', ascending=True)
     df_oferta = df_precios_promedio[df_precios_promedio['Tipo'] == 'Oferta']
     fig = go.Figure()
@@ -323,11 +648,11 @@ def crear_grafico_premium(df_metodos_expl, fecha_inicio, fecha_fin):
 
 def crear_grafico_flujo(df_metodos_expl, fecha_inicio, fecha_fin):
     if df_metodos_expl.empty: return _crear_grafico_vacio("No hay datos de métodos")
-    df_filtrado = df_metodos_expl[(df_metodos_expl['Timestamp'] >= fecha_inicio) & (df_metodos_expl['Timestamp'] <= fecha_fin)]
+    df_filtrado = _filtrar_rango(df_metodos_expl, fecha_inicio, fecha_fin)
     if df_filtrado.empty: return _crear_grafico_vacio()
-    top_10_metodos = df_filtrado.groupby('Metodos_Pago')['Volumen'].sum().nlargest(10).index
+    top_10_metodos = df_filtrado.groupby('Metodos_Pago', observed=True)['Volumen'].sum().nlargest(10).index
     df_top_10 = df_filtrado[df_filtrado['Metodos_Pago'].isin(top_10_metodos)]
-    df_volumen = df_top_10.groupby(['Metodos_Pago', 'Tipo'])['Volumen'].sum().unstack(fill_value=0).reset_index()
+    df_volumen = df_top_10.groupby(['Metodos_Pago', 'Tipo'], observed=True)['Volumen'].sum().unstack(fill_value=0).reset_index()
     if 'Demanda' not in df_volumen: df_volumen['Demanda'] = 0
     if 'Oferta' not in df_volumen: df_volumen['Oferta'] = 0
     df_volumen['Total'] = df_volumen['Demanda'] + df_volumen['Oferta']
@@ -343,7 +668,7 @@ def crear_grafico_tendencia(df_metodos_expl, fecha_inicio, fecha_fin):
     
     # --- CORRECCIÓN SETTINGWITHCOPYWARNING ---
     # Al filtrar, creamos una copia explícita con .copy()
-    df_filtrado = df_metodos_expl[(df_metodos_expl['Timestamp'] >= fecha_inicio) & (df_metodos_expl['Timestamp'] <= fecha_fin)].copy()
+    df_filtrado = _filtrar_rango(df_metodos_expl, fecha_inicio, fecha_fin).copy()
     
     if df_filtrado.empty: return _crear_grafico_vacio()
     
@@ -355,12 +680,15 @@ def crear_grafico_tendencia(df_metodos_expl, fecha_inicio, fecha_fin):
     elif duration_days <= 14: interval, interval_label = '6h', "6 Horas"
     else: interval, interval_label = '1d', "1 Día"
         
-    top_metodos = df_filtrado.groupby('Metodos_Pago')['Volumen'].sum().nlargest(7).index
+    top_metodos = df_filtrado.groupby('Metodos_Pago', observed=True)['Volumen'].sum().nlargest(7).index
     
-    # Esta es la línea que causaba el warning (336 aprox). Ahora es segura gracias al .copy() de arriba.
-    df_filtrado['Metodo_Agrupado'] = df_filtrado['Metodos_Pago'].apply(lambda x: x if x in top_metodos else 'Otros')
+    # Agrupar el resto en 'Otros' sin recorrer fila a fila (Metodos_Pago es Categorical)
+    metodos = df_filtrado['Metodos_Pago']
+    if isinstance(metodos.dtype, pd.CategoricalDtype) and 'Otros' not in metodos.cat.categories:
+        metodos = metodos.cat.add_categories('Otros')
+    df_filtrado['Metodo_Agrupado'] = metodos.where(metodos.isin(top_metodos), 'Otros')
     
-    df_resampled = (df_filtrado.set_index('Timestamp').groupby('Metodo_Agrupado').resample(interval)['Volumen'].sum().unstack(level=0, fill_value=0))
+    df_resampled = (df_filtrado.set_index('Timestamp').groupby('Metodo_Agrupado', observed=True).resample(interval)['Volumen'].sum().unstack(level=0, fill_value=0))
     if 'Otros' in df_resampled.columns: df_resampled = df_resampled[[col for col in df_resampled if col != 'Otros'] + ['Otros']]
     fig = go.Figure()
     for i, metodo in enumerate(df_resampled.columns):
@@ -372,29 +700,49 @@ def crear_grafico_tendencia(df_metodos_expl, fecha_inicio, fecha_fin):
 
 # --- 3. FUNCIONES AUXILIARES ---
 
-def obtener_rango_fechas_del_grafico(relayout_data, df_ohlc_actual):
-    if relayout_data is None or 'xaxis.range[0]' not in relayout_data:
-        if not df_ohlc_actual.empty: return df_ohlc_actual.index.min(), df_ohlc_actual.index.max()
-        else: return datetime.datetime.now(), datetime.datetime.now()
-    try:
-        fecha_inicio_str = relayout_data['xaxis.range[0]']
-        fecha_fin_str = relayout_data['xaxis.range[1]']
-        return pd.to_datetime(fecha_inicio_str), pd.to_datetime(fecha_fin_str)
-    except Exception:
-        return df_ohlc_actual.index.min(), df_ohlc_actual.index.max()
-
-def crear_texto_rango_fechas(fecha_inicio, fecha_fin):
-    return html.Span([
+def obtener_rango_zoom(relayout_data):
+    """Rango (inicio, fin) del zoom del gráfico principal, o None si se ve el rango por defecto."""
+    if not relayout_data:
+        return None
+    # Los subplots comparten eje X: el zoom puede llegar por el eje del precio o por el del volumen
+    for eje in ('xaxis', 'xaxis2'):
+        try:
+            if f'{eje}.range[0]' in relayout_data:
+                inicio, fin = relayout_data[f'{eje}.range[0]'], relayout_data[f'{eje}.range[1]']
+            elif f'{eje}.range' in relayout_data:
+                inicio, fin = relayout_data[f'{eje}.range']
+            else:
+                continue
+            fecha_inicio, fecha_fin = pd.to_datetime(inicio), pd.to_datetime(fin)
+            if fecha_inicio < fecha_fin:
+                return fecha_inicio, fecha_fin
+        except Exception:
+            continue
+    return None
+
+def crear_texto_rango_fechas(fecha_inicio, fecha_fin, inicio_metodos=None):
+    partes = [
         html.Span("RANGO DE FECHA: ", style={'color': 'white', 'fontWeight': '400'}),
         html.Span(f"{fecha_inicio.strftime(DEFAULT_TIMESTAMP_FORMAT)}", style={'color': COLOR_PRECIO_COMPRA, 'fontWeight': '700'}),
         html.Span(" — ", style={'color': 'gray'}),
         html.Span(f"{fecha_fin.strftime(DEFAULT_TIMESTAMP_FORMAT)}", style={'color': COLOR_PRECIO_VENTA, 'fontWeight': '700'})
-    ])
+    ]
+    if inicio_metodos is not None and inicio_metodos > fecha_inicio:
+        # Los gráficos de métodos solo cubren la ventana cargada (haz zoom para ver otro rango)
+        partes.append(html.Span(f" · Métodos desde {inicio_metodos.strftime(DEFAULT_TIMESTAMP_FORMAT)} (ventana cargada)",
+                                style={'color': 'gray', 'fontWeight': '400'}))
+    return html.Span(partes)
 
 # --- 4. INICIALIZACIÓN DE DASH ---
 
 app = Dash(__name__, external_stylesheets=EXTERNAL_STYLESHEET)
 server = app.server # Variable server para Gunicorn
+if ENGINE is not None:
+    conexion_db.registrar_ruta_salud(server, ENGINE) # GET /salud: latencia de la BD y métricas del pool
+metricas.registrar_rutas(server, [e for e in (ENGINE, ENGINE_ESCUCHA) if e is not None]) # GET /metrics (Prometheus)
+if ENGINE is not None:
+    # GET /exportar: anuncios o velas de un rango y mercado en CSV/Parquet, por lotes desde un cursor del servidor
+    exportar.registrar_ruta_exportar(server, ENGINE_EXPORTAR, (ASSET_DASHBOARD, FIAT_DASHBOARD), EXCHANGE_VELAS)
 
 app.index_string = f'''
 <!DOCTYPE html>
@@ -435,8 +783,10 @@ def crear_layout():
         texto_fecha_inicial = html.Span("Cargando rango de fechas...")
 
         return html.Div([
-            dcc.Store(id='store-raw-data'),
-            dcc.Store(id='store-methods-data'),
+            # Solo guarda la versión de los datos; los DataFrames viven en cache_frames (servidor)
+            dcc.Store(id='store-data-version'),
+            # Intervalo y rango que muestra el gráfico principal (lo escribe el callback 2, lo lee el 3)
+            dcc.Store(id='store-vista-principal'),
             
             dcc.Interval(
                 id='interval-data-refresh', 
@@ -444,6 +794,13 @@ def crear_layout():
                 n_intervals=0,
                 max_intervals=-1 
             ),
+            # Último ciclo del scraper que ya provocó una recarga en este cliente
+            dcc.Store(id='store-ciclo-visto'),
+            dcc.Interval(
+                id='interval-aviso-ciclo',
+                interval=SEGUNDOS_AVISO_CICLO * 1000,
+                n_intervals=0
+            ),
             dcc.Interval(
                 id='interval-initial-load',
                 interval=1 * 1000, 
@@ -507,85 +864,337 @@ print(f"[{datetime.datetime.now()}] Asignando crear_layout a app.layout...")
 app.layout = crear_layout
 print(f"[{datetime.datetime.now()}] Asignación de layout completada.")
 
-# --- 6. CALLBACKS (¡OPTIMIZADOS CON DCC.STORE!) ---
+# --- 6. CALLBACKS (DCC.STORE CON CLAVE DE VERSIÓN + CACHÉ EN SERVIDOR) ---
+
+FRAMES_CACHE = ['ohlc', 'metodos']
 
-# --- CALLBACK 1: Carga de Datos (Disparado por los Intervals) ---
+# --- AVISOS DE CICLO DEL SCRAPER (LISTEN/NOTIFY) ---
+# Un hilo por proceso mantiene una conexión con LISTEN. Los clientes solo comparan el último ciclo
+# anunciado con el suyo (una petición sin cuerpo de respuesta si no hay novedades), y la recarga
+# que provoca un ciclo se hace una vez: los demás clientes reutilizan la versión ya publicada.
+_ciclos_lock = threading.Lock()
+_ciclos = {'ultimo': None, 'recibido': None, 'hilo': None}
+_aviso_ciclo = threading.Event() # Se activa con cada aviso (lo espera worker_precalculo.py)
+
+def _escuchar_ciclos():
+    """Bucle del hilo de escucha. Si la conexión se cae, reconecta con espera creciente."""
+    espera = 1
+    while True:
+        pg = None
+        try:
+            conexion = ENGINE_ESCUCHA.raw_connection()
+            pg = conexion.driver_connection
+            conexion.detach() # El hilo la cierra directamente al reconectar
+            pg.autocommit = True
+            cursor = pg.cursor()
+            cursor.execute(f'LISTEN "{CANAL_CICLOS}"')
+            print(f"[{datetime.datetime.now()}] Escuchando avisos de ciclo en '{CANAL_CICLOS}'.")
+            espera = 1
+            while True:
+                if select.select([pg], [], [], 60) == ([], [], []):
+                    cursor.execute("SELECT 1") # Sin avisos en un minuto: comprobar que la conexión sigue viva
+                    continue
+                pg.poll()
+                if pg.notifies:
+                    aviso = pg.notifies[-1].payload
+                    pg.notifies.clear()
+                    with _ciclos_lock:
+                        _ciclos['ultimo'] = aviso
+                        _ciclos['recibido'] = datetime.datetime.now()
+                    _aviso_ciclo.set()
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Error en la escucha de ciclos ({e}). Reintentando en {espera}s...")
+        finally:
+            if pg is not None:
+                try:
+                    pg.close()
+                except Exception:
+                    pass
+        time.sleep(espera)
+        espera = min(espera * 2, 60)
+
+def _iniciar_escucha():
+    """Arranca el hilo de escucha si no está vivo (en el primer callback, no al importar: tras el fork de gunicorn)."""
+    with _ciclos_lock:
+        if ENGINE is None or (_ciclos['hilo'] is not None and _ciclos['hilo'].is_alive()):
+            return
+        _ciclos['hilo'] = threading.Thread(target=_escuchar_ciclos, name='escucha-ciclos', daemon=True)
+        _ciclos['hilo'].start()
+
+def _version_posterior_al_aviso():
+    """Versión de la caché cuya carga empezó después del último aviso (ya incluye ese ciclo), o None."""
+    with _ciclos_lock:
+        recibido = _ciclos['recibido']
+    ultima = cache_frames.ultima_version()
+    if recibido is None or ultima is None:
+        return None
+    # Cuenta el inicio de la consulta, no la escritura de la versión: una carga que empezó antes del
+    # aviso y terminó después no ve el ciclo. El scraper confirma el ciclo antes de enviar el NOTIFY.
+    inicio_carga = cache_frames.leer_metadatos(ultima).get('inicio_carga')
+    if inicio_carga is None:
+        return None
+    return ultima if datetime.datetime.fromisoformat(inicio_carga) > recibido else None
+
+
+# --- CALLBACK 0: Aviso de Ciclo Nuevo (Disparado por un Interval corto) ---
 @app.callback(
-    Output('store-raw-data', 'data'),
-    Output('store-methods-data', 'data'),
+    Output('store-ciclo-visto', 'data'),
+    Input('interval-aviso-ciclo', 'n_intervals'),
+    State('store-ciclo-visto', 'data')
+)
+@metricas.instrumentar
+def comprobar_ciclo_nuevo(n_intervals, ciclo_visto):
+    if DASHBOARD_PRECALCULO == 'externo':
+        ultimo = cache_frames.ultima_version() # El precálculo publica una versión por ciclo
+    else:
+        _iniciar_escucha()
+        with _ciclos_lock:
+            ultimo = _ciclos['ultimo']
+    if ultimo is None or ultimo == ciclo_visto:
+        raise PreventUpdate
+    return ultimo
+
+
+# --- CALLBACK 1: Carga de Datos (Disparado por los Intervals y los Avisos de Ciclo) ---
+@app.callback(
+    Output('store-data-version', 'data'),
     Output('app-title', 'children'),
     [Input('interval-initial-load', 'n_intervals'),
-     Input('interval-data-refresh', 'n_intervals')]
+     Input('interval-data-refresh', 'n_intervals'),
+     Input('store-ciclo-visto', 'data')],
+    State('store-data-version', 'data')
 )
-def update_global_data_store(n_initial, n_refresh):
+@metricas.instrumentar
+def update_global_data_store(n_initial, n_refresh, ciclo_visto, store_version):
     ctx = callback_context
     if not ctx.triggered:
         raise PreventUpdate
     
     trigger_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    if DASHBOARD_PRECALCULO == 'externo':
+        # Los agregados los publica worker_precalculo.py: este proceso no consulta la BD
+        version = cache_frames.ultima_version()
+        if version is None:
+            print(f"[{datetime.datetime.now()}] CALLBACK 1: El precálculo aún no publicó ninguna versión.")
+            if trigger_id == 'interval-initial-load':
+                return None, "Análisis de Mercado P2P (Esperando datos...)"
+            raise PreventUpdate
+        if store_version and store_version['version'] == version:
+            raise PreventUpdate
+        exchange_name = cache_frames.leer_metadatos(version).get('exchange_name', 'P2P')
+        return {'version': version}, f"Análisis de Mercado P2P: {exchange_name}"
+
+    if trigger_id == 'store-ciclo-visto':
+        # Otro cliente (o worker) ya recargó tras este ciclo: se reparte su versión sin tocar la BD
+        version_reciente = _version_posterior_al_aviso()
+        if version_reciente is not None:
+            if store_version and store_version['version'] == version_reciente:
+                raise PreventUpdate
+            print(f"[{datetime.datetime.now()}] CALLBACK 1: Ciclo nuevo, se reutiliza la versión {version_reciente}.")
+            return {'version': version_reciente}, no_update
     print(f"[{datetime.datetime.now()}] CALLBACK 1: Actualizando store (Disparado por: {trigger_id})...")
     
-    # --- CAMBIO A 6 HORAS ---
-    df_raw, df_metodos_expl, exchange_name = cargar_datos_crudos(hours_to_load=HOURS_TO_LOAD)
+    version, exchange_name = publicar_agregados()
     
     titulo = f"Análisis de Mercado P2P: {exchange_name}"
 
-    if df_raw.empty:
+    if version is None:
         print(f"[{datetime.datetime.now()}] CALLBACK 1: No se cargaron datos, no se actualiza el store.")
         titulo = f"Análisis de Mercado P2P: {exchange_name} (Sin datos recientes)"
         if trigger_id == 'interval-initial-load':
-             return None, None, titulo
+             return None, titulo
         raise PreventUpdate
+    return {'version': version}, titulo
+
+
+def publicar_agregados():
+    """
+    Carga los agregados de la ventana y los publica como una versión nueva de la caché.
+    Devuelve (versión, exchange_name); la versión es None si no hay datos.
+    """
+    inicio_carga = datetime.datetime.now() # Ver _version_posterior_al_aviso
+    # --- CAMBIO A 6 HORAS ---
+    df_ohlc, df_metodos_expl, exchange_name = cargar_agregados(hours_to_load=HOURS_TO_LOAD)
+    if df_ohlc.empty:
+        return None, exchange_name
     
-    json_raw = df_raw.to_json(orient='split', date_format='iso')
-    json_methods = df_metodos_expl.to_json(orient='split', date_format='iso')
+    # Los frames se publican en la caché del servidor; al navegador solo viaja la versión
+    with metricas.tramo('guardar_frames') as t:
+        version = cache_frames.guardar_frames({
+            'ohlc': df_ohlc.reset_index(drop=True),
+            'metodos': df_metodos_expl.reset_index(drop=True),
+        }, metadatos={'exchange_name': exchange_name, 'inicio_carga': inicio_carga.isoformat()})
+        t['filas'] = len(df_ohlc) + len(df_metodos_expl)
     
-    print(f"[{datetime.datetime.now()}] CALLBACK 1: Store de datos actualizado con {len(df_raw)} registros.")
-    return json_raw, json_methods, titulo
+    print(f"[{datetime.datetime.now()}] Caché de datos actualizada con {len(df_ohlc)} buckets (versión {version}).")
+    print(f"[{datetime.datetime.now()}] {conexion_db.informe_pool(ENGINE)}")
+    return version, exchange_name
+
+
+def _leer_frames(store_version, nombres=FRAMES_CACHE):
+    """Frames de la versión del cliente, o de la más reciente si esa ya se purgó (pestaña abierta mucho tiempo)."""
+    if not store_version:
+        return None
+    with metricas.tramo('leer_frames') as t:
+        frames = cache_frames.leer_frames(store_version['version'], nombres)
+        if frames is None:
+            ultima = cache_frames.ultima_version()
+            frames = cache_frames.leer_frames(ultima, nombres) if ultima else None
+        t['filas'] = sum(len(df) for df in frames.values()) if frames else 0
+    return frames
+
+# --- CACHÉ LRU DE VELAS POR (VERSIÓN, INTERVALO, MERCADO) ---
+# Cambiar de pestaña o volver a un intervalo ya visto no vuelve a leer ni a combinar velas.
+# Acotada en entradas y en bytes. Las versiones anteriores no se barren al llegar una nueva: un
+# cliente que aún no recibió el refresco sigue pidiendo la suya, y el LRU las desaloja solo.
+MAX_ENTRADAS_CACHE_OHLC = 16
+MAX_BYTES_CACHE_OHLC = int(os.environ.get("MAX_MB_CACHE_OHLC", 64)) * 1024 * 1024
+_ohlc_lock = threading.Lock()
+_ohlc_cache = OrderedDict() # (version, intervalo, mercado) -> (df_demanda, df_oferta, bytes)
 
+def _bytes_ohlc(df_demanda, df_oferta):
+    return int(df_demanda.memory_usage(deep=True).sum() + df_oferta.memory_usage(deep=True).sum())
+
+def _guardar_ohlc_cache(clave, df_demanda, df_oferta):
+    with _ohlc_lock:
+        _ohlc_cache[clave] = (df_demanda, df_oferta, _bytes_ohlc(df_demanda, df_oferta))
+        _ohlc_cache.move_to_end(clave)
+        while len(_ohlc_cache) > 1 and (len(_ohlc_cache) > MAX_ENTRADAS_CACHE_OHLC
+                                         or sum(e[2] for e in _ohlc_cache.values()) > MAX_BYTES_CACHE_OHLC):
+            _ohlc_cache.popitem(last=False)
+
+def obtener_ohlc(version, interval, df_ohlc):
+    """(df_demanda, df_oferta) del intervalo: de la caché, de p2p_velas o de los buckets de 15 minutos."""
+    mercado = (EXCHANGE_VELAS, ASSET_DASHBOARD, FIAT_DASHBOARD)
+    clave = (version, interval, mercado)
+    with _ohlc_lock:
+        if clave in _ohlc_cache:
+            _ohlc_cache.move_to_end(clave)
+            df_demanda_ohlc, df_oferta_ohlc = _ohlc_cache[clave][:2]
+            return df_demanda_ohlc, df_oferta_ohlc
+
+    # Cada intervalo lee sus propias velas: las de uno más fino cubren menos días (VELAS_DAYS_TO_LOAD)
+    # y no alcanzan para derivar el rango del más grueso
+    df_demanda_ohlc, df_oferta_ohlc = cargar_velas(interval)
+    if df_demanda_ohlc.empty and df_oferta_ohlc.empty:
+        # Sin velas pre-agregadas (p.ej. el scraper aún no creó la tabla): se combinan los buckets de 15 minutos
+        with metricas.tramo('resample') as t:
+            df_demanda_ohlc, df_oferta_ohlc = crear_datos_ohlc(df_ohlc, interval)
+            t['filas'] = len(df_demanda_ohlc) + len(df_oferta_ohlc)
+    _guardar_ohlc_cache(clave, df_demanda_ohlc, df_oferta_ohlc)
+    return df_demanda_ohlc, df_oferta_ohlc
 
-# --- CALLBACK 2: Actualización de Gráficos (Disparado por Stores y Clics) ---
+
+# --- ACTUALIZACIÓN PARCIAL DEL GRÁFICO PRINCIPAL (dash.Patch) ---
+# En los refrescos solo viajan al navegador las velas nuevas y la última (que pudo cambiar);
+# la figura completa se reconstruye al cambiar de pestaña o de intervalo.
+
+def _series_por_traza(tab_value, df_demanda_ohlc, df_oferta_ohlc):
+    """
+    Por cada traza de la figura del tab, (frame indexado por x, {atributo de la traza: columna}).
+    None si el tab no admite parches.
+    """
+    if tab_value == 'tab-burbuja':
+        return None # El tamaño de cada burbuja depende del volumen máximo: una vela nueva cambia todas
+    if tab_value == 'tab-spread':
+        df_combinado = _combinar_spread(df_demanda_ohlc, df_oferta_ohlc)
+        return [(df_combinado, {'y': 'Close_D'}), (df_combinado, {'y': 'Close_O'}), (df_combinado, {'y': 'Volumen_Total'})]
+    columnas_vela = {'open': 'Open', 'high': 'High', 'low': 'Low', 'close': 'Close'}
+    return [(df_demanda_ohlc, columnas_vela), (df_oferta_ohlc, columnas_vela),
+            (df_demanda_ohlc, {'y': 'Volume'}), (df_oferta_ohlc, {'y': 'Volume'})]
+
+def resumir_trazas(tab_value, df_demanda_ohlc, df_oferta_ohlc):
+    """Nº de puntos y primera y última x de cada traza dibujada (lo que necesita el siguiente parche)."""
+    series = _series_por_traza(tab_value, df_demanda_ohlc, df_oferta_ohlc)
+    if series is None:
+        return None
+    return [{'n': len(df), 'primero': df.index[0].isoformat() if len(df) else None,
+             'ultimo': df.index[-1].isoformat() if len(df) else None} for df, _ in series]
+
+def crear_parche_figura(tab_value, df_demanda_ohlc, df_oferta_ohlc, trazas_previas):
+    """
+    Patch que lleva la figura dibujada (resumida en trazas_previas) a las velas nuevas: reescribe la
+    última vela de cada traza y añade las posteriores. Devuelve (None, None) si hace falta reconstruirla.
+    """
+    series = _series_por_traza(tab_value, df_demanda_ohlc, df_oferta_ohlc)
+    if series is None or trazas_previas is None or len(series) != len(trazas_previas):
+        return None, None
+    parche = Patch()
+    trazas = []
+    for i, ((df, columnas), previa) in enumerate(zip(series, trazas_previas)):
+        # Sin puntos, o la ventana descartó velas por el principio: el parche solo sabe añadir al final
+        if previa['ultimo'] is None or df.empty or df.index[0] != pd.Timestamp(previa['primero']):
+            return None, None
+        cola = df[df.index >= pd.Timestamp(previa['ultimo'])]
+        # La última vela dibujada debe seguir ahí (si no, la ventana se movió por completo)
+        if cola.empty or cola.index[0] != pd.Timestamp(previa['ultimo']):
+            return None, None
+        n = previa['n'] + len(cola) - 1
+        if n > MAX_PUNTOS_GRAFICO:
+            return None, None # Reconstruir: la figura completa se vuelve a diezmar
+        for atributo, columna in columnas.items():
+            valores = [None if pd.isna(v) else float(v) for v in cola[columna]]
+            parche['data'][i][atributo][previa['n'] - 1] = valores[0]
+            if len(valores) > 1:
+                parche['data'][i][atributo].extend(valores[1:])
+        if len(cola) > 1:
+            parche['data'][i]['x'].extend([t.isoformat() for t in cola.index[1:]])
+        trazas.append(dict(previa, n=n, ultimo=cola.index[-1].isoformat()))
+    return parche, trazas
+
+
+# --- CALLBACK 2: Gráfico Principal (Disparado por Stores, Pestañas, Intervalo y Zoom) ---
+# Además del gráfico publica la vista (intervalo y rango visible) en 'store-vista-principal'.
+# Un zoom que las velas dibujadas ya cubren solo actualiza la vista, sin recalcular el gráfico.
 @app.callback(
     Output('grafico-principal', 'figure'),
-    Output('grafico-metodos-premium', 'figure'),
-    Output('grafico-metodos-flujo', 'figure'),
-    Output('grafico-metodos-tendencia', 'figure'),
-    Output('output-rango-fecha', 'children'),
-    Input('store-raw-data', 'data'),
-    Input('store-methods-data', 'data'),
+    Output('store-vista-principal', 'data'),
+    Input('store-data-version', 'data'),
     Input('tabs-grafico-principal', 'value'),
     Input('interval-selector', 'value'),
-    Input('grafico-principal', 'relayoutData')
+    Input('grafico-principal', 'relayoutData'),
+    State('store-vista-principal', 'data')
 )
-def actualizar_graficos(json_raw, json_methods, tab_value, interval_value, relayout_data):
-    if not json_raw or not json_methods:
+@metricas.instrumentar
+def actualizar_grafico_principal(store_version, tab_value, interval_value, relayout_data, vista):
+    frames = _leer_frames(store_version, ['ohlc'])
+    if frames is None:
         print(f"[{datetime.datetime.now()}] CALLBACK 2: Esperando datos del store...")
-        fig_vacia = _crear_grafico_vacio("Cargando datos...")
-        texto_vacio = html.Span("Cargando...")
-        return fig_vacia, fig_vacia, fig_vacia, fig_vacia, texto_vacio
-
-    print(f"[{datetime.datetime.now()}] CALLBACK 2: Actualizando gráficos...")
-    df_raw_global = pd.read_json(json_raw, orient='split')
-    df_metodos_expl_global = pd.read_json(json_methods, orient='split')
-    
-    df_raw_global['Timestamp'] = pd.to_datetime(df_raw_global['Timestamp'], errors='coerce')
-    df_metodos_expl_global['Timestamp'] = pd.to_datetime(df_metodos_expl_global['Timestamp'], errors='coerce')
+        return _crear_grafico_vacio("Cargando datos..."), None
 
-    
-    if df_raw_global.empty:
-        return (_crear_grafico_vacio("No hay datos recientes"),) * 4 + (html.Span("Esperando datos..."),)
+    # Frames compartidos de la caché (memory-map): no se modifican en el callback
+    df_ohlc_global = frames['ohlc']
+    if df_ohlc_global.empty:
+        return _crear_grafico_vacio("No hay datos recientes"), None
+    version = store_version['version']
 
     ctx = callback_context
     trigger_id = ctx.triggered
     trigger_id_prop = trigger_id[0]['prop_id'].split('.')[0] if trigger_id else None
     
-    df_demanda_ohlc, df_oferta_ohlc = crear_datos_ohlc(df_raw_global, interval_value)
-
-    if trigger_id_prop == 'grafico-principal' and 'xaxis.range[0]' in (relayout_data or {}):
-        fecha_inicio, fecha_fin = obtener_rango_fechas_del_grafico(relayout_data, df_demanda_ohlc)
+    # Con zoom, el rango visible decide qué velas pedir y a qué resolución (ver elegir_intervalo)
+    rango_zoom = obtener_rango_zoom(relayout_data) if trigger_id_prop == 'grafico-principal' else None
+    if rango_zoom:
+        fecha_inicio, fecha_fin = rango_zoom
+        intervalo_grafico = elegir_intervalo(fecha_inicio, fecha_fin)
+        vista_cubierta = vista_zoom_cubierto(vista, version, intervalo_grafico, fecha_inicio, fecha_fin)
+        if vista_cubierta is not None:
+            # Las velas dibujadas ya cubren el zoom: solo cambian los métodos
+            print(f"[{datetime.datetime.now()}] CALLBACK 2: Zoom dentro de las velas cargadas, solo se actualiza la vista.")
+            return no_update, vista_cubierta
+        print(f"[{datetime.datetime.now()}] CALLBACK 2: Zoom, cargando velas de {intervalo_grafico}...")
+        df_demanda_ohlc, df_oferta_ohlc = cargar_velas(intervalo_grafico, desde=fecha_inicio, hasta=fecha_fin)
+        if df_demanda_ohlc.empty and df_oferta_ohlc.empty:
+            df_demanda_ohlc, df_oferta_ohlc = (df.loc[fecha_inicio - pd.Timedelta(seconds=INTERVALOS_SEGUNDOS[intervalo_grafico]):fecha_fin]
+                                               for df in crear_datos_ohlc(df_ohlc_global, intervalo_grafico))
+        cargado_desde, cargado_hasta = fecha_inicio, fecha_fin
     else:
+        print(f"[{datetime.datetime.now()}] CALLBACK 2: Actualizando gráfico principal...")
+        intervalo_grafico = interval_value
+        df_demanda_ohlc, df_oferta_ohlc = obtener_ohlc(version, interval_value, df_ohlc_global)
+
         if df_demanda_ohlc.empty and df_oferta_ohlc.empty: 
-             return (_crear_grafico_vacio(f"No hay datos para el intervalo {interval_value}"),) * 4 + (html.Span("Datos insuficientes..."),)
+             return _crear_grafico_vacio(f"No hay datos para el intervalo {interval_value}"), None
         
         min_d = df_demanda_ohlc.index.min() if not df_demanda_ohlc.empty else pd.Timestamp.max
         min_o = df_oferta_ohlc.index.min() if not df_oferta_ohlc.empty else pd.Timestamp.min
@@ -597,30 +1206,84 @@ def actualizar_graficos(json_raw, json_methods, tab_value, interval_value, relay
         
         if fecha_inicio >= fecha_fin: 
             if fecha_inicio == pd.Timestamp.max:
-                return (_crear_grafico_vacio(f"No hay datos para el intervalo {interval_value}"),) * 4 + (html.Span("Datos insuficientes..."),)
+                return _crear_grafico_vacio(f"No hay datos para el intervalo {interval_value}"), None
             fecha_fin = fecha_inicio + datetime.timedelta(hours=1)
+        cargado_desde, cargado_hasta = fecha_inicio, fecha_fin
 
-    if trigger_id_prop == 'grafico-principal' and 'xaxis.range[0]' in (relayout_data or {}):
-        fig_principal = PreventUpdate
-    else:
+        # Refresco de datos con la misma pestaña e intervalo: parche en lugar de figura completa
+        if (trigger_id_prop == 'store-data-version' and vista and not vista['zoom']
+                and vista['tab'] == tab_value and vista['intervalo'] == interval_value):
+            with metricas.tramo('parche_figura'):
+                parche, trazas = crear_parche_figura(tab_value, df_demanda_ohlc, df_oferta_ohlc, vista['trazas'])
+            if parche is not None:
+                print(f"[{datetime.datetime.now()}] CALLBACK 2: Refresco parcial del gráfico principal.")
+                nueva_vista = dict(vista, version=version, trazas=trazas,
+                                   cargado_desde=cargado_desde.isoformat(), cargado_hasta=cargado_hasta.isoformat())
+                if vista['desde'] == vista['cargado_desde'] and vista['hasta'] == vista['cargado_hasta']:
+                    # Sin zoom del usuario, los métodos siguen al rango completo
+                    nueva_vista.update(desde=fecha_inicio.isoformat(), hasta=fecha_fin.isoformat())
+                return parche, nueva_vista
+
+    # Tope de puntos por traza, sea cual sea el rango
+    decimado = max(len(df_demanda_ohlc), len(df_oferta_ohlc)) > MAX_PUNTOS_GRAFICO
+    df_demanda_ohlc, df_oferta_ohlc = decimar_ohlc(df_demanda_ohlc), decimar_ohlc(df_oferta_ohlc)
+
+    with metricas.tramo('figura_principal') as t:
+        t['filas'] = len(df_demanda_ohlc) + len(df_oferta_ohlc)
         if (df_demanda_ohlc.empty and df_oferta_ohlc.empty):
-             fig_principal = _crear_grafico_vacio(f"No hay datos para el intervalo {interval_value}")
+             fig_principal = _crear_grafico_vacio(f"No hay datos para el intervalo {intervalo_grafico}")
         elif tab_value == 'tab-velas':
-            fig_principal = crear_figura_velas(df_demanda_ohlc, df_oferta_ohlc, interval_value)
+            fig_principal = crear_figura_velas(df_demanda_ohlc, df_oferta_ohlc, intervalo_grafico)
         elif tab_value == 'tab-spread':
-            fig_principal = crear_figura_spread(df_demanda_ohlc, df_oferta_ohlc, interval_value)
+            fig_principal = crear_figura_spread(df_demanda_ohlc, df_oferta_ohlc, intervalo_grafico)
         elif tab_value == 'tab-burbuja':
-            fig_principal = crear_figura_burbuja(df_demanda_ohlc, df_oferta_ohlc, interval_value)
+            fig_principal = crear_figura_burbuja(df_demanda_ohlc, df_oferta_ohlc, intervalo_grafico)
         else:
-            fig_principal = crear_figura_velas(df_demanda_ohlc, df_oferta_ohlc, interval_value)
+            fig_principal = crear_figura_velas(df_demanda_ohlc, df_oferta_ohlc, intervalo_grafico)
+    if rango_zoom:
+        # La figura nueva conserva el zoom del usuario
+        fig_principal.update_xaxes(range=[fecha_inicio, fecha_fin])
+
+    vista = {
+        'version': version, 'intervalo': intervalo_grafico, 'decimado': decimado,
+        'tab': tab_value, 'zoom': rango_zoom is not None,
+        'trazas': None if decimado else resumir_trazas(tab_value, df_demanda_ohlc, df_oferta_ohlc),
+        'cargado_desde': cargado_desde.isoformat(), 'cargado_hasta': cargado_hasta.isoformat(),
+        'desde': fecha_inicio.isoformat(), 'hasta': fecha_fin.isoformat(),
+    }
+    return fig_principal, vista
+
+
+# --- CALLBACK 3: Gráficos de Métodos (Disparado por la Vista del Gráfico Principal) ---
+@app.callback(
+    Output('grafico-metodos-premium', 'figure'),
+    Output('grafico-metodos-flujo', 'figure'),
+    Output('grafico-metodos-tendencia', 'figure'),
+    Output('output-rango-fecha', 'children'),
+    Input('store-vista-principal', 'data'),
+    State('store-data-version', 'data')
+)
+@metricas.instrumentar
+def actualizar_graficos_metodos(vista, store_version):
+    frames = _leer_frames(store_version, ['metodos']) if vista else None
+    if frames is None:
+        fig_vacia = _crear_grafico_vacio("Cargando datos...")
+        return fig_vacia, fig_vacia, fig_vacia, html.Span("Cargando...")
+
+    print(f"[{datetime.datetime.now()}] CALLBACK 3: Actualizando gráficos de métodos...")
+    fecha_inicio, fecha_fin = pd.Timestamp(vista['desde']), pd.Timestamp(vista['hasta'])
+    df_metodos_expl_global, inicio_metodos = metodos_de_vista(vista, frames['metodos'])
 
-    fig_premium = crear_grafico_premium(df_metodos_expl_global, fecha_inicio, fecha_fin)
-    fig_flujo = crear_grafico_flujo(df_metodos_expl_global, fecha_inicio, fecha_fin)
-    fig_tendencia = crear_grafico_tendencia(df_metodos_expl_global, fecha_inicio, fecha_fin)
+    with metricas.tramo('figura_premium'):
+        fig_premium = crear_grafico_premium(df_metodos_expl_global, inicio_metodos, fecha_fin)
+    with metricas.tramo('figura_flujo'):
+        fig_flujo = crear_grafico_flujo(df_metodos_expl_global, inicio_metodos, fecha_fin)
+    with metricas.tramo('figura_tendencia'):
+        fig_tendencia = crear_grafico_tendencia(df_metodos_expl_global, inicio_metodos, fecha_fin)
     
-    texto_fecha = crear_texto_rango_fechas(fecha_inicio, fecha_fin)
+    texto_fecha = crear_texto_rango_fechas(fecha_inicio, fecha_fin, inicio_metodos)
     
-    return fig_principal, fig_premium, fig_flujo, fig_tendencia, texto_fecha
+    return fig_premium, fig_flujo, fig_tendencia, texto_fecha
 
 # --- 7. EJECUCIÓN ---
 if __name__ == '__main__':
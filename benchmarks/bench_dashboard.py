@@ -0,0 +1,235 @@
+"""
+Benchmark del dashboard por etapas: latencia, pico de RSS y bytes de cada etapa para ventanas de
+6h, 24h, 7d y 30d, más el guardado de un ciclo del scraper.
+
+Los datos salen de generador_mercado.py (el dashboard lee el mercado de P2P_MERCADO_DASHBOARD y las
+velas de Exchange_Name='Sintetico'). Es solo PostgreSQL: las consultas usan date_bin, unnest y
+tablas particionadas. Cada ventana se mide en un proceso hijo, así el pico de RSS es el de esa
+ventana y no el de la mayor medida hasta el momento.
+
+Uso (contra un PostgreSQL local, NUNCA contra producción):
+    DATABASE_URL=postgresql://usuario@localhost/p2p_bench python benchmarks/generador_mercado.py --dias 30 --ciclo-segundos 600 --limpiar
+    DATABASE_URL=postgresql://usuario@localhost/p2p_bench python benchmarks/bench_dashboard.py --guardar base.json
+    # Antes de desplegar: falla (código 1) si alguna etapa empeora más de un 20% respecto a la base
+    DATABASE_URL=postgresql://usuario@localhost/p2p_bench python benchmarks/bench_dashboard.py --comparar base.json
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+VENTANAS = {'6h': 6, '24h': 24, '7d': 7 * 24, '30d': 30 * 24}
+EXCHANGE_SINTETICO = 'Sintetico' # El de generador_mercado.py
+MARCA_RESULTADO = 'RESULTADO_BENCH ' # Prefijo de la línea JSON que el hijo deja entre los logs del dashboard
+# Diferencia mínima para contar una regresión de latencia (evita falsos positivos en etapas de pocos ms)
+MARGEN_LATENCIA_MS = 5.0
+
+
+def rss_pico_mb():
+    """Pico de RSS del proceso hasta ahora (ru_maxrss está en KiB en Linux y en bytes en macOS)."""
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+
+
+def medir(etapas, nombre, funcion, repeticiones, medida=None):
+    """
+    Ejecuta funcion() 'repeticiones' veces y añade a 'etapas' la mediana de la latencia, el pico de
+    RSS tras la etapa y (filas, bytes) = medida(resultado). Devuelve el resultado de la última ejecución.
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    tiempos.sort()
+    filas, bytes_ = medida(resultado) if medida else (None, None)
+    etapas.append({'etapa': nombre, 'latencia_ms': tiempos[len(tiempos) // 2] * 1000,
+                   'rss_mb': rss_pico_mb(), 'filas': filas, 'bytes': bytes_})
+    return resultado
+
+
+def _bytes_df(*dfs):
+    return sum(int(df.memory_usage(deep=True).sum()) for df in dfs)
+
+
+def _bytes_figura(json_figura):
+    return None, len(json_figura.encode('utf-8'))
+
+
+def etapas_ventana(horas, repeticiones):
+    """Etapas del dashboard para una ventana de 'horas' (se ejecuta en el proceso hijo)."""
+    import app as dashboard # Tras fijar EXCHANGE_VELAS y P2P_CACHE_DIR en el entorno
+    import cache_frames
+
+    etapas = []
+    df_ohlc, df_metodos, _ = medir(
+        etapas, 'cargar_agregados', lambda: dashboard.cargar_agregados(horas, incremental=False), repeticiones,
+        lambda r: (len(r[0]) + len(r[1]), _bytes_df(r[0], r[1])))
+    if df_ohlc.empty:
+        raise RuntimeError("No hay datos en la ventana: genera antes el mercado con generador_mercado.py")
+    # Refresco tras un ciclo: solo el último bucket (el estado incremental es el de la carga completa)
+    medir(etapas, 'cargar_agregados (delta)', lambda: dashboard.cargar_agregados(horas, incremental=True), repeticiones,
+          lambda r: (len(r[0]) + len(r[1]), _bytes_df(r[0], r[1])))
+    dashboard.cargar_agregados(horas, incremental=False) # Deja el estado como tras la carga completa
+
+    frames = {'ohlc': df_ohlc, 'metodos': df_metodos}
+    version = medir(etapas, 'guardar_frames', lambda: cache_frames.guardar_frames(frames), repeticiones,
+                    lambda v: (None, sum(os.path.getsize(cache_frames._ruta(v, n)) for n in frames)))
+
+    def _leer_sin_memo():
+        cache_frames._memo['version'] = None # Lectura en frío, como la de un worker que aún no la tiene
+        return cache_frames.leer_frames(version, list(frames))
+    medir(etapas, 'leer_frames', _leer_sin_memo, repeticiones, lambda r: (sum(len(df) for df in r.values()), None))
+
+    fin = df_ohlc['Timestamp'].max().to_pydatetime() + dashboard.BUCKET
+    inicio = fin - datetime.timedelta(hours=horas)
+    df_demanda, df_oferta = medir(etapas, 'crear_datos_ohlc (1h)', lambda: dashboard.crear_datos_ohlc(df_ohlc, '1h'),
+                                  repeticiones, lambda r: (len(r[0]) + len(r[1]), _bytes_df(r[0], r[1])))
+    # Las figuras se miden con su serialización a JSON: es lo que Dash envía al navegador
+    medir(etapas, 'figura velas (1h)', lambda: dashboard.crear_figura_velas(df_demanda, df_oferta, '1h').to_json(),
+          repeticiones, _bytes_figura)
+    medir(etapas, 'cargar_velas (1h)', lambda: dashboard.cargar_velas('1h', desde=inicio), repeticiones,
+          lambda r: (len(r[0]) + len(r[1]), _bytes_df(r[0], r[1])))
+    for nombre, crear in (('premium', dashboard.crear_grafico_premium), ('flujo', dashboard.crear_grafico_flujo),
+                          ('tendencia', dashboard.crear_grafico_tendencia)):
+        medir(etapas, f'gráfico {nombre}', lambda: crear(df_metodos, inicio, fin).to_json(), repeticiones, _bytes_figura)
+    etapas_zoom_cubierto(dashboard, etapas, df_metodos, version, inicio, fin, repeticiones)
+    return etapas
+
+
+def etapas_zoom_cubierto(dashboard, etapas, df_metodos, version, inicio, fin, repeticiones):
+    """
+    Zoom anterior a la ventana que las velas ya dibujadas cubren: no recarga velas, pero los métodos
+    deben agregarse para el rango del zoom y no recortarse a la ventana cargada.
+    """
+    zoom_inicio, zoom_fin = inicio - datetime.timedelta(hours=6), inicio
+    intervalo = dashboard.elegir_intervalo(zoom_inicio, zoom_fin)
+    df_demanda, df_oferta = dashboard.cargar_velas(intervalo)
+    primeras = [df.index.min() for df in (df_demanda, df_oferta) if not df.empty]
+    cargado_desde = min(primeras) if primeras else None
+    if cargado_desde is None or cargado_desde > zoom_inicio:
+        return # Sin velas anteriores a la ventana (p. ej. la de 30d con 30 días generados)
+    vista = {'version': version, 'intervalo': intervalo, 'decimado': False, 'zoom': False,
+             'cargado_desde': cargado_desde.isoformat(), 'cargado_hasta': fin.isoformat(),
+             'desde': cargado_desde.isoformat(), 'hasta': fin.isoformat()}
+    vista = dashboard.vista_zoom_cubierto(vista, version, intervalo, pd.Timestamp(zoom_inicio), pd.Timestamp(zoom_fin))
+    if vista is None:
+        raise RuntimeError("El zoom cubierto por las velas cargadas no se reconoce como tal")
+    df_rango, inicio_metodos = medir(etapas, 'métodos zoom cubierto', lambda: dashboard.metodos_de_vista(vista, df_metodos),
+                                     repeticiones, lambda r: (len(r[0]), _bytes_df(r[0])))
+    if df_rango.empty or inicio_metodos != pd.Timestamp(zoom_inicio):
+        raise RuntimeError(f"Zoom cubierto de {zoom_inicio} a {zoom_fin}: los métodos se recortaron a la ventana cargada")
+
+
+def etapas_guardado(filas, repeticiones):
+    """guardar_en_db (COPY) de un ciclo de 'filas' anuncios (se ejecuta en el proceso hijo)."""
+    from bench_guardar_en_db import generar_anuncios, limpiar
+    from scraper_paas import ENGINE, ScraperP2P, inicializar_base_de_datos
+
+    inicializar_base_de_datos()
+    scraper = ScraperP2P(ENGINE)
+    etapas = []
+
+    def _guardar():
+        anuncios = generar_anuncios(filas, datetime.datetime.now())
+        scraper.codificar_metodos(anuncios)
+        if not scraper.guardar_en_db(anuncios):
+            raise RuntimeError("guardar_en_db falló")
+    try:
+        medir(etapas, f'guardar_en_db ({filas} filas)', _guardar, repeticiones, lambda r: (filas, None))
+    finally:
+        limpiar()
+    return etapas
+
+
+def ejecutar_hijo(args):
+    """Lanza este script en un proceso nuevo para una ventana y devuelve sus etapas."""
+    entorno = dict(os.environ, EXCHANGE_VELAS=EXCHANGE_SINTETICO, P2P_CACHE_DIR=args.dir_cache,
+                   DASHBOARD_PRECALCULO='local')
+    comando = [sys.executable, os.path.abspath(__file__), '--hijo', args.hijo_ventana, '--repeticiones', str(args.repeticiones),
+               '--filas-ciclo', str(args.filas_ciclo)]
+    salida = subprocess.run(comando, env=entorno, capture_output=True, text=True)
+    for linea in salida.stdout.splitlines():
+        if linea.startswith(MARCA_RESULTADO):
+            return json.loads(linea[len(MARCA_RESULTADO):])
+    raise RuntimeError(f"El proceso de '{args.hijo_ventana}' falló:\n{salida.stdout[-2000:]}\n{salida.stderr[-2000:]}")
+
+
+def comparar(resultados, base, tolerancia):
+    """Etapas que empeoran más de 'tolerancia' (fracción) en latencia, pico de RSS o bytes."""
+    anteriores = {(r['ventana'], r['etapa']): r for r in base}
+    regresiones = []
+    for r in resultados:
+        anterior = anteriores.get((r['ventana'], r['etapa']))
+        if anterior is None:
+            continue
+        for clave in ('latencia_ms', 'rss_mb', 'bytes'):
+            actual, previo = r.get(clave), anterior.get(clave)
+            if actual is None or not previo:
+                continue
+            if clave == 'latencia_ms' and actual - previo < MARGEN_LATENCIA_MS:
+                continue
+            if actual > previo * (1 + tolerancia):
+                regresiones.append(f"{r['ventana']:>5} {r['etapa']}: {clave} {previo:,.1f} -> {actual:,.1f} (+{(actual / previo - 1) * 100:.0f}%)")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ventanas', nargs='+', choices=list(VENTANAS), default=list(VENTANAS))
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--filas-ciclo', type=int, default=400, help='Anuncios del ciclo de guardar_en_db (0 para no medirlo)')
+    parser.add_argument('--guardar', metavar='JSON', help='Guardar los resultados (base para --comparar)')
+    parser.add_argument('--comparar', metavar='JSON', help='Resultados base: termina con código 1 si hay regresiones')
+    parser.add_argument('--tolerancia', type=float, default=0.2, help='Empeoramiento admitido respecto a la base (0.2 = 20%%)')
+    parser.add_argument('--hijo', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        if args.hijo == 'ciclo':
+            etapas = etapas_guardado(args.filas_ciclo, args.repeticiones)
+        else:
+            etapas = etapas_ventana(VENTANAS[args.hijo], args.repeticiones)
+        print(MARCA_RESULTADO + json.dumps(etapas), flush=True)
+        return
+
+    ejecuciones = list(args.ventanas) + (['ciclo'] if args.filas_ciclo > 0 else [])
+    resultados = []
+    print(f"{'ventana':>7} {'etapa':<26} {'latencia ms':>12} {'RSS pico MB':>12} {'filas':>10} {'bytes':>14}")
+    with tempfile.TemporaryDirectory(prefix='p2p_bench_cache_') as dir_cache:
+        for ventana in ejecuciones:
+            args.hijo_ventana, args.dir_cache = ventana, dir_cache
+            for etapa in ejecutar_hijo(args):
+                etapa['ventana'] = ventana
+                resultados.append(etapa)
+                filas = f"{etapa['filas']:,}" if etapa['filas'] is not None else '-'
+                bytes_ = f"{etapa['bytes']:,}" if etapa['bytes'] is not None else '-'
+                print(f"{ventana:>7} {etapa['etapa']:<26} {etapa['latencia_ms']:>12,.1f} {etapa['rss_mb']:>12,.1f} {filas:>10} {bytes_:>14}")
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, indent=1)
+        print(f"[{datetime.datetime.now()}] Resultados guardados en {args.guardar}.")
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            regresiones = comparar(resultados, json.load(f), args.tolerancia)
+        if regresiones:
+            print(f"[{datetime.datetime.now()}] ❌ {len(regresiones)} regresión(es) respecto a {args.comparar}:")
+            for linea in regresiones:
+                print(f"  {linea}")
+            sys.exit(1)
+        print(f"[{datetime.datetime.now()}] ✅ Sin regresiones respecto a {args.comparar} (tolerancia {args.tolerancia:.0%}).")
+
+
+if __name__ == '__main__':
+    main()
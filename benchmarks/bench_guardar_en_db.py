@@ -0,0 +1,84 @@
+"""
+Benchmark de ScraperP2P.guardar_en_db: filas/segundo con COPY frente al ORM.
+
+Uso (contra un PostgreSQL local, NUNCA contra producción):
+    DATABASE_URL=postgresql://usuario@localhost/p2p_bench python benchmarks/bench_guardar_en_db.py --filas 40 400 4000
+
+Las filas se insertan con Exchange_Name='Benchmark' y se borran al terminar.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from scraper_paas import ENGINE, TABLE_NAME, Anuncio, ScraperP2P, inicializar_base_de_datos
+
+EXCHANGE_BENCH = 'Benchmark'
+METODOS = ['Banesco', 'PagoMovil', 'Mercantil', 'Provincial', 'BancoDeVenezuela', 'Zelle', 'BNC', 'Bancamiga']
+
+
+def generar_anuncios(n, timestamp):
+    """Anuncios sintéticos con la forma de un ciclo real (precio, volumen, límites y métodos)."""
+    anuncios = []
+    for i in range(n):
+        tipo = 'Demanda' if i % 2 == 0 else 'Oferta'
+        metodos = random.sample(METODOS, random.randint(1, 3))
+        anuncios.append(Anuncio(
+            Timestamp=timestamp,
+            Tipo=tipo,
+            Precio=round(random.uniform(38.0, 42.0), 3),
+            Volumen=round(random.uniform(10.0, 5000.0), 2),
+            Volumen_min=round(random.uniform(5.0, 50.0), 2),
+            Volumen_max=round(random.uniform(100.0, 2000.0), 2),
+            Metodos_Pago=', '.join(metodos),
+            Exchange_Name=EXCHANGE_BENCH,
+            Asset='USDT',
+            Fiat='VES',
+        ))
+    return anuncios
+
+
+def medir(scraper, modo, n, repeticiones):
+    """Devuelve la mediana de filas/segundo de guardar_en_db en el modo indicado."""
+    tasas = []
+    for _ in range(repeticiones):
+        anuncios = generar_anuncios(n, datetime.datetime.now())
+        scraper.codificar_metodos(anuncios)
+        inicio = time.perf_counter()
+        if not scraper.guardar_en_db(anuncios, modo=modo):
+            raise RuntimeError(f"guardar_en_db falló en modo '{modo}'")
+        tasas.append(n / (time.perf_counter() - inicio))
+    tasas.sort()
+    return tasas[len(tasas) // 2]
+
+
+def limpiar():
+    with ENGINE.begin() as connection:
+        connection.execute(text(f'DELETE FROM {TABLE_NAME} WHERE "Exchange_Name" = :exchange'), {'exchange': EXCHANGE_BENCH})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filas', type=int, nargs='+', default=[40, 400, 4000], help='Filas por ciclo a probar')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+
+    inicializar_base_de_datos()
+    scraper = ScraperP2P(ENGINE)
+    print(f"{'filas/ciclo':>12} {'orm filas/s':>14} {'copy filas/s':>14} {'x':>6}")
+    try:
+        for n in args.filas:
+            orm = medir(scraper, 'orm', n, args.repeticiones)
+            copy = medir(scraper, 'copy', n, args.repeticiones)
+            print(f"{n:>12} {orm:>14,.0f} {copy:>14,.0f} {copy / orm:>6.1f}")
+    finally:
+        limpiar()
+
+
+if __name__ == '__main__':
+    main()
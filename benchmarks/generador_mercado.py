@@ -0,0 +1,186 @@
+"""
+Generador de mercado P2P sintético: llena un PostgreSQL local con los ciclos de N días de scraping.
+
+Cada ciclo pasa por ScraperP2P.guardar_ciclo (deduplicación, COPY, presencia y velas), así que la BD
+queda como tras N días de scraper real, sin pedir nada a Binance. Los anuncios tienen identidad estable
+(advNo): en cada ciclo una parte cambia de precio/volumen y otra sale del libro y es reemplazada.
+
+Uso (contra un PostgreSQL local, NUNCA contra producción):
+    DATABASE_URL=postgresql://usuario@localhost/p2p_bench python benchmarks/generador_mercado.py --dias 7 --limpiar
+    python benchmarks/generador_mercado.py --dias 30 --ciclo-segundos 600 --mercados USDT/VES,USDT/ARS \\
+        --anuncios-por-lado 100 --metodos PagoMovil:5,Banesco:3,Zelle:1
+
+Las filas se insertan con Exchange_Name='Sintetico'; --limpiar borra las de una ejecución anterior.
+"""
+import argparse
+import datetime
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from scraper_paas import (ENGINE, TABLE_NAME, TABLE_PRESENCIA, TABLE_VELAS, Anuncio, ScraperP2P,
+                          calcular_huella, inicializar_base_de_datos)
+
+EXCHANGE_SINTETICO = 'Sintetico' # Distinto del de bench_guardar_en_db.py, que borra sus filas al terminar
+# Precio de referencia inicial por fiat (el resto empieza en 1.0)
+PRECIOS_BASE = {'VES': 40.0, 'ARS': 1200.0, 'COP': 4000.0, 'BRL': 5.5, 'PEN': 3.8}
+METODOS_POR_DEFECTO = 'PagoMovil:5,Banesco:3,Mercantil:2,Provincial:2,BancoDeVenezuela:1,Zelle:1'
+
+
+def parsear_metodos(texto):
+    """'PagoMovil:5,Banesco:3' -> (['PagoMovil', 'Banesco'], [5.0, 3.0])"""
+    nombres, pesos = [], []
+    for parte in texto.split(','):
+        nombre, _, peso = parte.strip().partition(':')
+        nombres.append(nombre)
+        pesos.append(float(peso or 1))
+    return nombres, pesos
+
+
+class LibroSintetico:
+    """Libro de un (mercado, lado): anuncios con advNo estable que cambian y rotan ciclo a ciclo."""
+
+    def __init__(self, rng, asset, fiat, tipo, n_anuncios, metodos, prob_cambio, rotacion):
+        self.rng = rng
+        self.asset, self.fiat, self.tipo = asset, fiat, tipo
+        self.metodos, self.pesos = metodos
+        self.prob_cambio, self.rotacion = prob_cambio, rotacion
+        self.siguiente_adv = 0
+        self.anuncios = {}
+        for _ in range(n_anuncios):
+            self._alta()
+
+    def _alta(self):
+        self.siguiente_adv += 1
+        adv_no = f"{self.asset}{self.fiat}{self.tipo[0]}{self.siguiente_adv:08d}"
+        metodos = set(self.rng.choices(self.metodos, weights=self.pesos, k=self.rng.randint(1, 3)))
+        volumen_max = round(self.rng.uniform(100.0, 2000.0), 2)
+        self.anuncios[adv_no] = {
+            'margen': self.rng.uniform(0.0, 0.015), # Distancia al precio medio: ordena el libro
+            'Volumen': round(self.rng.uniform(10.0, 5000.0), 2),
+            'Volumen_min': round(self.rng.uniform(5.0, 50.0), 2),
+            'Volumen_max': volumen_max,
+            'Metodos_Pago': ', '.join(sorted(metodos)),
+            'Precio': None,
+        }
+
+    def avanzar(self, timestamp, precio_medio):
+        """Anuncios del libro en este ciclo (como los devolvería obtener_anuncios)."""
+        for adv_no in [a for a in self.anuncios if self.rng.random() < self.rotacion]:
+            del self.anuncios[adv_no]
+            self._alta()
+        signo = -1 if self.tipo == 'Demanda' else 1 # Los compradores pujan por debajo del medio
+        anuncios = []
+        for adv_no, a in self.anuncios.items():
+            if a['Precio'] is None or self.rng.random() < self.prob_cambio:
+                a['Precio'] = round(precio_medio * (1 + signo * (0.002 + a['margen'])), 3)
+                a['Volumen'] = round(max(1.0, a['Volumen'] * self.rng.uniform(0.8, 1.1)), 2)
+            anuncios.append(Anuncio(
+                Timestamp=timestamp, Tipo=self.tipo, Precio=a['Precio'], Volumen=a['Volumen'],
+                Volumen_min=a['Volumen_min'], Volumen_max=a['Volumen_max'], Metodos_Pago=a['Metodos_Pago'],
+                Exchange_Name=EXCHANGE_SINTETICO, Asset=self.asset, Fiat=self.fiat, Adv_No=adv_no,
+                Huella=calcular_huella(a['Precio'], a['Volumen'], a['Volumen_min'], a['Volumen_max'], a['Metodos_Pago']),
+            ))
+        # Orden del libro: el mejor precio primero
+        anuncios.sort(key=lambda x: x.Precio, reverse=(self.tipo == 'Demanda'))
+        return anuncios
+
+
+def preparar_particiones(inicio, fin):
+    """
+    Crea las particiones diarias del rango. crear_particiones solo avanza hacia el futuro; los días
+    ya cubiertos por otra partición (p.ej. el histórico) se saltan.
+    """
+    dia = datetime.datetime.combine(inicio.date(), datetime.time())
+    with ENGINE.begin() as connection:
+        while dia <= fin:
+            siguiente = dia + datetime.timedelta(days=1)
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {TABLE_NAME}_{dia:%Y%m%d} PARTITION OF {TABLE_NAME} "
+                        f"FOR VALUES FROM ('{dia:%Y-%m-%d}') TO ('{siguiente:%Y-%m-%d}')"
+                    ))
+            except Exception:
+                pass # Solapa con una partición existente
+            dia = siguiente
+
+
+def limpiar():
+    with ENGINE.begin() as connection:
+        for tabla in (TABLE_PRESENCIA, TABLE_NAME, TABLE_VELAS):
+            connection.execute(text(f'DELETE FROM {tabla} WHERE "Exchange_Name" = :exchange'), {'exchange': EXCHANGE_SINTETICO})
+
+
+def generar(dias, ciclo_segundos, mercados, anuncios_por_lado, metodos, prob_cambio=0.2, rotacion=0.02,
+            volatilidad=0.001, semilla=0):
+    """Inserta los ciclos de los últimos 'dias' días hasta ahora. Devuelve (ciclos, anuncios insertados)."""
+    rng = random.Random(semilla)
+    libros = {
+        (asset, fiat): [LibroSintetico(rng, asset, fiat, tipo, anuncios_por_lado, metodos, prob_cambio, rotacion)
+                        for tipo in ('Demanda', 'Oferta')]
+        for asset, fiat in mercados
+    }
+    precios = {mercado: PRECIOS_BASE.get(mercado[1], 1.0) for mercado in mercados}
+
+    scraper = ScraperP2P(ENGINE)
+    scraper.versiones = {} # El generador empieza su propio libro: no se lee la foto anterior de la BD
+    fin = datetime.datetime.now()
+    inicio = fin - datetime.timedelta(days=dias)
+    preparar_particiones(inicio, fin)
+
+    n_ciclos = int((fin - inicio).total_seconds() // ciclo_segundos)
+    t0 = time.perf_counter()
+    insertados = 0
+    for i in range(n_ciclos):
+        timestamp = inicio + datetime.timedelta(seconds=i * ciclo_segundos)
+        anuncios = []
+        for mercado, lados in libros.items():
+            precios[mercado] *= math.exp(rng.gauss(0, volatilidad)) # Paseo aleatorio del precio medio
+            for libro in lados:
+                anuncios.extend(libro.avanzar(timestamp, precios[mercado]))
+        nuevos, _ = scraper.guardar_ciclo(anuncios)
+        insertados += nuevos
+        if (i + 1) % 500 == 0 or i + 1 == n_ciclos:
+            transcurrido = time.perf_counter() - t0
+            print(f"[{datetime.datetime.now()}] {i + 1}/{n_ciclos} ciclos ({timestamp:%Y-%m-%d %H:%M}), "
+                  f"{insertados} anuncios insertados, {(i + 1) / transcurrido:.0f} ciclos/s")
+
+    with ENGINE.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT')
+        for tabla in (TABLE_NAME, TABLE_PRESENCIA, TABLE_VELAS):
+            connection.execute(text(f'ANALYZE {tabla}')) # Estadísticas al día para los planes del benchmark
+    scraper.pool_hilos.shutdown(wait=True)
+    scraper.pool_paginas.shutdown(wait=True)
+    return n_ciclos, insertados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dias', type=float, default=1, help='Días de historia hasta ahora')
+    parser.add_argument('--ciclo-segundos', type=int, default=120, help='Segundos entre ciclos (el scraper usa 120)')
+    parser.add_argument('--mercados', default='USDT/VES', help='Mercados asset/fiat separados por comas')
+    parser.add_argument('--anuncios-por-lado', type=int, default=100)
+    parser.add_argument('--metodos', default=METODOS_POR_DEFECTO, help='Métodos de pago y su peso: Nombre:peso,...')
+    parser.add_argument('--prob-cambio', type=float, default=0.2, help='Probabilidad de que un anuncio cambie en un ciclo')
+    parser.add_argument('--rotacion', type=float, default=0.02, help='Probabilidad de que un anuncio salga del libro')
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--limpiar', action='store_true', help='Borrar antes los datos de una generación anterior')
+    args = parser.parse_args()
+
+    mercados = [tuple(m.strip().upper().split('/')) for m in args.mercados.split(',') if m.strip()]
+    inicializar_base_de_datos()
+    if args.limpiar:
+        limpiar()
+    n_ciclos, insertados = generar(args.dias, args.ciclo_segundos, mercados, args.anuncios_por_lado,
+                                   parsear_metodos(args.metodos), args.prob_cambio, args.rotacion, semilla=args.semilla)
+    print(f"[{datetime.datetime.now()}] Generados {n_ciclos} ciclos de {len(mercados)} mercado(s): {insertados} anuncios en '{TABLE_NAME}'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import pyarrow as pa
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+# --- CACHÉ DE DATAFRAMES EN EL SERVIDOR ---
+# Los DataFrames del dashboard se guardan una vez en disco en formato Arrow IPC y el
+# dcc.Store del navegador solo guarda la clave de versión. Al ser ficheros, la caché es
+# compartida por todos los workers de gunicorn de la misma máquina, y al leerlos con
+# memory-map no hay que parsear JSON en cada clic.
+CACHE_DIR = os.environ.get("P2P_CACHE_DIR", os.path.join(tempfile.gettempdir(), "p2p_frame_cache"))
+
+# Versiones que se conservan en disco (un cliente puede seguir pidiendo la anterior
+# mientras recibe la nueva)
+VERSIONES_A_CONSERVAR = 3
+
+_EXTENSION = '.arrow'
+_SEPARADOR = '__'
+_METADATOS = 'metadatos.json'
+
+# Memo por proceso: los frames de la última versión leída, para no re-mapear en cada callback
+_memo_lock = threading.Lock()
+_memo = {'version': None, 'frames': {}}
+
+
+def _ruta(version, nombre):
+    return os.path.join(CACHE_DIR, f"{version}{_SEPARADOR}{nombre}{_EXTENSION}")
+
+
+def _versiones_en_disco():
+    """Devuelve las versiones presentes en la caché, de la más antigua a la más reciente."""
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    versiones = {f.split(_SEPARADOR)[0] for f in os.listdir(CACHE_DIR) if f.endswith(_EXTENSION)}
+    return sorted(versiones)
+
+
+def nueva_version():
+    """Clave de versión ordenable cronológicamente (única entre workers gracias al PID)."""
+    return f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}"
+
+
+def guardar_frames(frames, version=None, metadatos=None):
+    """
+    Escribe un dict {nombre: DataFrame} como una nueva versión de la caché y la devuelve.
+    Cada fichero se escribe en un temporal y se renombra, así ningún worker lee un fichero a medias.
+    metadatos (dict serializable a JSON) acompaña a la versión, ver leer_metadatos.
+    """
+    version = version or nueva_version()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if metadatos is not None:
+        # Antes que los frames: cuando la versión aparece en disco sus metadatos ya están
+        ruta_final = os.path.join(CACHE_DIR, f"{version}{_SEPARADOR}{_METADATOS}")
+        ruta_tmp = f"{ruta_final}.{os.getpid()}.tmp"
+        with open(ruta_tmp, 'w', encoding='utf-8') as f:
+            json.dump(metadatos, f)
+        os.replace(ruta_tmp, ruta_final)
+    for nombre, df in frames.items():
+        tabla = pa.Table.from_pandas(df, preserve_index=False)
+        ruta_final = _ruta(version, nombre)
+        ruta_tmp = f"{ruta_final}.{os.getpid()}.tmp"
+        with pa.OSFile(ruta_tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, tabla.schema) as writer:
+                writer.write_table(tabla)
+        os.replace(ruta_tmp, ruta_final)
+    _purgar_versiones_antiguas()
+    return version
+
+
+def _purgar_versiones_antiguas():
+    versiones = _versiones_en_disco()
+    for version in versiones[:-VERSIONES_A_CONSERVAR]:
+        for f in os.listdir(CACHE_DIR):
+            if f.startswith(f"{version}{_SEPARADOR}"):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, f))
+                except OSError:
+                    pass # Otro worker ya lo borró
+
+
+def leer_metadatos(version):
+    """Metadatos guardados con la versión ({} si no tiene o ya se purgó)."""
+    try:
+        with open(os.path.join(CACHE_DIR, f"{version}{_SEPARADOR}{_METADATOS}"), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def ultima_version():
+    versiones = _versiones_en_disco()
+    return versiones[-1] if versiones else None
+
+
+def leer_frames(version, nombres):
+    """
+    Devuelve {nombre: DataFrame} de una versión, o None si ya no está en disco.
+    Los ficheros se abren con memory-map: las columnas numéricas no se copian al leer.
+    """
+    with _memo_lock:
+        if _memo['version'] == version and all(n in _memo['frames'] for n in nombres):
+            return {n: _memo['frames'][n] for n in nombres}
+
+    frames = {}
+    try:
+        for nombre in nombres:
+            with pa.memory_map(_ruta(version, nombre), 'r') as source:
+                tabla = pa.ipc.open_file(source).read_all()
+            frames[nombre] = tabla.to_pandas(split_blocks=True)
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+
+    with _memo_lock:
+        if _memo['version'] != version:
+            _memo['version'] = version
+            _memo['frames'] = {}
+        _memo['frames'].update(frames)
+    return frames
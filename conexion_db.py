@@ -0,0 +1,138 @@
+import datetime
+import os
+import threading
+import time
+import weakref
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool, QueuePool
+
+# --- ENGINE COMPARTIDO (dashboard, scraper e inspector) ---
+# "local": pool de SQLAlchemy en cada proceso. Con gunicorn hay un pool por worker, así que el
+# máximo de conexiones es workers x (DB_POOL_TAMANO + DB_POOL_EXTRA): debe quedar por debajo de
+# max_connections del servidor.
+# "pgbouncer": las conexiones las reparte un pooler externo (PgBouncer en modo transacción) y cada
+# proceso abre y cierra la suya (NullPool), sin conexiones ociosas retenidas por worker.
+# "sin_pool": también NullPool, pero para engines que no deben tener pool con cualquier DB_POOL_MODO
+# (la escucha de ciclos y las exportaciones, que abren una conexión propia y de larga duración).
+DB_POOL_MODO = os.environ.get("DB_POOL_MODO", "local")
+DB_POOL_TAMANO = int(os.environ.get("DB_POOL_TAMANO", 3)) # Conexiones que se mantienen abiertas
+DB_POOL_EXTRA = int(os.environ.get("DB_POOL_EXTRA", 2)) # Conexiones extra en picos (se cierran al devolverse)
+DB_POOL_ESPERA = float(os.environ.get("DB_POOL_ESPERA", 10)) # Segundos esperando una conexión libre antes de fallar
+DB_POOL_RECICLAR = int(os.environ.get("DB_POOL_RECICLAR", 30 * 60)) # Segundos de vida de una conexión
+DB_TIMEOUT_CONEXION = int(os.environ.get("DB_TIMEOUT_CONEXION", 10))
+# Un checkout que tarda más que esto cuenta como espera (pool agotado o conexión nueva lenta)
+UMBRAL_ESPERA_SEGUNDOS = 0.1
+
+
+def normalizar_url(url):
+    """Fuerza el prefijo 'postgresql://' (Render/Heroku entregan 'postgres://')."""
+    if url and url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+class _PoolMedido(QueuePool):
+    """QueuePool que mide cuánto tarda cada checkout (la espera por una conexión libre)."""
+
+    def connect(self):
+        # connect() es la API pública con la que el engine pide conexiones al pool
+        inicio = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            _registrar_espera(self, time.perf_counter() - inicio)
+
+
+_metricas_lock = threading.Lock()
+_metricas = weakref.WeakKeyDictionary() # pool -> contadores (un pool nuevo tras dispose empieza de cero)
+
+
+def _contadores(pool):
+    return _metricas.setdefault(pool, {
+        'checkouts': 0, 'conexiones_nuevas': 0, 'invalidadas': 0,
+        'esperas': 0, 'espera_total_s': 0.0, 'espera_max_s': 0.0,
+    })
+
+
+def _registrar_espera(pool, segundos):
+    with _metricas_lock:
+        c = _contadores(pool)
+        c['espera_total_s'] += segundos
+        c['espera_max_s'] = max(c['espera_max_s'], segundos)
+        if segundos >= UMBRAL_ESPERA_SEGUNDOS:
+            c['esperas'] += 1
+
+
+def _contar(pool, clave):
+    with _metricas_lock:
+        _contadores(pool)[clave] += 1
+
+
+def crear_engine(url, nombre, modo=DB_POOL_MODO):
+    """
+    Engine con pre-ping (una conexión muerta tras reiniciar la BD se descarta y se reemplaza en
+    lugar de fallar el callback), reciclado periódico y métricas del pool (ver metricas_pool).
+    """
+    url = normalizar_url(url)
+    opciones = {'pool_pre_ping': True, 'connect_args': {'connect_timeout': DB_TIMEOUT_CONEXION, 'application_name': nombre}}
+    if modo in ('pgbouncer', 'sin_pool'):
+        opciones['poolclass'] = NullPool
+    else:
+        opciones.update(poolclass=_PoolMedido, pool_size=DB_POOL_TAMANO, max_overflow=DB_POOL_EXTRA,
+                        pool_timeout=DB_POOL_ESPERA, pool_recycle=DB_POOL_RECICLAR,
+                        pool_use_lifo=True) # LIFO: las conexiones sobrantes quedan ociosas y el reciclado las cierra
+    engine = create_engine(url, **opciones)
+    engine.info_pool = {'nombre': nombre, 'modo': modo} # Para los informes
+    if opciones['poolclass'] is _PoolMedido:
+        engine.info_pool['maximo'] = DB_POOL_TAMANO + DB_POOL_EXTRA
+
+    event.listen(engine, 'checkout', lambda *args: _contar(engine.pool, 'checkouts'))
+    event.listen(engine, 'connect', lambda *args: _contar(engine.pool, 'conexiones_nuevas'))
+    event.listen(engine, 'invalidate', lambda *args: _contar(engine.pool, 'invalidadas'))
+    # Tras un fork (gunicorn --preload) el hijo no debe reutilizar las conexiones del padre
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+    return engine
+
+
+def metricas_pool(engine):
+    """Contadores acumulados y estado actual del pool del engine."""
+    pool = engine.pool
+    with _metricas_lock:
+        metricas = dict(_contadores(pool))
+    metricas.update(engine.info_pool)
+    if isinstance(pool, QueuePool):
+        metricas.update(en_uso=pool.checkedout(), en_reposo=pool.checkedin(), overflow=max(pool.overflow(), 0),
+                        tamano=pool.size())
+    return metricas
+
+
+def informe_pool(engine):
+    """Resumen de una línea para los logs."""
+    m = metricas_pool(engine)
+    estado = f", en uso {m['en_uso']}/{m['maximo']} (overflow {m['overflow']})" if 'en_uso' in m else ""
+    return (f"Pool '{m['nombre']}' ({m['modo']}): {m['checkouts']} checkouts, {m['conexiones_nuevas']} conexiones nuevas, "
+            f"{m['invalidadas']} invalidadas, {m['esperas']} esperas (máx {m['espera_max_s'] * 1000:.0f} ms){estado}")
+
+
+def comprobar_conexion(engine):
+    """Health check: latencia en ms de un SELECT 1 (lanza la excepción si la BD no responde)."""
+    inicio = time.perf_counter()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    return (time.perf_counter() - inicio) * 1000
+
+
+def registrar_ruta_salud(server, engine, ruta='/salud'):
+    """Añade al servidor Flask de una app Dash una ruta JSON con el estado de la BD y del pool (503 si no responde)."""
+    from flask import jsonify
+
+    def salud():
+        try:
+            latencia_ms = comprobar_conexion(engine)
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Health check de la BD fallido: {e}")
+            return jsonify({'db': 'error', 'error': str(e), 'pool': metricas_pool(engine)}), 503
+        return jsonify({'db': 'ok', 'latencia_ms': round(latencia_ms, 1), 'pool': metricas_pool(engine)})
+
+    server.add_url_rule(ruta, 'salud_db', salud)
@@ -1,9 +1,11 @@
 import dash
-from dash import dash_table, html, dcc, Input, Output
+from dash import dash_table, html, dcc, callback_context, Input, Output, State
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import text
 import os
+import re
 import datetime
+import conexion_db # Engine compartido: pool, pre-ping y métricas
 
 # --- CONFIGURACIÓN DE BASE DE DATOS (Lee la variable de entorno de Render) ---
 DATABASE_URL = os.environ.get("DATABASE_URL")
@@ -12,18 +14,44 @@ if not DATABASE_URL:
     print("[INSPECTOR DB] ERROR FATAL: DATABASE_URL no encontrada en el entorno de Render.")
     exit()
 
-# Asegurar el prefijo correcto para SQLAlchemy
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-
 try:
-    ENGINE = create_engine(DATABASE_URL)
+    ENGINE = conexion_db.crear_engine(DATABASE_URL, 'inspector')
     print("[INSPECTOR DB] Engine de SQLAlchemy creado con la URL interna.")
 except Exception as e:
     print(f"[INSPECTOR DB] ERROR FATAL: No se pudo crear el engine: {e}")
     exit()
 
 TABLE_NAME = 'p2p_anuncios' 
+TABLE_METODOS = 'p2p_metodos_pago'
+
+# --- PAGINACIÓN POR CLAVE (KEYSET) Y FILTROS EN EL SERVIDOR ---
+# Cada página se pide con WHERE ("Timestamp", id) < (clave de la última fila de la anterior) sobre
+# el índice idx_anuncios_tiempo_id (lo crea el scraper): la página 1000 cuesta lo mismo que la
+# primera, sin OFFSET ni COUNT(*). Las claves de las páginas vistas se guardan en el navegador.
+FILAS_POR_PAGINA = 20
+COLUMNAS = ['id', 'Timestamp', 'Tipo', 'Asset', 'Fiat', 'Precio', 'Volumen', 'Metodos_Pago', 'Exchange_Name']
+COLUMNAS_NUMERICAS = {'id', 'Precio', 'Volumen'}
+# Filtros admitidos: columna -> operadores. En las columnas de texto '=' es igualdad exacta y
+# 'contains' (lo que la DataTable envía al escribir un valor suelto) busca con ILIKE durante el
+# recorrido de la clave; Metodos_Pago busca en el diccionario de métodos.
+FILTROS = {
+    'id': {'='},
+    'Timestamp': {'=', '>=', '<=', '>', '<', 'datestartswith', 'contains'},
+    'Tipo': {'=', 'contains'},
+    'Asset': {'=', 'contains'},
+    'Fiat': {'=', 'contains'},
+    'Exchange_Name': {'=', 'contains'},
+    'Precio': {'=', '>=', '<=', '>', '<'},
+    'Volumen': {'=', '>=', '<=', '>', '<'},
+    'Metodos_Pago': {'=', 'contains'},
+}
+# Operadores de filter_query (símbolo o alias de la DataTable) -> operador SQL
+OPERADORES = {'>=': '>=', 'ge': '>=', '<=': '<=', 'le': '<=', '>': '>', 'gt': '>', '<': '<', 'lt': '<',
+              '=': '=', 'eq': '=', 'contains': 'contains', 'datestartswith': 'datestartswith'}
+# Fechas del filtro de Timestamp: un prefijo (año, mes, día, hora, minuto) cubre todo su periodo
+RE_FECHA = re.compile(r'^\d{4}(-\d{2}(-\d{2}([ T]\d{2}(:\d{2}(:\d{2})?)?)?)?)?$')
+PERIODO_PREFIJO = {4: pd.DateOffset(years=1), 7: pd.DateOffset(months=1), 10: pd.DateOffset(days=1),
+                   13: pd.Timedelta(hours=1), 16: pd.Timedelta(minutes=1), 19: pd.Timedelta(seconds=1)}
 
 # --- APLICACIÓN DASH ---
 COLOR_BG = '#282c34'
@@ -33,12 +61,14 @@ COLOR_ACCENT = '#00cc96' # Un verde neón para acentuar
 
 app = dash.Dash(__name__)
 server = app.server 
+conexion_db.registrar_ruta_salud(server, ENGINE) # GET /salud: latencia de la BD y métricas del pool
 
 # --- CORRECCIÓN DE SINTAXIS EN app.layout ---
 # El error era un paréntesis extra al final de la primera línea de html.Div()
 app.layout = html.Div(style={'fontFamily': 'Roboto, sans-serif', 'padding': '20px', 'backgroundColor': COLOR_BG, 'minHeight': '100vh', 'color': COLOR_TEXT}, children=[
     html.H1("Inspector de Base de Datos P2P", style={'textAlign': 'center', 'color': COLOR_TEXT}),
-    html.P("Esta herramienta se conecta internamente a la base de datos y muestra los 50 registros más recientes.", style={'textAlign': 'center', 'color': '#ccc'}),
+    html.P("Esta herramienta se conecta internamente a la base de datos y recorre los registros del más reciente al más antiguo.", style={'textAlign': 'center', 'color': '#ccc'}),
+    html.P("Filtros: Tipo, Asset, Fiat y Exchange por texto contenido (o exacto con = Compra); Metodos_Pago por nombre; Precio y Volumen con >=, <=, > o <; Timestamp con un periodo (2024, 2024-05, 2024-05-01 10) o un rango (>= 2024-05-01 10:00).", style={'textAlign': 'center', 'color': '#ccc', 'fontSize': '13px'}),
     html.P("Si ves datos aquí, confirma que el scraper está funcionando correctamente.", style={'textAlign': 'center', 'color': COLOR_ACCENT, 'fontWeight': 'bold'}),
     
     html.Button('Actualizar Datos (Ejecutar Consulta)', id='btn-refresh-render', n_clicks=0, 
@@ -49,11 +79,14 @@ app.layout = html.Div(style={'fontFamily': 'Roboto, sans-serif', 'padding': '20p
                     'fontWeight': 'bold'
                 }),
     
+    dcc.Store(id='store-claves-paginas'), # Clave (Timestamp, id) con la que empieza cada página ya vista
     dcc.Loading(id="loading-icon-render", children=[
         html.Div(id='error-output-render', style={'color': 'red', 'marginBottom': '10px', 'textAlign': 'center', 'fontWeight': 'bold'}), 
         dash_table.DataTable(
             id='data-table-render',
-            columns=[],
+            # Timestamp como 'datetime': una fecha suelta en el filtro llega como datestartswith
+            columns=[{"name": c, "id": c, "type": 'numeric' if c in COLUMNAS_NUMERICAS else 'datetime' if c == 'Timestamp' else 'text'}
+                     for c in COLUMNAS],
             data=[],
             style_table={'overflowX': 'auto', 'border': f'1px solid {COLOR_ACCENT}', 'borderRadius': '5px'},
             style_header={'backgroundColor': COLOR_CARD, 'color': COLOR_TEXT, 'fontWeight': 'bold'},
@@ -66,45 +99,163 @@ app.layout = html.Div(style={'fontFamily': 'Roboto, sans-serif', 'padding': '20p
                 'height': 'auto',
                 'border': '1px solid #333'
             },
-            page_size=20, # Mostrar 20 filas por página
-            sort_action="native",
+            page_size=FILAS_POR_PAGINA,
+            page_current=0,
+            page_action='custom', # Cada página se pide al servidor (ver update_table)
+            filter_action='custom',
+            filter_query='',
+            sort_action='none', # El orden es el de la clave: Timestamp e id descendentes
         )
     ], type="default")
 ])
 
+def _parsear_filtro(parte):
+    """'{Precio} >= 40' -> ('Precio', '>=', '40'). Devuelve None si no se reconoce."""
+    encontrado = re.match(r'\s*\{(?P<columna>[^}]+)\}\s+(?P<operador>\S+)\s+(?P<valor>.+?)\s*$', parte)
+    if encontrado is None:
+        return None
+    operador = encontrado['operador']
+    if operador[:1] in ('i', 's') and operador[1:] in OPERADORES:
+        operador = operador[1:] # Variantes con/sin mayúsculas (icontains, s=...): se tratan igual
+    valor = encontrado['valor']
+    if len(valor) > 1 and valor[0] == valor[-1] and valor[0] in ('"', "'", '`'):
+        valor = valor[1:-1].replace('\\' + valor[0], valor[0])
+    return encontrado['columna'], OPERADORES.get(operador), valor
+
+def _patron_contiene(valor):
+    """Patrón ILIKE '%valor%' con los comodines del propio valor escapados."""
+    return '%' + valor.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def _periodo_fecha(valor):
+    """'2024-05' -> (2024-05-01, 2024-06-01): inicio y fin (excluido) del periodo que cubre el prefijo."""
+    valor = valor.strip()
+    if not RE_FECHA.match(valor):
+        raise ValueError(valor)
+    desde = pd.Timestamp(valor)
+    return desde.to_pydatetime(), (desde + PERIODO_PREFIJO[len(valor)]).to_pydatetime()
+
+def construir_filtros(filter_query):
+    """
+    Traduce el filter_query de la DataTable a condiciones SQL con parámetros.
+    Lanza ValueError con un mensaje para el usuario si un filtro no está admitido.
+    """
+    condiciones, params = [], {}
+    for i, parte in enumerate(p for p in (filter_query or '').split(' && ') if p.strip()):
+        filtro = _parsear_filtro(parte)
+        if filtro is None or filtro[0] not in FILTROS or filtro[1] not in FILTROS[filtro[0]]:
+            raise ValueError(f"Filtro no admitido: {parte}")
+        columna, operador, valor = filtro
+        clave = f"f{i}"
+        try:
+            if columna in COLUMNAS_NUMERICAS:
+                params[clave] = int(float(valor)) if columna == 'id' else float(valor)
+                condiciones.append(f'"{columna}" {operador} :{clave}')
+            elif columna == 'Timestamp':
+                if operador in ('=', 'datestartswith', 'contains'):
+                    # Una fecha incompleta (mes, día, hora...) cubre todo su periodo: [inicio, fin)
+                    params[clave], params[f"{clave}_hasta"] = _periodo_fecha(valor)
+                    condiciones.append(f'"Timestamp" >= :{clave} AND "Timestamp" < :{clave}_hasta')
+                else:
+                    params[clave] = pd.Timestamp(valor).to_pydatetime()
+                    condiciones.append(f'"Timestamp" {operador} :{clave}')
+            elif columna == 'Metodos_Pago':
+                params[clave] = _patron_contiene(valor)
+                condiciones.append(f'"Metodos_Ids" && ARRAY(SELECT id FROM {TABLE_METODOS} WHERE "Nombre" ILIKE :{clave})')
+            elif operador == 'contains':
+                params[clave] = _patron_contiene(valor)
+                condiciones.append(f'"{columna}" ILIKE :{clave}')
+            else:
+                params[clave] = valor.upper() if columna in ('Asset', 'Fiat') else valor.capitalize() if columna == 'Tipo' else valor
+                condiciones.append(f'"{columna}" = :{clave}')
+        except (TypeError, ValueError):
+            ejemplo = " (usa 2024, 2024-05, 2024-05-01 o 2024-05-01 10:30)" if columna == 'Timestamp' else ""
+            raise ValueError(f"Valor no válido para {columna}: {valor}{ejemplo}")
+    return condiciones, params
+
+def _consulta_pagina(condiciones, clave_inicio, limite, solo_claves=False, saltar=0):
+    """SELECT de una página desde clave_inicio (None = la más reciente), en el orden de la clave."""
+    condiciones = list(condiciones)
+    if clave_inicio is not None:
+        condiciones.append('("Timestamp", id) < (:clave_ts, :clave_id)')
+    columnas = '"Timestamp", id' if solo_claves else ', '.join(f'"{c}"' for c in COLUMNAS)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    offset = " OFFSET :saltar" if saltar else ""
+    return text(f'SELECT {columnas} FROM {TABLE_NAME} {where} ORDER BY "Timestamp" DESC, id DESC LIMIT :limite{offset}')
+
+def _params_clave(params, clave_inicio, **extra):
+    params = dict(params, **extra)
+    if clave_inicio is not None:
+        params.update(clave_ts=datetime.datetime.fromisoformat(clave_inicio[0]), clave_id=clave_inicio[1])
+    return params
+
+def _clave_de_pagina(pagina, claves, condiciones, params, tamano):
+    """
+    Clave con la que empieza la página. Si el usuario salta a una página no vista, se avanza desde
+    la última clave conocida leyendo solo claves del índice. Devuelve False si la página no existe.
+    """
+    if pagina == 0:
+        return None
+    if str(pagina) in claves:
+        return claves[str(pagina)]
+    conocida = max((int(p) for p in claves if int(p) < pagina), default=0)
+    clave_inicio = claves.get(str(conocida))
+    with ENGINE.connect() as connection:
+        fila = connection.execute(
+            _consulta_pagina(condiciones, clave_inicio, 1, solo_claves=True, saltar=(pagina - conocida) * tamano - 1),
+            _params_clave(params, clave_inicio, limite=1, saltar=(pagina - conocida) * tamano - 1),
+        ).first()
+    return False if fila is None else [fila[0].isoformat(), fila[1]]
+
 @app.callback(
     Output('data-table-render', 'data'),
-    Output('data-table-render', 'columns'),
+    Output('data-table-render', 'page_count'),
+    Output('data-table-render', 'page_current'),
+    Output('store-claves-paginas', 'data'),
     Output('error-output-render', 'children'),
-    Input('btn-refresh-render', 'n_clicks')
+    Input('btn-refresh-render', 'n_clicks'),
+    Input('data-table-render', 'page_current'),
+    Input('data-table-render', 'page_size'),
+    Input('data-table-render', 'filter_query'),
+    State('store-claves-paginas', 'data')
 )
-def update_table(n_clicks):
-    print(f"[{datetime.datetime.now()}] [INSPECTOR] Ejecutando consulta a la base de datos... (Click: {n_clicks})")
+def update_table(n_clicks, page_current, page_size, filter_query, estado):
+    disparador = callback_context.triggered[0]['prop_id'] if callback_context.triggered else ''
+    pagina, tamano = page_current or 0, page_size or FILAS_POR_PAGINA
+    # Las claves solo valen para el filtro y el tamaño con que se calcularon; "Actualizar" vuelve a la primera página
+    if (disparador.startswith('btn-refresh-render') or not estado
+            or estado['filtro'] != (filter_query or '') or estado['tamano'] != tamano):
+        estado = {'filtro': filter_query or '', 'tamano': tamano, 'claves': {}}
+        pagina = 0
+    print(f"[{datetime.datetime.now()}] [INSPECTOR] Consultando la página {pagina + 1} (filtro: '{filter_query or ''}')...")
     try:
-        # Consulta SQL para obtener los 50 registros más recientes
-        query = f"""
-            SELECT id, "Timestamp", "Tipo", "Precio", "Volumen", "Metodos_Pago", "Exchange_Name" 
-            FROM {TABLE_NAME} 
-            ORDER BY "Timestamp" DESC 
-            LIMIT 50
-        """
-        
-        # Leemos los datos desde la DB usando la conexión interna de Render
-        df = pd.read_sql(query, con=ENGINE)
-        
+        condiciones, params = construir_filtros(filter_query)
+        clave_inicio = _clave_de_pagina(pagina, estado['claves'], condiciones, params, tamano)
+        if clave_inicio is False:
+            return [], pagina, pagina, estado, "No hay más registros."
+
+        # Una fila de más indica si existe la página siguiente
+        with ENGINE.connect() as connection:
+            df = pd.read_sql(_consulta_pagina(condiciones, clave_inicio, tamano + 1), con=connection,
+                             params=_params_clave(params, clave_inicio, limite=tamano + 1))
+        hay_siguiente = len(df) > tamano
+        df = df.iloc[:tamano]
+
+        estado['claves'][str(pagina)] = clave_inicio
+        if hay_siguiente:
+            ultima = df.iloc[-1]
+            estado['claves'][str(pagina + 1)] = [ultima['Timestamp'].isoformat(), int(ultima['id'])]
         if not df.empty:
             df['Timestamp'] = df['Timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-            
-        data = df.to_dict('records')
-        columns = [{"name": i, "id": i} for i in df.columns]
-        
-        print(f"[{datetime.datetime.now()}] [INSPECTOR] Tabla actualizada con {len(df)} registros.")
-        return data, columns, "" # Sin error
-        
+
+        print(f"[{datetime.datetime.now()}] [INSPECTOR] Página {pagina + 1} con {len(df)} registros.")
+        # Sin COUNT(*): el número de páginas solo se conoce al llegar a la última
+        return df.to_dict('records'), None if hay_siguiente else pagina + 1, pagina, estado, ""
+    except ValueError as e:
+        return [], None, pagina, estado, str(e)
     except Exception as e:
         error_message = f"Error Crítico: {e}. Confirma que el Cron Job esté guardando datos."
         print(f"[{datetime.datetime.now()}] [INSPECTOR] ERROR: {e}")
-        return [], [], error_message
+        return [], None, pagina, estado, error_message
 
 if __name__ == '__main__':
     app.run_server(debug=True, host='0.0.0.0', port=os.environ.get('PORT', 8050))
@@ -0,0 +1,261 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import csv
+import datetime
+import io
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import text
+
+import metricas
+
+# --- EXPORTACIÓN MASIVA (CSV / PARQUET EN STREAMING) ---
+# GET /exportar?tabla=anuncios|velas&formato=csv|parquet&desde=...&hasta=...&mercado=USDT/VES
+# Las filas se leen con un cursor del lado del servidor (stream_results) en lotes de
+# EXPORTAR_FILAS_LOTE y cada lote se envía en cuanto está listo: un bloque CSV o un row group de
+# Parquet. La memoria del proceso depende del lote, no del rango exportado.
+# Cada exportación usa su propia conexión (engine sin pool, ver app.py), así nunca retiene las del
+# pool del dashboard. Con gunicorn, una exportación ocupa su worker mientras dura: con workers
+# gthread (--threads) ocupa solo un hilo, y EXPORTAR_MAXIMAS_SIMULTANEAS limita cuántos por proceso.
+EXPORTAR_FILAS_LOTE = int(os.environ.get("EXPORTAR_FILAS_LOTE", 50000)) # Filas por lote (y por row group)
+EXPORTAR_MAXIMAS_SIMULTANEAS = int(os.environ.get("EXPORTAR_MAXIMAS_SIMULTANEAS", 1)) # Por proceso; el resto recibe 429
+EXPORTAR_MAX_DIAS = int(os.environ.get("EXPORTAR_MAX_DIAS", 31)) # Rango máximo de los anuncios (las velas admiten un año)
+EXPORTAR_MAX_DIAS_VELAS = 366
+
+TABLE_NAME = 'p2p_anuncios'
+TABLE_VELAS = 'p2p_velas'
+INTERVALOS = ('15t', '1h', '4h', '1d')
+TIPOS = ('Demanda', 'Oferta')
+FORMATOS = {'csv': 'text/csv; charset=utf-8', 'parquet': 'application/vnd.apache.parquet'}
+
+# Columnas exportadas y su tipo en Parquet. Los anuncios son las versiones guardadas por el
+# scraper: una fila por anuncio nuevo o cambiado, no la foto completa de cada ciclo.
+COLUMNAS = {
+    'anuncios': [('id', pa.int64()), ('Timestamp', pa.timestamp('us')), ('Tipo', pa.string()),
+                 ('Precio', pa.float64()), ('Volumen', pa.float64()), ('Volumen_min', pa.float64()),
+                 ('Volumen_max', pa.float64()), ('Metodos_Pago', pa.string()), ('Exchange_Name', pa.string()),
+                 ('Asset', pa.string()), ('Fiat', pa.string()), ('Adv_No', pa.string())],
+    'velas': [('Bucket', pa.timestamp('us')), ('Intervalo', pa.string()), ('Tipo', pa.string()),
+              ('Exchange_Name', pa.string()), ('Asset', pa.string()), ('Fiat', pa.string()),
+              ('Open', pa.float64()), ('High', pa.float64()), ('Low', pa.float64()), ('Close', pa.float64()),
+              ('Volume', pa.float64()), ('Num_Anuncios', pa.int64())],
+}
+
+# Filtros opcionales (None en el parámetro = sin filtro). El orden de los anuncios sigue
+# idx_anuncios_tiempo_id, así el cursor avanza por el índice sin ordenar el rango en memoria.
+SQL_EXPORTAR = {
+    'anuncios': text(f"""
+        SELECT {', '.join(f'"{c}"' for c, _ in COLUMNAS['anuncios'])}
+        FROM {TABLE_NAME}
+        WHERE "Timestamp" >= :desde AND "Timestamp" < :hasta
+          AND "Asset" = :asset AND "Fiat" = :fiat
+          AND (CAST(:exchange AS text) IS NULL OR "Exchange_Name" = :exchange)
+          AND (CAST(:tipo AS text) IS NULL OR "Tipo" = :tipo)
+        ORDER BY "Timestamp", id
+        """),
+    'velas': text(f"""
+        SELECT {', '.join(f'"{c}"' for c, _ in COLUMNAS['velas'])}
+        FROM {TABLE_VELAS}
+        WHERE "Intervalo" = :intervalo AND "Exchange_Name" = :exchange
+          AND "Asset" = :asset AND "Fiat" = :fiat AND "Bucket" >= :desde AND "Bucket" < :hasta
+          AND (CAST(:tipo AS text) IS NULL OR "Tipo" = :tipo)
+        ORDER BY "Bucket", "Tipo"
+        """),
+}
+
+_RE_MERCADO = re.compile(r'^([A-Z0-9]{2,10})/([A-Z0-9]{2,10})$')
+
+_exportaciones = threading.BoundedSemaphore(EXPORTAR_MAXIMAS_SIMULTANEAS)
+
+
+def _parsear_fecha(valor, nombre):
+    try:
+        return datetime.datetime.fromisoformat(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{nombre}' debe ser una fecha ISO (p.ej. 2024-05-01 o 2024-05-01T12:00), no '{valor}'")
+
+
+def validar_parametros(args, mercado_defecto, exchange_defecto):
+    """
+    Valida los parámetros de la petición y devuelve (tabla, formato, params de la consulta).
+    Lanza ValueError con un mensaje para el cliente si alguno no es válido.
+    """
+    tabla = args.get('tabla', 'anuncios')
+    if tabla not in SQL_EXPORTAR:
+        raise ValueError(f"'tabla' debe ser una de {', '.join(SQL_EXPORTAR)}")
+    formato = args.get('formato', 'csv')
+    if formato not in FORMATOS:
+        raise ValueError(f"'formato' debe ser uno de {', '.join(FORMATOS)}")
+    if 'desde' not in args:
+        raise ValueError("Falta 'desde' (inicio del rango, fecha ISO)")
+    desde = _parsear_fecha(args['desde'], 'desde')
+    hasta = _parsear_fecha(args['hasta'], 'hasta') if 'hasta' in args else datetime.datetime.now()
+    if hasta <= desde:
+        raise ValueError("'hasta' debe ser posterior a 'desde'")
+    max_dias = EXPORTAR_MAX_DIAS if tabla == 'anuncios' else EXPORTAR_MAX_DIAS_VELAS
+    if hasta - desde > datetime.timedelta(days=max_dias):
+        raise ValueError(f"El rango máximo para '{tabla}' es de {max_dias} días: divide la exportación")
+    encontrado = _RE_MERCADO.match(args.get('mercado', '/'.join(mercado_defecto)).upper())
+    if encontrado is None:
+        raise ValueError("'mercado' debe tener la forma ASSET/FIAT, p.ej. USDT/VES")
+    tipo = args.get('tipo')
+    if tipo is not None and tipo not in TIPOS:
+        raise ValueError(f"'tipo' debe ser uno de {', '.join(TIPOS)}")
+
+    params = {'desde': desde, 'hasta': hasta, 'asset': encontrado.group(1), 'fiat': encontrado.group(2),
+              'tipo': tipo, 'exchange': args.get('exchange')}
+    if tabla == 'velas':
+        params['intervalo'] = args.get('intervalo', '1h')
+        if params['intervalo'] not in INTERVALOS:
+            raise ValueError(f"'intervalo' debe ser uno de {', '.join(INTERVALOS)}")
+        params['exchange'] = params['exchange'] or exchange_defecto # Las velas se guardan por exchange
+    return tabla, formato, params
+
+
+class _Tubo:
+    """Fichero de solo escritura para ParquetWriter: acumula los bytes hasta que se recogen."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.posicion = 0
+        self.closed = False
+
+    def write(self, datos):
+        self.buffer += datos
+        self.posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self.posicion
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def recoger(self):
+        datos = bytes(self.buffer)
+        self.buffer.clear()
+        return datos
+
+
+def _bloques_csv(lotes, columnas):
+    salida = io.StringIO()
+    escritor = csv.writer(salida, lineterminator='\n')
+    escritor.writerow(columnas)
+    for lote in lotes:
+        escritor.writerows(lote)
+        yield salida.getvalue().encode('utf-8')
+        salida.seek(0)
+        salida.truncate()
+    if salida.tell():
+        yield salida.getvalue().encode('utf-8') # Solo la cabecera: rango sin filas
+
+
+def _bloques_parquet(lotes, esquema):
+    tubo = _Tubo()
+    escritor = pq.ParquetWriter(tubo, esquema, compression='zstd')
+    for lote in lotes:
+        columnas = list(zip(*lote))
+        escritor.write_table(pa.Table.from_arrays(
+            [pa.array(valores, type=campo.type) for valores, campo in zip(columnas, esquema)], schema=esquema))
+        yield tubo.recoger() # Un row group por lote
+    escritor.close()
+    yield tubo.recoger() # Pie del fichero (metadatos de los row groups)
+
+
+def generar_exportacion(engine, tabla, formato, params):
+    """
+    Generador de los bloques de bytes de la exportación. La conexión y el cursor del servidor
+    viven mientras se consume: al cerrarlo (fin de la respuesta o cliente desconectado) se liberan.
+    """
+    inicio = time.perf_counter()
+    filas, enviados = 0, 0
+    completa = False
+    try:
+        with engine.connect() as conexion:
+            # stream_results: cursor con nombre de psycopg2, las filas se traen del servidor a medida que se piden
+            resultado = conexion.execution_options(stream_results=True, max_row_buffer=EXPORTAR_FILAS_LOTE).execute(
+                SQL_EXPORTAR[tabla], params)
+
+            def lotes():
+                nonlocal filas
+                for lote in resultado.partitions(EXPORTAR_FILAS_LOTE):
+                    filas += len(lote)
+                    yield [tuple(fila) for fila in lote]
+
+            if formato == 'csv':
+                bloques = _bloques_csv(lotes(), [c for c, _ in COLUMNAS[tabla]])
+            else:
+                bloques = _bloques_parquet(lotes(), pa.schema(COLUMNAS[tabla]))
+            for bloque in bloques:
+                enviados += len(bloque)
+                yield bloque
+        completa = True
+    finally:
+        segundos = time.perf_counter() - inicio
+        metricas.registrar_tramo(f'exportar_{tabla}', segundos, filas, enviados)
+        estado = "completada" if completa else "interrumpida"
+        print(f"[{datetime.datetime.now()}] Exportación de {tabla} ({formato}) {estado}: {filas} filas, "
+              f"{enviados / 2**20:.1f} MB en {segundos:.1f} s.")
+
+
+def nombre_fichero(tabla, formato, params):
+    partes = ['p2p', tabla, params['asset'], params['fiat']]
+    if tabla == 'velas':
+        partes.append(params['intervalo'])
+    partes += [f"{params['desde']:%Y%m%dT%H%M}", f"{params['hasta']:%Y%m%dT%H%M}"]
+    return f"{'_'.join(partes)}.{formato}"
+
+
+def registrar_ruta_exportar(server, engine, mercado_defecto, exchange_defecto, ruta='/exportar'):
+    """
+    Añade al servidor Flask la descarga en streaming de anuncios o velas.
+    Responde 400 si los parámetros no son válidos, 429 si el proceso ya tiene
+    EXPORTAR_MAXIMAS_SIMULTANEAS exportaciones en curso y 503 si la consulta no se puede abrir.
+    """
+    from flask import Response, jsonify, request
+
+    def exportar():
+        try:
+            tabla, formato, params = validar_parametros(request.args, mercado_defecto, exchange_defecto)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not _exportaciones.acquire(blocking=False):
+            respuesta = jsonify({'error': 'Hay otra exportación en curso en este proceso, reinténtalo en unos minutos'})
+            respuesta.headers['Retry-After'] = '60'
+            return respuesta, 429
+
+        liberada = threading.Lock()
+
+        def liberar():
+            if liberada.acquire(blocking=False): # Una sola vez, llegue antes el fin del cuerpo o el cierre
+                _exportaciones.release()
+
+        bloques = generar_exportacion(engine, tabla, formato, params)
+        try:
+            # El primer bloque abre la consulta: un error de la BD aún puede devolverse como 503
+            primero = next(bloques, b'')
+        except Exception as e:
+            liberar()
+            print(f"[{datetime.datetime.now()}] Error al abrir la exportación de {tabla}: {e}")
+            return jsonify({'error': 'No se pudo leer la base de datos'}), 503
+
+        def cuerpo():
+            try:
+                yield primero
+                yield from bloques
+            finally:
+                liberar()
+
+        respuesta = Response(cuerpo(), content_type=FORMATOS[formato])
+        respuesta.headers['Content-Disposition'] = f'attachment; filename="{nombre_fichero(tabla, formato, params)}"'
+        # El servidor WSGI cierra siempre la respuesta, aunque el cliente corte antes del primer bloque
+        respuesta.call_on_close(lambda: (bloques.close(), liberar()))
+        return respuesta
+
+    server.add_url_rule(ruta, 'exportar_datos', exportar)
@@ -0,0 +1,361 @@
+import atexit
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cache_frames
+import conexion_db
+
+# --- INSTRUMENTACIÓN POR TRAMOS (duración, filas, bytes y RSS) ---
+# Cada etapa de un callback (consulta, caché, resample, figura...) se envuelve en un tramo. Los
+# tramos se acumulan en histogramas por proceso que se exponen en formato Prometheus (ver
+# registrar_rutas) y, dentro de una petición de Dash, se juntan en una línea JSON por callback.
+# Con gunicorn cada worker tiene sus propios contadores y /metrics lo responde cualquiera de ellos:
+# cada proceso vuelca los suyos a un fichero de METRICAS_DIR (como el modo multiproceso de
+# prometheus_client) y /metrics suma los de todos los procesos de la máquina, también los de
+# worker_precalculo.py y los de workers ya reiniciados. Vacía METRICAS_DIR al desplegar si el
+# directorio sobrevive a los reinicios. Con METRICAS_DIR="" solo se exponen las del proceso.
+# El volcado lo hace un hilo por proceso cada METRICAS_VOLCADO_SEGUNDOS (y al salir), no cada
+# petición: /metrics ve los contadores de los demás procesos con ese retraso como mucho.
+METRICAS_DIR = os.environ.get("METRICAS_DIR", os.path.join(cache_frames.CACHE_DIR, "metricas"))
+METRICAS_VOLCADO_SEGUNDOS = float(os.environ.get("METRICAS_VOLCADO_SEGUNDOS", 5))
+METRICAS_LOG = os.environ.get("METRICAS_LOG", "json") # "json": una línea por callback; "no": solo /metrics
+METRICAS_UMBRAL_LENTO_MS = float(os.environ.get("METRICAS_UMBRAL_LENTO_MS", 1000)) # Callbacks marcados como lentos en el log
+# Límites de los buckets de los histogramas de duración (segundos)
+LIMITES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_RUTA_CALLBACKS = '_dash-update-component'
+_PAGINA = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_lock = threading.Lock()
+_tramos = {} # nombre -> {'cubetas', 'suma', 'cuenta', 'filas', 'bytes', 'rss_delta_max'}
+_callbacks = {} # nombre -> {'cubetas', 'suma', 'cuenta', 'bytes', 'lentos'}
+_engines = [] # Engines cuyos pools se exponen (ver registrar_rutas)
+_PREFIJO_FICHERO = 'metricas_'
+_lock_fichero = threading.Lock() # Un solo volcado a la vez por proceso (el hilo y el de salida)
+_volcado = {'pid': None, 'cambios': 0, 'volcados': 0} # pid con hilo de volcado y contadores de cambios
+
+
+def rss_bytes():
+    """RSS actual del proceso (None fuera de Linux, donde no hay /proc)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGINA
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _nuevo_histograma(**extra):
+    return dict({'cubetas': [0] * len(LIMITES_SEGUNDOS), 'suma': 0.0, 'cuenta': 0}, **extra)
+
+
+def _observar(histograma, segundos):
+    histograma['suma'] += segundos
+    histograma['cuenta'] += 1
+    for i, limite in enumerate(LIMITES_SEGUNDOS):
+        if segundos <= limite:
+            histograma['cubetas'][i] += 1
+
+
+def _tramos_de_la_peticion():
+    """Lista de tramos de la petición Flask en curso (None fuera de una petición, p.ej. en el precálculo)."""
+    from flask import g, has_request_context
+    if not has_request_context():
+        return None
+    if 'tramos_p2p' not in g:
+        g.tramos_p2p = []
+    return g.tramos_p2p
+
+
+def registrar_tramo(nombre, segundos, filas=None, bytes_=None, rss_delta=None):
+    with _lock:
+        h = _tramos.get(nombre)
+        if h is None:
+            h = _tramos[nombre] = _nuevo_histograma(filas=0, bytes=0, rss_delta_max=0)
+        _observar(h, segundos)
+        h['filas'] += filas or 0
+        h['bytes'] += bytes_ or 0
+        if rss_delta is not None:
+            h['rss_delta_max'] = max(h['rss_delta_max'], rss_delta)
+        _volcado['cambios'] += 1
+    _asegurar_hilo_volcado()
+    tramos = _tramos_de_la_peticion()
+    if tramos is not None:
+        tramos.append({'tramo': nombre, 'ms': round(segundos * 1000, 1), 'filas': filas, 'bytes': bytes_,
+                       'rss_delta_kb': None if rss_delta is None else rss_delta // 1024})
+
+
+@contextmanager
+def tramo(nombre):
+    """
+    Mide el bloque como un tramo. Devuelve un dict en el que el bloque puede anotar 'filas' y 'bytes':
+        with metricas.tramo('sql_ohlc') as t:
+            df = pd.read_sql(...)
+            t['filas'] = len(df)
+    """
+    datos = {'filas': None, 'bytes': None}
+    rss_inicio = rss_bytes()
+    inicio = time.perf_counter()
+    try:
+        yield datos
+    finally:
+        segundos = time.perf_counter() - inicio
+        rss_fin = rss_bytes()
+        rss_delta = rss_fin - rss_inicio if rss_inicio is not None and rss_fin is not None else None
+        registrar_tramo(nombre, segundos, datos['filas'], datos['bytes'], rss_delta)
+
+
+def instrumentar(funcion):
+    """
+    Decorador para callbacks de Dash (debajo de @app.callback): mide el callback como un tramo y
+    deja su nombre en la petición para la línea de log y las métricas por callback.
+    """
+    @functools.wraps(funcion)
+    def envoltorio(*args, **kwargs):
+        from flask import g, has_request_context
+        if has_request_context():
+            g.callback_p2p = funcion.__name__
+        inicio = time.perf_counter()
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            if has_request_context():
+                g.callback_segundos_p2p = time.perf_counter() - inicio
+    return envoltorio
+
+
+def _antes_de_peticion():
+    from flask import g
+    g.inicio_p2p = time.perf_counter()
+    g.rss_inicio_p2p = rss_bytes()
+
+
+def _despues_de_peticion(respuesta):
+    from flask import g, request
+    nombre = g.get('callback_p2p')
+    if nombre is None or not request.path.endswith(_RUTA_CALLBACKS):
+        return respuesta
+    total = time.perf_counter() - g.inicio_p2p
+    bytes_respuesta = respuesta.content_length or 0
+    # Resto de la petición fuera del callback: sobre todo la serialización JSON de las figuras
+    registrar_tramo('serializacion', max(total - g.get('callback_segundos_p2p', total), 0.0), bytes_=bytes_respuesta)
+    lento = total * 1000 >= METRICAS_UMBRAL_LENTO_MS
+    with _lock:
+        h = _callbacks.get(nombre)
+        if h is None:
+            h = _callbacks[nombre] = _nuevo_histograma(bytes=0, lentos=0)
+        _observar(h, total)
+        h['bytes'] += bytes_respuesta
+        h['lentos'] += int(lento)
+        _volcado['cambios'] += 1
+
+    # PreventUpdate (204) no hizo nada: no se registra en el log para no llenarlo con los sondeos
+    if METRICAS_LOG == 'json' and respuesta.status_code != 204:
+        tramos = g.get('tramos_p2p', [])
+        rss_fin = rss_bytes()
+        registro = {
+            'ts': datetime.datetime.now().isoformat(), 'evento': 'callback', 'callback': nombre,
+            'estado': respuesta.status_code, 'duracion_ms': round(total * 1000, 1), 'bytes_respuesta': bytes_respuesta,
+            'rss_mb': None if rss_fin is None else round(rss_fin / 2**20, 1),
+            'rss_delta_kb': None if rss_fin is None or g.rss_inicio_p2p is None else (rss_fin - g.rss_inicio_p2p) // 1024,
+            'lento': lento,
+            'tramo_mas_lento': max(tramos, key=lambda t: t['ms'])['tramo'] if tramos else None,
+            'tramos': tramos,
+        }
+        print(json.dumps(registro, ensure_ascii=False), flush=True)
+    return respuesta
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(**etiquetas):
+    return '{' + ','.join(f'{k}="{_escapar(v)}"' for k, v in etiquetas.items()) + '}'
+
+
+def _lineas_histograma(metrica, etiquetas, h):
+    lineas = []
+    for limite, acumulado in zip(LIMITES_SEGUNDOS, h['cubetas']):
+        lineas.append(f"{metrica}_bucket{_etiquetas(**etiquetas, le=limite)} {acumulado}")
+    lineas.append(f"{metrica}_bucket{_etiquetas(**etiquetas, le='+Inf')} {h['cuenta']}")
+    lineas.append(f"{metrica}_sum{_etiquetas(**etiquetas)} {h['suma']:.6f}")
+    lineas.append(f"{metrica}_count{_etiquetas(**etiquetas)} {h['cuenta']}")
+    return lineas
+
+
+def _instantanea():
+    """Contadores de este proceso (lo que se vuelca a METRICAS_DIR)."""
+    with _lock:
+        tramos = {n: dict(h, cubetas=list(h['cubetas'])) for n, h in _tramos.items()}
+        callbacks = {n: dict(h, cubetas=list(h['cubetas'])) for n, h in _callbacks.items()}
+    return {'pid': os.getpid(), 'tramos': tramos, 'callbacks': callbacks, 'rss': rss_bytes(),
+            'pools': [conexion_db.metricas_pool(engine) for engine in _engines]}
+
+
+def volcar():
+    """Escribe los contadores del proceso en su fichero de METRICAS_DIR (temporal + rename: nadie lee uno a medias)."""
+    if not METRICAS_DIR:
+        return
+    ruta = os.path.join(METRICAS_DIR, f"{_PREFIJO_FICHERO}{os.getpid()}.json")
+    with _lock_fichero:
+        try:
+            os.makedirs(METRICAS_DIR, exist_ok=True)
+            with open(f"{ruta}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(_instantanea(), f)
+            os.replace(f"{ruta}.tmp", ruta)
+        except OSError as e:
+            print(f"[{datetime.datetime.now()}] Advertencia: no se pudieron volcar las métricas en {METRICAS_DIR}: {e}")
+
+
+def _volcar_si_hay_cambios():
+    cambios = _volcado['cambios']
+    if _volcado['pid'] == os.getpid() and cambios != _volcado['volcados']:
+        volcar()
+        _volcado['volcados'] = cambios
+
+
+def _bucle_volcado():
+    while True:
+        time.sleep(METRICAS_VOLCADO_SEGUNDOS)
+        _volcar_si_hay_cambios()
+
+
+def _asegurar_hilo_volcado():
+    """Arranca el hilo de volcado del proceso (tras un fork de gunicorn el hilo del padre no existe)."""
+    if not METRICAS_DIR or _volcado['pid'] == os.getpid():
+        return
+    with _lock:
+        if _volcado['pid'] == os.getpid():
+            return
+        _volcado['pid'], _volcado['volcados'] = os.getpid(), -1
+    threading.Thread(target=_bucle_volcado, name='metricas-volcado', daemon=True).start()
+
+
+atexit.register(_volcar_si_hay_cambios) # Lo último que el hilo aún no volcó
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _instantaneas():
+    """Las del proceso actual (al día) y las volcadas por los demás procesos."""
+    propia = _instantanea()
+    instantaneas = [propia]
+    if not METRICAS_DIR or not os.path.isdir(METRICAS_DIR):
+        return instantaneas
+    for fichero in os.listdir(METRICAS_DIR):
+        if not (fichero.startswith(_PREFIJO_FICHERO) and fichero.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(METRICAS_DIR, fichero), encoding='utf-8') as f:
+                instantanea = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if instantanea.get('pid') != propia['pid']:
+            instantanea['vivo'] = _proceso_vivo(instantanea['pid'])
+            instantaneas.append(instantanea)
+    propia['vivo'] = True
+    return instantaneas
+
+
+def _sumar(histogramas):
+    """Suma los histogramas de un mismo nombre de varios procesos (rss_delta_max se toma como máximo)."""
+    total = None
+    for h in histogramas:
+        if total is None:
+            total = dict(h, cubetas=list(h['cubetas']))
+            continue
+        total['cubetas'] = [a + b for a, b in zip(total['cubetas'], h['cubetas'])]
+        for clave, valor in h.items():
+            if clave == 'rss_delta_max':
+                total[clave] = max(total[clave], valor)
+            elif clave != 'cubetas':
+                total[clave] += valor
+    return total
+
+
+def _agregar(instantaneas, clave):
+    nombres = sorted({n for i in instantaneas for n in i[clave]})
+    return {n: _sumar(i[clave][n] for i in instantaneas if n in i[clave]) for n in nombres}
+
+
+def exponer_prometheus():
+    """
+    Métricas en el formato de texto de Prometheus. Histogramas y contadores suman todos los
+    procesos (también los ya terminados: un contador no retrocede al reiniciarse un worker); los
+    gauges de memoria y pools solo se dan de los procesos vivos, con la etiqueta pid.
+    """
+    instantaneas = _instantaneas()
+    tramos = _agregar(instantaneas, 'tramos')
+    callbacks = _agregar(instantaneas, 'callbacks')
+
+    lineas = ["# HELP p2p_tramo_duracion_segundos Duración de cada etapa instrumentada.",
+              "# TYPE p2p_tramo_duracion_segundos histogram"]
+    for nombre, h in tramos.items():
+        lineas += _lineas_histograma('p2p_tramo_duracion_segundos', {'tramo': nombre}, h)
+    for metrica, clave, tipo, ayuda in (
+            ('p2p_tramo_filas_total', 'filas', 'counter', 'Filas procesadas por la etapa.'),
+            ('p2p_tramo_bytes_total', 'bytes', 'counter', 'Bytes producidos por la etapa (frames, caché o respuesta).'),
+            ('p2p_tramo_rss_delta_max_bytes', 'rss_delta_max', 'gauge', 'Mayor crecimiento del RSS durante una ejecución de la etapa.')):
+        lineas += [f"# HELP {metrica} {ayuda}", f"# TYPE {metrica} {tipo}"]
+        lineas += [f"{metrica}{_etiquetas(tramo=n)} {h[clave]}" for n, h in tramos.items()]
+
+    lineas += ["# HELP p2p_callback_duracion_segundos Duración de la petición de cada callback de Dash.",
+               "# TYPE p2p_callback_duracion_segundos histogram"]
+    for nombre, h in callbacks.items():
+        lineas += _lineas_histograma('p2p_callback_duracion_segundos', {'callback': nombre}, h)
+    for metrica, clave, ayuda in (
+            ('p2p_callback_respuesta_bytes_total', 'bytes', 'Bytes de las respuestas del callback.'),
+            ('p2p_callback_lentos_total', 'lentos', 'Peticiones por encima de METRICAS_UMBRAL_LENTO_MS.')):
+        lineas += [f"# HELP {metrica} {ayuda}", f"# TYPE {metrica} counter"]
+        lineas += [f"{metrica}{_etiquetas(callback=n)} {h[clave]}" for n, h in callbacks.items()]
+
+    vivos = [i for i in instantaneas if i['vivo']]
+    lineas += ["# HELP p2p_procesos_metricas Procesos vivos cuyas métricas se suman.", "# TYPE p2p_procesos_metricas gauge",
+               f"p2p_procesos_metricas {len(vivos)}"]
+    rss = [f"process_resident_memory_bytes{_etiquetas(pid=i['pid'])} {i['rss']}" for i in vivos if i['rss'] is not None]
+    if rss:
+        lineas += ["# HELP process_resident_memory_bytes RSS del proceso.", "# TYPE process_resident_memory_bytes gauge"] + rss
+
+    for clave, tipo in (('checkouts', 'counter'), ('conexiones_nuevas', 'counter'), ('invalidadas', 'counter'),
+                        ('esperas', 'counter'), ('en_uso', 'gauge'), ('maximo', 'gauge')):
+        if tipo == 'counter':
+            metrica = f"p2p_pool_{clave}_total"
+            sumas = {}
+            for i in instantaneas:
+                for m in i['pools']:
+                    sumas[m['nombre']] = sumas.get(m['nombre'], 0) + m[clave]
+            valores = [f"{metrica}{_etiquetas(pool=n)} {v}" for n, v in sorted(sumas.items())]
+        else:
+            metrica = f"p2p_pool_{clave}"
+            valores = [f"{metrica}{_etiquetas(pool=m['nombre'], pid=i['pid'])} {m[clave]}"
+                       for i in vivos for m in i['pools'] if clave in m]
+        if valores:
+            lineas += [f"# TYPE {metrica} {tipo}"] + valores
+    return '\n'.join(lineas) + '\n'
+
+
+def registrar_rutas(server, engines=(), ruta='/metrics'):
+    """Mide las peticiones de callbacks del servidor Flask de una app Dash y añade la ruta de Prometheus."""
+    from flask import Response
+
+    _engines.extend(engines)
+    server.before_request(_antes_de_peticion)
+    server.after_request(_despues_de_peticion)
+
+    def metrics():
+        return Response(exponer_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    server.add_url_rule(ruta, 'metricas_prometheus', metrics)
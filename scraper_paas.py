@@ -1,12 +1,25 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from sqlalchemy import create_engine, text, inspect, Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import text, inspect, select, Column, Integer, String, Float, DateTime, Text, UniqueConstraint
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert as pg_insert
 # Corrección de importación para SQLAlchemy 2.0
 from sqlalchemy.orm import sessionmaker, declarative_base 
 import time
 import datetime
 import os
 import sys
+import csv
+import hashlib
+import io
+import json
+import random
+import re
+import signal
+import threading
+from contextlib import contextmanager
+import conexion_db # Engine compartido: pool, pre-ping y métricas
 
 # --- CONFIGURACIÓN DE BASE DE DATOS ---
 DATABASE_URL = os.environ.get("DATABASE_URL")
@@ -14,12 +27,8 @@ if not DATABASE_URL:
     print(f"[{datetime.datetime.now()}] ERROR FATAL: No se encontró la variable de entorno DATABASE_URL.")
     sys.exit(1)
 
-# Forzar prefijo 'postgresql://'
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-
 try:
-    ENGINE = create_engine(DATABASE_URL)
+    ENGINE = conexion_db.crear_engine(DATABASE_URL, 'scraper')
 except Exception as e:
     print(f"[{datetime.datetime.now()}] ERROR FATAL: No se pudo crear engine de SQLAlchemy: {e}")
     sys.exit(1)
@@ -27,13 +36,98 @@ except Exception as e:
 # Ajuste para SQLAlchemy 2.0
 Base = declarative_base()
 TABLE_NAME = 'p2p_anuncios'
+TABLE_VELAS = 'p2p_velas'
+TABLE_METODOS = 'p2p_metodos_pago'
+TABLE_PRESENCIA = 'p2p_presencia'
+TABLE_METRICAS = 'p2p_metricas_ciclo'
+
+# --- MODO DE INSERCIÓN DE ANUNCIOS ---
+# 'copy': un único COPY FROM STDIN por ciclo (sin unit-of-work ni ida y vuelta por fila).
+# 'orm': session.add_all + commit (modo original; también es el respaldo si COPY falla).
+MODO_INSERCION = os.environ.get("SCRAPER_MODO_INSERCION", "copy")
+COLUMNAS_COPY = ['id', 'Timestamp', 'Tipo', 'Precio', 'Volumen', 'Volumen_min', 'Volumen_max', 'Metodos_Pago', 'Exchange_Name', 'Metodos_Ids', 'Asset', 'Fiat', 'Adv_No', 'Huella']
+
+# --- MERCADOS A RECOLECTAR ---
+# Lista "ASSET/FIAT" separada por comas; cada mercado se pide en ambos lados (Demanda y Oferta).
+# Todas las peticiones del ciclo salen en paralelo por un único pool de conexiones keep-alive.
+RE_MERCADO = re.compile(r'^([A-Z0-9]{2,10})/([A-Z0-9]{2,10})$')
+P2P_MERCADOS = []
+for _mercado in os.environ.get("P2P_MERCADOS", "USDT/VES").split(','):
+    if not _mercado.strip():
+        continue
+    _coincidencia = RE_MERCADO.match(_mercado.strip().upper())
+    if not _coincidencia:
+        print(f"[{datetime.datetime.now()}] ERROR FATAL: P2P_MERCADOS contiene '{_mercado.strip()}'; cada mercado debe tener la forma ASSET/FIAT (p.ej. USDT/VES).")
+        sys.exit(1)
+    P2P_MERCADOS.append(_coincidencia.groups())
+if not P2P_MERCADOS:
+    print(f"[{datetime.datetime.now()}] ERROR FATAL: P2P_MERCADOS no contiene ningún mercado ASSET/FIAT.")
+    sys.exit(1)
+# Peticiones simultáneas como máximo contra el host de Binance (evita throttling)
+SCRAPER_CONCURRENCIA_POR_HOST = int(os.environ.get("SCRAPER_CONCURRENCIA_POR_HOST", 4))
+
+# --- REINTENTOS Y RITMO DE PETICIONES A BINANCE ---
+# Cada página se reintenta ante timeouts, errores de conexión, 429 y 5xx con backoff exponencial y
+# jitter completo (espera aleatoria entre 0 y base·2^intento, con tope). Un token bucket compartido
+# por todos los hilos limita las peticiones por segundo: un 429 reduce la tasa a la mitad y cada
+# respuesta correcta la devuelve poco a poco a la configurada.
+SCRAPER_TIMEOUT_SEGUNDOS = float(os.environ.get("SCRAPER_TIMEOUT_SEGUNDOS", 10))
+SCRAPER_REINTENTOS = int(os.environ.get("SCRAPER_REINTENTOS", 3)) # Reintentos por página, además del primer intento
+SCRAPER_BACKOFF_BASE = float(os.environ.get("SCRAPER_BACKOFF_BASE", 0.5))
+SCRAPER_BACKOFF_MAXIMO = float(os.environ.get("SCRAPER_BACKOFF_MAXIMO", 8))
+SCRAPER_PETICIONES_POR_SEGUNDO = float(os.environ.get("SCRAPER_PETICIONES_POR_SEGUNDO", 10)) # 0 = sin límite
+SCRAPER_RAFAGA = int(os.environ.get("SCRAPER_RAFAGA", SCRAPER_CONCURRENCIA_POR_HOST)) # Peticiones seguidas sin esperar
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+# --- PAGINACIÓN DEL LIBRO DE ANUNCIOS ---
+FILAS_POR_PAGINA = 20 # 20 es el máximo de la API "friendly"
+# Profundidad máxima por lado y mercado (en páginas) y corte opcional por volumen acumulado (0 = sin corte)
+SCRAPER_MAX_PAGINAS = int(os.environ.get("SCRAPER_MAX_PAGINAS", 50))
+SCRAPER_VOLUMEN_MAXIMO = float(os.environ.get("SCRAPER_VOLUMEN_MAXIMO", 0))
+
+# --- MODO DE EJECUCIÓN ---
+# 'cron': un ciclo y salir (Render lo lanza cada 2 minutos).
+# 'daemon': proceso persistente que reutiliza engine, sesión HTTP y diccionarios entre ciclos.
+SCRAPER_MODO = os.environ.get("SCRAPER_MODO", "cron")
+SCRAPER_INTERVALO_SEGUNDOS = float(os.environ.get("SCRAPER_INTERVALO_SEGUNDOS", 120))
+SCRAPER_JITTER_SEGUNDOS = float(os.environ.get("SCRAPER_JITTER_SEGUNDOS", 3))
+
+# --- INTERVALOS DE LAS VELAS PRE-AGREGADAS ---
+# Las claves coinciden con los valores del selector de intervalo del dashboard (app.py).
+# Todos dividen un día exacto, así que los buckets coinciden con los de pandas.resample().
+INTERVALOS_VELAS = {
+    '15t': 15 * 60,
+    '1h': 60 * 60,
+    '4h': 4 * 60 * 60,
+    '1d': 24 * 60 * 60,
+}
+
+# --- PARTICIONADO Y RETENCIÓN DE p2p_anuncios ---
+# La tabla está particionada por día (RANGE sobre "Timestamp"): las consultas por fecha solo leen
+# las particiones del rango y la retención borra días enteros con DROP TABLE, sin DELETE ni VACUUM.
+SCRAPER_DIAS_ADELANTO = int(os.environ.get("SCRAPER_DIAS_ADELANTO", 3)) # Particiones creadas por adelantado
+SCRAPER_DIAS_RETENCION = int(os.environ.get("SCRAPER_DIAS_RETENCION", 30)) # 0 = conservar todo el histórico
+# Un anuncio sin cambios se reescribe cuando su versión guardada supera esta edad. Así la presencia de
+# un día solo referencia anuncios de ese día o del anterior, y los días viejos se pueden borrar.
+EDAD_MAXIMA_VERSION = datetime.timedelta(hours=24)
+TABLE_HISTORICO = f'{TABLE_NAME}_historico' # Tabla previa al particionado, adjuntada como partición
+
+# Cada ciclo confirmado se anuncia con NOTIFY en este canal; el dashboard lo escucha (LISTEN)
+# y recarga en segundos en lugar de esperar a su refresco periódico.
+CANAL_CICLOS = os.environ.get("P2P_CANAL_CICLOS", "p2p_ciclos")
+
+# Índice de las columnas de tiempo: "btree" o "brin". Las filas se insertan en orden de Timestamp,
+# así que un BRIN ocupa unos KB frente a los MB del B-tree y apenas encarece cada inserción.
+SCRAPER_INDICE_TIEMPO = os.environ.get("SCRAPER_INDICE_TIEMPO", "btree")
 
 # --- DEFINICIÓN DEL MODELO DE LA TABLA ---
 # (Este modelo no cambia, es compatible con ambos scrapers)
 class Anuncio(Base):
     __tablename__ = TABLE_NAME
-    id = Column(Integer, primary_key=True)
-    Timestamp = Column(DateTime, nullable=False, index=True)
+    # La clave de partición debe formar parte de la PK
+    __table_args__ = {'postgresql_partition_by': 'RANGE ("Timestamp")'}
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    Timestamp = Column(DateTime, primary_key=True) # Índices de tiempo en crear_indices
     Tipo = Column(String(10), nullable=False)
     Precio = Column(Float, nullable=False)
     Volumen = Column(Float, nullable=False)
@@ -41,35 +135,586 @@ class Anuncio(Base):
     Volumen_max = Column(Float)
     Metodos_Pago = Column(Text)
     Exchange_Name = Column(String(50))
+    # Métodos de pago codificados con el diccionario p2p_metodos_pago (ver MetodoPago).
+    # El dashboard agrupa por estos enteros en lugar de partir el texto de Metodos_Pago.
+    Metodos_Ids = Column(ARRAY(Integer))
+    # Mercado del anuncio. El DEFAULT hace que las filas anteriores a la columna queden como USDT/VES.
+    Asset = Column(String(10), nullable=False, server_default='USDT')
+    Fiat = Column(String(10), nullable=False, server_default='VES')
+    # Identidad y huella del anuncio: si en el ciclo siguiente siguen iguales no se vuelve a insertar
+    Adv_No = Column(String(32)) # adv.advNo de Binance
+    Huella = Column(String(16)) # hash de precio, volumen, límites y métodos
+
+# --- PRESENCIA DE ANUNCIOS POR CICLO ---
+# Una fila por (ciclo, mercado, lado) con los ids de p2p_anuncios que formaban esa foto del libro.
+# Los anuncios sin cambios no se reinsertan: solo se referencia su última versión desde aquí.
+class Presencia(Base):
+    __tablename__ = TABLE_PRESENCIA
+    id = Column(Integer, primary_key=True)
+    Timestamp = Column(DateTime, nullable=False, index=True)
+    Tipo = Column(String(10), nullable=False)
+    Exchange_Name = Column(String(50))
+    Asset = Column(String(10), nullable=False)
+    Fiat = Column(String(10), nullable=False)
+    Anuncio_Ids = Column(ARRAY(Integer), nullable=False) # En el orden en que llegaron del libro
+
+# --- TELEMETRÍA DE CADA CICLO ---
+# Una fila por ciclo: tiempos por etapa, y por mercado/lado las páginas, latencias, reintentos y errores.
+# Un lado sin anuncios con errores en la fila es un hueco en los datos, no un libro vacío.
+class MetricaCiclo(Base):
+    __tablename__ = TABLE_METRICAS
+    id = Column(Integer, primary_key=True)
+    Timestamp = Column(DateTime, nullable=False, index=True) # Inicio del ciclo
+    Duracion_s = Column(Float)
+    Anuncios = Column(Integer)
+    Nuevos = Column(Integer)
+    Peticiones = Column(Integer)
+    Reintentos = Column(Integer)
+    Etapas = Column(JSONB) # etapa -> segundos (descarga, parseo, codificacion, deduplicacion, insercion, velas, aviso)
+    Lados = Column(JSONB) # "USDT/VES Demanda" -> páginas, anuncios, latencias (ms), reintentos y errores
+    Errores = Column(JSONB) # clase de error -> ocurrencias
+
+def calcular_huella(precio, volumen, volumen_min, volumen_max, metodos_pago_str):
+    """Hash corto de los campos que, si cambian, obligan a guardar una nueva versión del anuncio."""
+    contenido = f"{precio!r}|{volumen!r}|{volumen_min!r}|{volumen_max!r}|{metodos_pago_str}"
+    return hashlib.blake2b(contenido.encode(), digest_size=8).hexdigest()
+
+# --- FOTOS COMPLETAS DEL LIBRO ---
+# Reconstruye una fila por anuncio presente en cada ciclo (Timestamp del ciclo, datos de su versión).
+# 'Orden' es la posición en el libro, para que Open/Close salgan igual que en el upsert del ciclo.
+SQL_FOTOS = f'''
+    SELECT a.id, p."Timestamp", p."Tipo", a."Precio", a."Volumen",
+           COALESCE(p."Exchange_Name", '') AS "Exchange_Name", p."Asset", p."Fiat", u.orden AS "Orden"
+    FROM {TABLE_PRESENCIA} AS p
+    CROSS JOIN LATERAL UNNEST(p."Anuncio_Ids") WITH ORDINALITY AS u(anuncio_id, orden)
+    JOIN {TABLE_NAME} AS a ON a.id = u.anuncio_id
+'''
+
+# --- DICCIONARIO DE MÉTODOS DE PAGO ---
+# Un id entero por nombre de método ('Banesco', 'PagoMovil', ...). Solo crece.
+class MetodoPago(Base):
+    __tablename__ = TABLE_METODOS
+    id = Column(Integer, primary_key=True)
+    Nombre = Column(String(100), nullable=False, unique=True)
+
+def separar_metodos(metodos_pago_str):
+    """Lista de métodos a partir del texto 'A, B, C' guardado en Metodos_Pago."""
+    return [m.strip() for m in (metodos_pago_str or '').split(',') if m.strip()]
+
+# --- MODELO DE LAS VELAS (OHLCV) PRE-AGREGADAS ---
+# El scraper las actualiza en cada ciclo; el dashboard las lee en lugar de re-muestrear el crudo.
+class Vela(Base):
+    __tablename__ = TABLE_VELAS
+    id = Column(Integer, primary_key=True)
+    Intervalo = Column(String(5), nullable=False)
+    Bucket = Column(DateTime, nullable=False)
+    Tipo = Column(String(10), nullable=False)
+    Exchange_Name = Column(String(50), nullable=False)
+    Asset = Column(String(10), nullable=False, server_default='USDT')
+    Fiat = Column(String(10), nullable=False, server_default='VES')
+    Open = Column(Float, nullable=False)
+    High = Column(Float, nullable=False)
+    Low = Column(Float, nullable=False)
+    Close = Column(Float, nullable=False)
+    Volume = Column(Float, nullable=False)
+    Num_Anuncios = Column(Integer, nullable=False)
+    # Primer y último Timestamp del bucket: deciden Open/Close si llegan ciclos desordenados
+    Primer_Timestamp = Column(DateTime, nullable=False)
+    Ultimo_Timestamp = Column(DateTime, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('Intervalo', 'Exchange_Name', 'Asset', 'Fiat', 'Tipo', 'Bucket', name='uq_velas_mercado_bucket'),
+    )
+
+# --- UPSERT DE VELAS ---
+# Combina un bucket nuevo con el existente: High/Low por extremos, Volume acumulado,
+# Open/Close según cuál de los dos trae el Timestamp más antiguo/reciente.
+SQL_UPSERT_VELA = text(f'''
+    INSERT INTO {TABLE_VELAS} ("Intervalo", "Bucket", "Tipo", "Exchange_Name", "Asset", "Fiat", "Open", "High", "Low", "Close",
+                               "Volume", "Num_Anuncios", "Primer_Timestamp", "Ultimo_Timestamp")
+    VALUES (:intervalo, :bucket, :tipo, :exchange, :asset, :fiat, :open, :high, :low, :close,
+            :volume, :num_anuncios, :primer_ts, :ultimo_ts)
+    ON CONFLICT ("Intervalo", "Exchange_Name", "Asset", "Fiat", "Tipo", "Bucket") DO UPDATE SET
+        "Open" = CASE WHEN EXCLUDED."Primer_Timestamp" < {TABLE_VELAS}."Primer_Timestamp"
+                      THEN EXCLUDED."Open" ELSE {TABLE_VELAS}."Open" END,
+        "High" = GREATEST({TABLE_VELAS}."High", EXCLUDED."High"),
+        "Low" = LEAST({TABLE_VELAS}."Low", EXCLUDED."Low"),
+        "Close" = CASE WHEN EXCLUDED."Ultimo_Timestamp" >= {TABLE_VELAS}."Ultimo_Timestamp"
+                       THEN EXCLUDED."Close" ELSE {TABLE_VELAS}."Close" END,
+        "Volume" = {TABLE_VELAS}."Volume" + EXCLUDED."Volume",
+        "Num_Anuncios" = {TABLE_VELAS}."Num_Anuncios" + EXCLUDED."Num_Anuncios",
+        "Primer_Timestamp" = LEAST({TABLE_VELAS}."Primer_Timestamp", EXCLUDED."Primer_Timestamp"),
+        "Ultimo_Timestamp" = GREATEST({TABLE_VELAS}."Ultimo_Timestamp", EXCLUDED."Ultimo_Timestamp")
+''')
+
+def _inicio_bucket(timestamp, segundos):
+    """Trunca un Timestamp al inicio de su bucket (alineado a medianoche, como pandas)."""
+    epoch = datetime.datetime(1970, 1, 1)
+    transcurrido = int((timestamp - epoch).total_seconds())
+    return epoch + datetime.timedelta(seconds=transcurrido - transcurrido % segundos)
+
+def agregar_velas(anuncios):
+    """Agrupa los anuncios de un ciclo en velas OHLCV por intervalo, mercado, Tipo y Exchange."""
+    velas = {}
+    for anuncio in anuncios:
+        exchange = anuncio.Exchange_Name or ''
+        for intervalo, segundos in INTERVALOS_VELAS.items():
+            bucket = _inicio_bucket(anuncio.Timestamp, segundos)
+            clave = (intervalo, bucket, anuncio.Tipo, exchange, anuncio.Asset, anuncio.Fiat)
+            vela = velas.get(clave)
+            if vela is None:
+                velas[clave] = {
+                    'intervalo': intervalo, 'bucket': bucket, 'tipo': anuncio.Tipo, 'exchange': exchange,
+                    'asset': anuncio.Asset, 'fiat': anuncio.Fiat,
+                    'open': anuncio.Precio, 'high': anuncio.Precio, 'low': anuncio.Precio, 'close': anuncio.Precio,
+                    'volume': anuncio.Volumen, 'num_anuncios': 1,
+                    'primer_ts': anuncio.Timestamp, 'ultimo_ts': anuncio.Timestamp,
+                }
+                continue
+            vela['high'] = max(vela['high'], anuncio.Precio)
+            vela['low'] = min(vela['low'], anuncio.Precio)
+            if anuncio.Timestamp < vela['primer_ts']:
+                vela['open'] = anuncio.Precio
+                vela['primer_ts'] = anuncio.Timestamp
+            if anuncio.Timestamp >= vela['ultimo_ts']:
+                vela['close'] = anuncio.Precio
+                vela['ultimo_ts'] = anuncio.Timestamp
+            vela['volume'] += anuncio.Volumen
+            vela['num_anuncios'] += 1
+    return list(velas.values())
+
+def reconstruir_velas(connection, desde=None, hasta=None):
+    """
+    Recalcula las velas desde las fotos del libro con SQL (backfill inicial o reparación de un rango).
+    Con 'hasta' solo se leen las fotos anteriores a ese instante (debe caer en inicio de día).
+    """
+    condiciones = []
+    if desde is not None:
+        # Sobre a."Timestamp" también, para que PostgreSQL descarte las particiones fuera del rango
+        condiciones += ['p."Timestamp" >= :desde', 'a."Timestamp" >= :desde_versiones']
+    if hasta is not None:
+        condiciones += ['p."Timestamp" < :hasta', 'a."Timestamp" < :hasta']
+    filtro = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    for intervalo, segundos in INTERVALOS_VELAS.items():
+        sql_command = text(f'''
+            INSERT INTO {TABLE_VELAS} ("Intervalo", "Bucket", "Tipo", "Exchange_Name", "Asset", "Fiat", "Open", "High", "Low", "Close",
+                                       "Volume", "Num_Anuncios", "Primer_Timestamp", "Ultimo_Timestamp")
+            SELECT :intervalo, "Bucket", "Tipo", "Exchange_Name", "Asset", "Fiat",
+                   (array_agg("Precio" ORDER BY "Timestamp", "Orden"))[1],
+                   MAX("Precio"), MIN("Precio"),
+                   (array_agg("Precio" ORDER BY "Timestamp" DESC, "Orden" DESC))[1],
+                   SUM("Volumen"), COUNT(*), MIN("Timestamp"), MAX("Timestamp")
+            FROM (
+                SELECT fotos.*,
+                       TIMESTAMP 'epoch' + FLOOR(EXTRACT(EPOCH FROM "Timestamp") / :segundos) * :segundos * INTERVAL '1 second' AS "Bucket"
+                FROM ({SQL_FOTOS} {filtro}) AS fotos
+            ) AS crudo
+            GROUP BY "Bucket", "Tipo", "Exchange_Name", "Asset", "Fiat"
+            ON CONFLICT ("Intervalo", "Exchange_Name", "Asset", "Fiat", "Tipo", "Bucket") DO UPDATE SET
+                "Open" = EXCLUDED."Open", "High" = EXCLUDED."High", "Low" = EXCLUDED."Low",
+                "Close" = EXCLUDED."Close", "Volume" = EXCLUDED."Volume",
+                "Num_Anuncios" = EXCLUDED."Num_Anuncios",
+                "Primer_Timestamp" = EXCLUDED."Primer_Timestamp",
+                "Ultimo_Timestamp" = EXCLUDED."Ultimo_Timestamp"
+        ''')
+        params = {'intervalo': intervalo, 'segundos': segundos}
+        if desde is not None:
+            params['desde'] = _inicio_bucket(desde, segundos)
+            params['desde_versiones'] = params['desde'] - EDAD_MAXIMA_VERSION
+        if hasta is not None:
+            params['hasta'] = hasta
+        connection.execute(sql_command, params)
+
+def migrar_presencia(connection):
+    """Crea la presencia de las filas históricas (cuando cada ciclo guardaba el libro completo)."""
+    connection.execute(text(f'''
+        INSERT INTO {TABLE_PRESENCIA} ("Timestamp", "Tipo", "Exchange_Name", "Asset", "Fiat", "Anuncio_Ids")
+        SELECT "Timestamp", "Tipo", "Exchange_Name", "Asset", "Fiat", ARRAY_AGG(id ORDER BY id)
+        FROM {TABLE_NAME}
+        GROUP BY "Timestamp", "Tipo", "Exchange_Name", "Asset", "Fiat"
+    '''))
+
+def migrar_metodos_pago(connection):
+    """Rellena el diccionario y Metodos_Ids de las filas antiguas a partir del texto Metodos_Pago."""
+    connection.execute(text(f'''
+        INSERT INTO {TABLE_METODOS} ("Nombre")
+        SELECT DISTINCT BTRIM(metodo)
+        FROM {TABLE_NAME}, REGEXP_SPLIT_TO_TABLE("Metodos_Pago", ',') AS metodo
+        WHERE BTRIM(metodo) <> ''
+        ON CONFLICT ("Nombre") DO NOTHING
+    '''))
+    connection.execute(text(f'''
+        UPDATE {TABLE_NAME} AS a SET "Metodos_Ids" = COALESCE((
+            SELECT ARRAY_AGG(d.id ORDER BY d.id)
+            FROM REGEXP_SPLIT_TO_TABLE(a."Metodos_Pago", ',') AS metodo
+            JOIN {TABLE_METODOS} AS d ON d."Nombre" = BTRIM(metodo)
+        ), '{{}}')
+        WHERE a."Metodos_Ids" IS NULL
+    '''))
+
+# --- GESTIÓN DE PARTICIONES ---
+def _inicio_dia(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def listar_particiones(connection):
+    """Devuelve [(nombre, límite superior)] de las particiones de p2p_anuncios, de la más antigua a la más nueva."""
+    filas = connection.execute(text('''
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits AS i
+        JOIN pg_class AS c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:tabla AS regclass)
+    '''), {'tabla': TABLE_NAME}).all()
+    particiones = []
+    for nombre, limites in filas:
+        # "FOR VALUES FROM ('2025-01-01 00:00:00') TO ('2025-01-02 00:00:00')" (o FROM (MINVALUE))
+        hasta = re.search(r"TO \('([^']+)'\)", limites)
+        if hasta:
+            particiones.append((nombre, datetime.datetime.fromisoformat(hasta.group(1))))
+    return sorted(particiones, key=lambda p: p[1])
+
+def crear_particiones(connection, ahora=None, dias_adelanto=SCRAPER_DIAS_ADELANTO):
+    """Crea las particiones diarias que falten desde el último día cubierto hasta 'dias_adelanto' días después de hoy."""
+    hoy = _inicio_dia(ahora or datetime.datetime.now())
+    particiones = listar_particiones(connection)
+    # Sin particiones se empieza por ayer: un ciclo lanzado justo antes de medianoche sigue teniendo dónde escribir
+    dia = max(particiones[-1][1], hoy) if particiones else hoy - datetime.timedelta(days=1)
+    creadas = 0
+    while dia <= hoy + datetime.timedelta(days=dias_adelanto):
+        siguiente = dia + datetime.timedelta(days=1)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {TABLE_NAME}_{dia:%Y%m%d} PARTITION OF {TABLE_NAME} "
+            f"FOR VALUES FROM ('{dia:%Y-%m-%d}') TO ('{siguiente:%Y-%m-%d}')"
+        ))
+        dia = siguiente
+        creadas += 1
+    return creadas
+
+def aplicar_retencion(connection, dias_retencion, ahora=None):
+    """
+    Consolida en p2p_velas los días anteriores a la ventana de retención y borra su detalle:
+    la presencia con DELETE y los anuncios con DROP de sus particiones.
+    Devuelve el número de particiones eliminadas.
+    """
+    limite = _inicio_dia(ahora or datetime.datetime.now()) - datetime.timedelta(days=dias_retencion)
+    primera_foto = connection.execute(
+        text(f'SELECT MIN("Timestamp") FROM {TABLE_PRESENCIA} WHERE "Timestamp" < :limite'), {'limite': limite}
+    ).scalar()
+    if primera_foto is not None:
+        # Se recalculan las velas del rango completo antes de perder el detalle (los buckets no cruzan días)
+        desde = _inicio_dia(primera_foto)
+        connection.execute(text(f'DELETE FROM {TABLE_VELAS} WHERE "Bucket" >= :desde AND "Bucket" < :limite'),
+                           {'desde': desde, 'limite': limite})
+        reconstruir_velas(connection, desde=desde, hasta=limite)
+        connection.execute(text(f'DELETE FROM {TABLE_PRESENCIA} WHERE "Timestamp" < :limite'), {'limite': limite})
+    connection.execute(text(f'DELETE FROM {TABLE_METRICAS} WHERE "Timestamp" < :limite'), {'limite': limite})
+
+    # La presencia que queda puede referenciar versiones de hasta EDAD_MAXIMA_VERSION antes del límite
+    eliminadas = 0
+    for nombre, hasta in listar_particiones(connection):
+        if hasta <= limite - EDAD_MAXIMA_VERSION:
+            connection.execute(text(f'DROP TABLE IF EXISTS {nombre}'))
+            eliminadas += 1
+    return eliminadas
+
+def mantener_particiones(engine=None):
+    """Crea las particiones futuras y aplica la retención. Es idempotente: se puede llamar en cada arranque."""
+    try:
+        with (engine or ENGINE).begin() as connection:
+            creadas = crear_particiones(connection)
+            eliminadas = aplicar_retencion(connection, SCRAPER_DIAS_RETENCION) if SCRAPER_DIAS_RETENCION > 0 else 0
+        if creadas or eliminadas:
+            print(f"[{datetime.datetime.now()}] Particiones de '{TABLE_NAME}': {creadas} creadas, {eliminadas} eliminadas por retención.")
+    except Exception as e:
+        print(f"[{datetime.datetime.now()}] ERROR al mantener las particiones de '{TABLE_NAME}': {e}")
+
+def particionar_tabla_existente(connection):
+    """
+    Convierte la p2p_anuncios sin particionar en la primera partición (MINVALUE hasta mañana) de la
+    nueva tabla particionada. No copia filas: solo renombra, cambia la PK y adjunta.
+    """
+    secuencia = connection.execute(text("SELECT pg_get_serial_sequence(:tabla, 'id')"), {'tabla': TABLE_NAME}).scalar()
+    ultimo_id, ultimo_ts = connection.execute(text(f'SELECT MAX(id), MAX("Timestamp") FROM {TABLE_NAME}')).one()
+
+    connection.execute(text(f'ALTER TABLE {TABLE_NAME} RENAME TO {TABLE_HISTORICO}'))
+    # Sus índices de tiempo de una columna los reemplaza idx_anuncios_tiempo_id (ver crear_indices)
+    connection.execute(text('DROP INDEX IF EXISTS idx_timestamp'))
+    connection.execute(text(f'DROP INDEX IF EXISTS "ix_{TABLE_NAME}_Timestamp"'))
+    connection.execute(text(f'ALTER TABLE {TABLE_HISTORICO} ALTER COLUMN id DROP DEFAULT'))
+    if secuencia:
+        connection.execute(text(f'DROP SEQUENCE IF EXISTS {secuencia}'))
+    connection.execute(text(f'ALTER TABLE {TABLE_HISTORICO} DROP CONSTRAINT IF EXISTS {TABLE_NAME}_pkey'))
+    connection.execute(text(f'ALTER TABLE {TABLE_HISTORICO} ADD PRIMARY KEY (id, "Timestamp")'))
+
+    Anuncio.__table__.create(connection)
+    hasta = _inicio_dia(ultimo_ts or datetime.datetime.now()) + datetime.timedelta(days=1)
+    connection.execute(text(
+        f"ALTER TABLE {TABLE_NAME} ATTACH PARTITION {TABLE_HISTORICO} FOR VALUES FROM (MINVALUE) TO ('{hasta:%Y-%m-%d}')"
+    ))
+    # Los ids nuevos siguen a los históricos: la presencia los referencia por id
+    connection.execute(text(f"SELECT setval(pg_get_serial_sequence(:tabla, 'id'), :siguiente, false)"),
+                       {'tabla': TABLE_NAME, 'siguiente': (ultimo_id or 0) + 1})
 
 # --- FUNCIÓN PARA CREAR LA TABLA (si no existe) ---
+def crear_indices(connection):
+    """
+    Índices de las consultas del dashboard (ver SQL_OHLC en app.py) y del inspector. La foto une la presencia con
+    los anuncios por id: el índice cubriente de p2p_anuncios permite un index-only scan sin leer la tabla.
+    """
+    connection.execute(text(f'''CREATE INDEX IF NOT EXISTS idx_anuncios_fotos ON {TABLE_NAME}
+                                (id, "Timestamp") INCLUDE ("Precio", "Volumen", "Metodos_Ids")'''))
+    # Paginación por clave del inspector (db_inspector_render.py) y orden de las exportaciones
+    # (exportar.py): ORDER BY "Timestamp", id. Es el único B-tree de tiempo de p2p_anuncios: los
+    # filtros por rango de tiempo también lo usan, así que los de una sola columna sobran.
+    # Se mantiene en modo BRIN porque sin él cada página del inspector ordenaría la tabla entera;
+    # las claves crecen con el tiempo y cada inserción va al final del índice.
+    connection.execute(text(f'CREATE INDEX IF NOT EXISTS idx_anuncios_tiempo_id ON {TABLE_NAME} ("Timestamp", id)'))
+    for indice in ('idx_timestamp', f'ix_{TABLE_NAME}_Timestamp', # También los de la partición histórica
+                   'idx_timestamp_historico', f'ix_{TABLE_HISTORICO}_Timestamp'):
+        connection.execute(text(f'DROP INDEX IF EXISTS "{indice}"'))
+    # Al cambiar SCRAPER_INDICE_TIEMPO se crean los índices del modo elegido y se borran los del otro
+    if SCRAPER_INDICE_TIEMPO == 'brin':
+        for tabla in (TABLE_NAME, TABLE_PRESENCIA):
+            connection.execute(text(f'CREATE INDEX IF NOT EXISTS idx_{tabla}_timestamp_brin ON {tabla} USING BRIN ("Timestamp")'))
+        connection.execute(text(f'DROP INDEX IF EXISTS "ix_{TABLE_PRESENCIA}_Timestamp"'))
+    else:
+        for tabla in (TABLE_NAME, TABLE_PRESENCIA):
+            connection.execute(text(f'DROP INDEX IF EXISTS idx_{tabla}_timestamp_brin'))
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS "ix_{TABLE_PRESENCIA}_Timestamp" ON {TABLE_PRESENCIA} ("Timestamp")'))
+    # Ventana de tiempo de un mercado (los filtros de la consulta de fotos): no es un índice de
+    # tiempo puro, se mantiene en los dos modos
+    connection.execute(text(f'CREATE INDEX IF NOT EXISTS idx_presencia_mercado ON {TABLE_PRESENCIA} ("Asset", "Fiat", "Timestamp")'))
+    connection.commit()
+
 def inicializar_base_de_datos():
     try:
         with ENGINE.connect() as connection:
             inspector = inspect(ENGINE)
+            existian_velas = inspector.has_table(TABLE_VELAS)
+            existia_presencia = inspector.has_table(TABLE_PRESENCIA)
             if not inspector.has_table(TABLE_NAME):
                 print(f"[{datetime.datetime.now()}] Creando tabla '{TABLE_NAME}' por primera vez...")
                 Base.metadata.create_all(ENGINE)
                 print(f"[{datetime.datetime.now()}] Tabla '{TABLE_NAME}' creada con éxito.")
-                
-                print(f"[{datetime.datetime.now()}] Creando índice 'idx_timestamp' en la nueva tabla...")
-                sql_command = text(f'CREATE INDEX IF NOT EXISTS idx_timestamp ON {TABLE_NAME} ("Timestamp");')
-                connection.execute(sql_command)
-                connection.commit()
-                print(f"[{datetime.datetime.now()}] Índice 'idx_timestamp' creado.")
             else:
                 print(f"[{datetime.datetime.now()}] La tabla '{TABLE_NAME}' ya existe.")
+                columnas = {c['name'] for c in inspector.get_columns(TABLE_NAME)}
+                if 'Metodos_Ids' not in columnas:
+                    print(f"[{datetime.datetime.now()}] Migrando métodos de pago a '{TABLE_METODOS}' + columna 'Metodos_Ids'...")
+                    MetodoPago.__table__.create(ENGINE, checkfirst=True)
+                    connection.execute(text(f'ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS "Metodos_Ids" INTEGER[]'))
+                    migrar_metodos_pago(connection)
+                    connection.commit()
+                    print(f"[{datetime.datetime.now()}] Migración de métodos de pago completada.")
+                if 'Asset' not in columnas:
+                    # ADD COLUMN con DEFAULT constante no reescribe la tabla (PostgreSQL 11+)
+                    print(f"[{datetime.datetime.now()}] Añadiendo columnas de mercado 'Asset'/'Fiat' a '{TABLE_NAME}'...")
+                    connection.execute(text(f'''ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS "Asset" VARCHAR(10) NOT NULL DEFAULT 'USDT' '''))
+                    connection.execute(text(f'''ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS "Fiat" VARCHAR(10) NOT NULL DEFAULT 'VES' '''))
+                    connection.commit()
+                if 'Adv_No' not in columnas:
+                    connection.execute(text(f'ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS "Adv_No" VARCHAR(32)'))
+                    connection.execute(text(f'ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS "Huella" VARCHAR(16)'))
+                    connection.commit()
+                es_particionada = connection.execute(
+                    text("SELECT relkind = 'p' FROM pg_class WHERE oid = CAST(:tabla AS regclass)"), {'tabla': TABLE_NAME}
+                ).scalar()
+                if not es_particionada:
+                    print(f"[{datetime.datetime.now()}] Particionando '{TABLE_NAME}' por día (el histórico pasa a '{TABLE_HISTORICO}')...")
+                    particionar_tabla_existente(connection)
+                    connection.commit()
+                    print(f"[{datetime.datetime.now()}] Particionado completado.")
+
+            if not existia_presencia:
+                # Va antes que las velas: su reconstrucción lee las fotos desde la presencia
+                print(f"[{datetime.datetime.now()}] Creando tabla '{TABLE_PRESENCIA}' a partir del histórico...")
+                Presencia.__table__.create(ENGINE, checkfirst=True)
+                migrar_presencia(connection)
+                connection.commit()
+                print(f"[{datetime.datetime.now()}] Tabla '{TABLE_PRESENCIA}' lista.")
+            crear_indices(connection)
+            MetricaCiclo.__table__.create(ENGINE, checkfirst=True)
+
+            if existian_velas and 'Asset' not in {c['name'] for c in inspector.get_columns(TABLE_VELAS)}:
+                print(f"[{datetime.datetime.now()}] Añadiendo el mercado a la clave de '{TABLE_VELAS}'...")
+                connection.execute(text(f'''ALTER TABLE {TABLE_VELAS} ADD COLUMN IF NOT EXISTS "Asset" VARCHAR(10) NOT NULL DEFAULT 'USDT' '''))
+                connection.execute(text(f'''ALTER TABLE {TABLE_VELAS} ADD COLUMN IF NOT EXISTS "Fiat" VARCHAR(10) NOT NULL DEFAULT 'VES' '''))
+                connection.execute(text(f'ALTER TABLE {TABLE_VELAS} DROP CONSTRAINT IF EXISTS uq_velas_bucket'))
+                connection.execute(text(f'''ALTER TABLE {TABLE_VELAS} ADD CONSTRAINT uq_velas_mercado_bucket
+                                            UNIQUE ("Intervalo", "Exchange_Name", "Asset", "Fiat", "Tipo", "Bucket")'''))
+                connection.commit()
+
+            if not existian_velas:
+                print(f"[{datetime.datetime.now()}] Creando tabla '{TABLE_VELAS}' y reconstruyendo velas desde el histórico...")
+                Vela.__table__.create(ENGINE, checkfirst=True)
+                reconstruir_velas(connection)
+                connection.commit()
+                print(f"[{datetime.datetime.now()}] Tabla '{TABLE_VELAS}' lista.")
     except Exception as e:
         print(f"[{datetime.datetime.now()}] ERROR durante la inicialización de la BD: {e}")
+        return
+    mantener_particiones()
+
+# --- REINTENTOS, LÍMITE DE PETICIONES Y TELEMETRÍA ---
+def clasificar_error(e):
+    """Clase de un error de petición para la telemetría: timeout, conexion, http_429, http_5xx..."""
+    if isinstance(e, requests.Timeout):
+        return 'timeout'
+    if isinstance(e, requests.ConnectionError):
+        return 'conexion'
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        codigo = e.response.status_code
+        return 'http_429' if codigo == 429 else f'http_{codigo // 100}xx'
+    if isinstance(e, ValueError):
+        return 'respuesta_invalida' # JSON no válido
+    return 'inesperado'
+
+def calcular_espera(intento, retry_after=None):
+    """
+    Espera antes del reintento 'intento' (0, 1, ...): aleatoria entre 0 y base·2^intento, con tope
+    SCRAPER_BACKOFF_MAXIMO. Si el servidor manda Retry-After (en segundos) se espera al menos eso.
+    """
+    espera = random.uniform(0, min(SCRAPER_BACKOFF_MAXIMO, SCRAPER_BACKOFF_BASE * 2 ** intento))
+    try:
+        return max(espera, min(float(retry_after), SCRAPER_BACKOFF_MAXIMO))
+    except (TypeError, ValueError):
+        return espera
+
+class LimitadorPeticiones:
+    """Token bucket compartido por los hilos: 'tasa' peticiones/s de media, con ráfagas de 'capacidad'."""
+
+    def __init__(self, tasa, capacidad):
+        self.tasa_objetivo = self.tasa = tasa
+        self.capacidad = max(1, capacidad)
+        self.tokens = float(self.capacidad)
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+
+    def adquirir(self):
+        """Bloquea hasta que haya un token libre. Devuelve los segundos esperados."""
+        if self.tasa_objetivo <= 0:
+            return 0.0
+        esperado = 0.0
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return esperado
+                falta = (1 - self.tokens) / self.tasa
+            time.sleep(falta)
+            esperado += falta
+
+    def penalizar(self):
+        """Throttling (429): la tasa baja a la mitad (hasta un 10% de la configurada) y se vacía el cubo."""
+        with self.lock:
+            self.tasa = max(self.tasa_objetivo * 0.1, self.tasa / 2)
+            self.tokens = 0.0
+
+    def recuperar(self):
+        """Respuesta correcta: la tasa sube un 5% de la configurada, sin pasarla."""
+        with self.lock:
+            self.tasa = min(self.tasa_objetivo, self.tasa + self.tasa_objetivo * 0.05)
+
+class TelemetriaCiclo:
+    """Contadores de un ciclo. Los hilos de descarga escriben a la vez, así que todo pasa por el lock."""
+
+    def __init__(self):
+        self.inicio = datetime.datetime.now()
+        self.lock = threading.Lock()
+        self.etapas = {} # etapa -> segundos (sumados entre hilos)
+        self.lados = {} # "USDT/VES Demanda" -> contadores
+        self.errores = {} # clase -> ocurrencias
+
+    def _lado(self, mercado, tipo):
+        return self.lados.setdefault(f"{mercado} {tipo}", {
+            'paginas': 0, 'peticiones': 0, 'anuncios': 0, 'latencia_total_ms': 0.0, 'latencia_max_ms': 0.0,
+            'espera_limite_ms': 0.0, 'reintentos': 0, 'errores': {},
+        })
+
+    def registrar_intento(self, mercado, tipo, segundos, espera_limite, reintento):
+        """Cada intento HTTP, válido o fallido: las respuestas lentas o con timeout también cuentan en la latencia."""
+        with self.lock:
+            lado = self._lado(mercado, tipo)
+            lado['peticiones'] += 1
+            lado['latencia_total_ms'] += segundos * 1000
+            lado['latencia_max_ms'] = max(lado['latencia_max_ms'], segundos * 1000)
+            lado['espera_limite_ms'] += espera_limite * 1000
+            lado['reintentos'] += int(reintento)
+
+    def registrar_pagina(self, mercado, tipo):
+        with self.lock:
+            self._lado(mercado, tipo)['paginas'] += 1
+
+    def registrar_error(self, mercado, tipo, clase):
+        with self.lock:
+            errores = self._lado(mercado, tipo)['errores']
+            errores[clase] = errores.get(clase, 0) + 1
+            self.errores[clase] = self.errores.get(clase, 0) + 1
+
+    def registrar_anuncios(self, mercado, tipo, n):
+        with self.lock:
+            self._lado(mercado, tipo)['anuncios'] += n
+
+    @contextmanager
+    def medir(self, etapa):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.etapas[etapa] = self.etapas.get(etapa, 0.0) + time.perf_counter() - inicio
+
+    def fila(self, nuevos):
+        """Valores de la fila de p2p_metricas_ciclo."""
+        with self.lock:
+            lados = {k: dict(v, latencia_total_ms=round(v['latencia_total_ms'], 1), latencia_max_ms=round(v['latencia_max_ms'], 1),
+                             espera_limite_ms=round(v['espera_limite_ms'], 1)) for k, v in self.lados.items()}
+            return {
+                'Timestamp': self.inicio,
+                'Duracion_s': (datetime.datetime.now() - self.inicio).total_seconds(),
+                'Anuncios': sum(l['anuncios'] for l in lados.values()),
+                'Nuevos': nuevos,
+                'Peticiones': sum(l['peticiones'] for l in lados.values()), # Intentos HTTP, reintentos incluidos
+                'Reintentos': sum(l['reintentos'] for l in lados.values()),
+                'Etapas': {k: round(v, 3) for k, v in self.etapas.items()},
+                'Lados': lados,
+                'Errores': dict(self.errores),
+            }
+
+    def resumen(self, fila):
+        etapas = ', '.join(f"{k} {v:.2f}s" for k, v in fila['Etapas'].items())
+        errores = ', '.join(f"{k}: {v}" for k, v in fila['Errores'].items()) or 'ninguno'
+        return (f"Ciclo en {fila['Duracion_s']:.1f}s ({etapas}); {fila['Peticiones']} peticiones, "
+                f"{fila['Reintentos']} reintentos; errores: {errores}")
 
 # --- CLASE PRINCIPAL DEL SCRAPER (ADAPTADA A BINANCE) ---
 class ScraperP2P:
     def __init__(self, engine):
         # --- ¡ESTA ES LA API CORRECTA DE BINANCE! ---
         self.base_url = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
+        self.engine = engine
         self.session_db = sessionmaker(bind=engine)()
         self.total_registros_sesion = 0
+        self.ids_metodos = {} # Caché del diccionario de métodos: nombre -> id
+        # Última versión guardada de cada anuncio presente: (exchange, asset, fiat, tipo, advNo) -> (huella, id)
+        self.versiones = None
+        # En modo daemon las particiones se mantienen una vez al día (el arranque ya lo hizo hoy)
+        self.dia_mantenimiento = datetime.date.today()
         self.exchange_name = "Binance" # Nombre correcto
+        self.mercados = P2P_MERCADOS
+        # Sesión HTTP persistente: en modo daemon la conexión keep-alive se reutiliza entre ciclos.
+        # Un único pool compartido por todos los hilos, con tantas conexiones como peticiones simultáneas.
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SCRAPER_CONCURRENCIA_POR_HOST)
+        self.http.mount('https://', adapter)
+        # Límite de concurrencia por host (solo hay uno: p2p.binance.com) y de peticiones por segundo
+        self.limite_host = threading.BoundedSemaphore(SCRAPER_CONCURRENCIA_POR_HOST)
+        self.limitador = LimitadorPeticiones(SCRAPER_PETICIONES_POR_SEGUNDO, SCRAPER_RAFAGA)
+        self.telemetria = TelemetriaCiclo() # Se renueva en cada ciclo (ver ejecutar_ciclo)
+        self.pool_hilos = ThreadPoolExecutor(max_workers=SCRAPER_CONCURRENCIA_POR_HOST, thread_name_prefix='p2p-fetch')
+        # Pool aparte para las páginas 2..N: si compartieran pool con obtener_anuncios podrían bloquearse
+        self.pool_paginas = ThreadPoolExecutor(max_workers=SCRAPER_CONCURRENCIA_POR_HOST, thread_name_prefix='p2p-pagina')
         
         # --- HEADERS ESENCIALES PARA BINANCE ---
         # Binance bloquea peticiones sin un User-Agent (como las de Render)
@@ -81,114 +726,457 @@ class ScraperP2P:
             'Origin': 'https://p2p.binance.com'
         }
 
-    def obtener_anuncios(self, tipo_anuncio):
-        """Obtiene y filtra los anuncios de la API de Binance."""
-        print(f"  → Obteniendo datos de {tipo_anuncio} (Binance)...")
-        
-        # El "side" en la API de Binance es "tradeType"
-        trade_type = "BUY" if tipo_anuncio == "Demanda" else "SELL"
-        
+    def _pedir_pagina(self, asset, fiat, trade_type, pagina):
+        """
+        POST de una página del libro de anuncios, con hasta SCRAPER_REINTENTOS reintentos ante errores
+        transitorios. Lanza la excepción del último intento si la respuesta no es válida.
+        """
         # --- PAYLOAD PARA LA PETICIÓN POST DE BINANCE ---
         payload = {
-            "asset": "USDT",
-            "fiat": "VES",
+            "asset": asset,
+            "fiat": fiat,
             "merchantCheck": False, # No incluir solo comerciantes
-            "page": 1,
-            "rows": 20, # 20 es el máximo de la API "friendly"
+            "page": pagina,
+            "rows": FILAS_POR_PAGINA,
             "tradeType": trade_type,
             "payTypes": [], # Todos los métodos de pago
         }
+        mercado, tipo = f"{asset}/{fiat}", "Demanda" if trade_type == "BUY" else "Oferta"
+        for intento in range(SCRAPER_REINTENTOS + 1):
+            espera_limite = self.limitador.adquirir()
+            inicio = time.perf_counter()
+            try:
+                # --- ¡ES UN POST, NO UN GET! ---
+                with self.limite_host:
+                    response = self.http.post(self.base_url, headers=self.headers, json=payload, timeout=SCRAPER_TIMEOUT_SEGUNDOS)
+                response.raise_for_status() # Lanza error si la respuesta es 4xx o 5xx
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                self.telemetria.registrar_intento(mercado, tipo, time.perf_counter() - inicio, espera_limite, intento > 0)
+                clase = clasificar_error(e)
+                self.telemetria.registrar_error(mercado, tipo, clase)
+                respuesta = e.response if isinstance(e, requests.HTTPError) else None
+                codigo = respuesta.status_code if respuesta is not None else None
+                if codigo == 429:
+                    self.limitador.penalizar()
+                transitorio = isinstance(e, (requests.Timeout, requests.ConnectionError)) or codigo in CODIGOS_REINTENTABLES
+                if not transitorio or intento == SCRAPER_REINTENTOS:
+                    raise
+                espera = calcular_espera(intento, respuesta.headers.get('Retry-After') if respuesta is not None else None)
+                print(f"<i>   [!] {clase} en la página {pagina} de {tipo} {mercado}; reintento {intento + 1}/{SCRAPER_REINTENTOS} en {espera:.1f}s</i>")
+                time.sleep(espera)
+                continue
+            self.telemetria.registrar_intento(mercado, tipo, time.perf_counter() - inicio, espera_limite, intento > 0)
+            self.limitador.recuperar()
+            self.telemetria.registrar_pagina(mercado, tipo)
+            return data
+
+    def _parsear_anuncios(self, items, tipo_anuncio, asset, fiat, timestamp, vistos):
+        """Convierte los items de una página en objetos Anuncio (saltando advNo ya vistos en otra página)."""
+        anuncios = []
+        for item in items:
+            try:
+                # Los datos del anuncio están en el sub-diccionario 'adv'
+                adv = item['adv']
+
+                # El libro puede moverse entre páginas: un anuncio repetido se guarda una sola vez
+                adv_no = adv.get('advNo')
+                if adv_no is not None:
+                    if adv_no in vistos:
+                        continue
+                    vistos.add(adv_no)
+                
+                precio = float(adv['price'])
+                volumen = float(adv['surplusAmount']) # 'surplusAmount' es el volumen disponible
+                volumen_min = float(adv['minSingleTransAmount'])
+                volumen_max = float(adv['maxSingleTransAmount'])
+                
+                # Extraer métodos de pago
+                metodos_pago_lista = [pm['payType'] for pm in adv.get('tradeMethods', []) if pm.get('payType')]
+                metodos_pago_str = ', '.join(metodos_pago_lista)
+                huella = calcular_huella(precio, volumen, volumen_min, volumen_max, metodos_pago_str)
+
+                anuncio_obj = Anuncio(
+                    Timestamp=timestamp,
+                    Tipo=tipo_anuncio,
+                    Precio=precio,
+                    Volumen=volumen,
+                    Volumen_min=volumen_min,
+                    Volumen_max=volumen_max,
+                    Metodos_Pago=metodos_pago_str,
+                    Exchange_Name=self.exchange_name, # Guardamos "Binance"
+                    Asset=asset,
+                    Fiat=fiat,
+                    Adv_No=adv_no,
+                    Huella=huella
+                )
+                anuncios.append(anuncio_obj)
+            except (ValueError, TypeError, KeyError) as e:
+                print(f"<i>   [!] Error procesando un anuncio de Binance: {e}. Saltando...</i>")
+                self.telemetria.registrar_error(f"{asset}/{fiat}", tipo_anuncio, 'anuncio_invalido')
+        return anuncios
+
+    def obtener_anuncios(self, tipo_anuncio, asset="USDT", fiat="VES"):
+        """
+        Obtiene y filtra los anuncios de la API de Binance para un mercado (asset/fiat).
+        Recorre el libro completo: la página 1 da el total y el resto se pide en paralelo por tandas,
+        hasta agotar el libro, llegar a SCRAPER_MAX_PAGINAS o superar SCRAPER_VOLUMEN_MAXIMO.
+        """
+        mercado = f"{asset}/{fiat}"
+        print(f"  → Obteniendo datos de {tipo_anuncio} {mercado} (Binance)...")
+        
+        # El "side" en la API de Binance es "tradeType"
+        trade_type = "BUY" if tipo_anuncio == "Demanda" else "SELL"
         
         try:
-            with requests.Session() as s:
-                # --- ¡ES UN POST, NO UN GET! ---
-                response = s.post(self.base_url, headers=self.headers, json=payload, timeout=10)
-            
-            response.raise_for_status() # Lanza error si la respuesta es 4xx o 5xx
-            data = response.json()
-            
-            anuncios_guardar = []
+            data = self._pedir_pagina(asset, fiat, trade_type, 1)
             
             # La respuesta de Binance tiene un formato específico
-            if data and data.get('success') and data.get('data'):
-                timestamp = datetime.datetime.now()
-                
-                for item in data['data']:
-                    try:
-                        # Los datos del anuncio están en el sub-diccionario 'adv'
-                        adv = item['adv']
-                        
-                        precio = float(adv['price'])
-                        volumen = float(adv['surplusAmount']) # 'surplusAmount' es el volumen disponible
-                        volumen_min = float(adv['minSingleTransAmount'])
-                        volumen_max = float(adv['maxSingleTransAmount'])
-                        
-                        # Extraer métodos de pago
-                        metodos_pago_lista = [pm['payType'] for pm in adv.get('tradeMethods', []) if pm.get('payType')]
-                        metodos_pago_str = ', '.join(metodos_pago_lista)
-
-                        anuncio_obj = Anuncio(
-                            Timestamp=timestamp,
-                            Tipo=tipo_anuncio,
-                            Precio=precio,
-                            Volumen=volumen,
-                            Volumen_min=volumen_min,
-                            Volumen_max=volumen_max,
-                            Metodos_Pago=metodos_pago_str,
-                            Exchange_Name=self.exchange_name # Guardamos "Binance"
-                        )
-                        anuncios_guardar.append(anuncio_obj)
-                    except (ValueError, TypeError, KeyError) as e:
-                        print(f"<i>   [!] Error procesando un anuncio de Binance: {e}. Saltando...</i>")
-                        
-                print(f"<i>   <i> Anuncios de {tipo_anuncio} recolectados: {len(anuncios_guardar)}</i>")
-                return anuncios_guardar, len(anuncios_guardar)
-            
-            else:
-                print(f"<i>   <i> No se encontraron anuncios de {tipo_anuncio} o la respuesta no fue exitosa.</i>")
+            if not (data and data.get('success') and data.get('data')):
+                print(f"<i>   <i> No se encontraron anuncios de {tipo_anuncio} {mercado} o la respuesta no fue exitosa.</i>")
                 return [], 0
+
+            # Todas las páginas del lado comparten el Timestamp de la primera (es una misma foto del libro)
+            timestamp = datetime.datetime.now()
+            vistos = set()
+            with self.telemetria.medir('parseo'):
+                anuncios_guardar = self._parsear_anuncios(data['data'], tipo_anuncio, asset, fiat, timestamp, vistos)
+            volumen = sum(a.Volumen for a in anuncios_guardar)
+
+            total = int(data.get('total') or 0)
+            ultima_pagina = min(SCRAPER_MAX_PAGINAS, -(-total // FILAS_POR_PAGINA))
+            pagina, paginas_pedidas = 2, 1
+            while pagina <= ultima_pagina and not (SCRAPER_VOLUMEN_MAXIMO and volumen >= SCRAPER_VOLUMEN_MAXIMO):
+                tanda = list(range(pagina, min(pagina + SCRAPER_CONCURRENCIA_POR_HOST, ultima_pagina + 1)))
+                futuros = [self.pool_paginas.submit(self._pedir_pagina, asset, fiat, trade_type, p) for p in tanda]
+                paginas_pedidas += len(tanda)
+                agotado = False
+                for p, futuro in zip(tanda, futuros):
+                    try:
+                        items = (futuro.result() or {}).get('data') or []
+                    except Exception as e:
+                        print(f"<i>   [!] Error en la página {p} de {tipo_anuncio} {mercado}: {e}. Se conserva lo recolectado.</i>")
+                        items = []
+                    if not items:
+                        agotado = True # Respuesta vacía: el libro se acabó antes de lo que decía 'total'
+                        continue
+                    with self.telemetria.medir('parseo'):
+                        nuevos = self._parsear_anuncios(items, tipo_anuncio, asset, fiat, timestamp, vistos)
+                    anuncios_guardar.extend(nuevos)
+                    volumen += sum(a.Volumen for a in nuevos)
+                if agotado:
+                    break
+                pagina = tanda[-1] + 1
+                    
+            print(f"<i>   <i> Anuncios de {tipo_anuncio} {mercado} recolectados: {len(anuncios_guardar)} ({paginas_pedidas} pág.)</i>")
+            self.telemetria.registrar_anuncios(mercado, tipo_anuncio, len(anuncios_guardar))
+            return anuncios_guardar, len(anuncios_guardar)
                 
         except requests.RequestException as e:
-            print(f"<i>   [!] Error de red obteniendo {tipo_anuncio} (Binance): {e}</i>")
+            print(f"<i>   [!] Error de red obteniendo {tipo_anuncio} {mercado} (Binance): {e}</i>")
             return [], 0
         except Exception as e:
             print(f"<i>   [!] Error inesperado en obtener_anuncios (Binance): {e}</i>")
+            self.telemetria.registrar_error(mercado, tipo_anuncio, 'inesperado')
             return [], 0
 
-    def guardar_en_db(self, anuncios):
-        """Guarda la lista de anuncios en la base de datos."""
-        if not anuncios:
+    def codificar_metodos(self, anuncios):
+        """Asigna Metodos_Ids a cada anuncio, dando de alta en el diccionario los métodos nuevos."""
+        nombres = {m for anuncio in anuncios for m in separar_metodos(anuncio.Metodos_Pago)}
+        faltantes = nombres - self.ids_metodos.keys()
+        try:
+            if faltantes:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        pg_insert(MetodoPago).values([{'Nombre': n} for n in faltantes]).on_conflict_do_nothing(index_elements=['Nombre'])
+                    )
+                    filas = connection.execute(select(MetodoPago.Nombre, MetodoPago.id).where(MetodoPago.Nombre.in_(faltantes)))
+                    self.ids_metodos.update(dict(filas.all()))
+        except Exception as e:
+            # Sin diccionario los anuncios se guardan igual; el dashboard los verá como 'Indefinido'
+            print(f"<i>[!] Error al codificar métodos de pago: {e}</i>")
+            return
+        for anuncio in anuncios:
+            anuncio.Metodos_Ids = sorted(self.ids_metodos[m] for m in separar_metodos(anuncio.Metodos_Pago))
+
+    def _cargar_versiones_previas(self):
+        """Recupera de la BD la última foto de cada lado (modo cron: el proceso arranca sin memoria)."""
+        versiones = {}
+        sql_query = text(f'''
+            SELECT a."Exchange_Name", a."Asset", a."Fiat", a."Tipo", a."Adv_No", a."Huella", a.id, a."Timestamp"
+            FROM (
+                SELECT DISTINCT ON ("Exchange_Name", "Asset", "Fiat", "Tipo") "Anuncio_Ids"
+                FROM {TABLE_PRESENCIA}
+                WHERE "Timestamp" >= :desde
+                ORDER BY "Exchange_Name", "Asset", "Fiat", "Tipo", "Timestamp" DESC
+            ) AS ultima
+            CROSS JOIN LATERAL UNNEST(ultima."Anuncio_Ids") AS u(anuncio_id)
+            JOIN {TABLE_NAME} AS a ON a.id = u.anuncio_id
+            WHERE a."Adv_No" IS NOT NULL AND a."Timestamp" >= :desde_versiones
+        ''')
+        try:
+            with self.engine.connect() as connection:
+                desde = datetime.datetime.now() - datetime.timedelta(hours=1)
+                params = {'desde': desde, 'desde_versiones': desde - EDAD_MAXIMA_VERSION}
+                for exchange, asset, fiat, tipo, adv_no, huella, anuncio_id, timestamp in connection.execute(sql_query, params):
+                    versiones[(exchange, asset, fiat, tipo, adv_no)] = (huella, anuncio_id, timestamp)
+        except Exception as e:
+            print(f"<i>[!] No se pudo leer la foto anterior; se guardará el libro completo: {e}</i>")
+        return versiones
+
+    def _reservar_ids(self, anuncios):
+        """Asigna ids de la secuencia de p2p_anuncios antes de insertar (COPY no los devuelve)."""
+        sin_id = [a for a in anuncios if a.id is None]
+        if not sin_id:
             return
+        with self.engine.connect() as connection:
+            ids = connection.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:tabla, 'id')) FROM generate_series(1, :n)"),
+                {'tabla': TABLE_NAME, 'n': len(sin_id)}
+            ).scalars().all()
+        for anuncio, anuncio_id in zip(sin_id, ids):
+            anuncio.id = anuncio_id
+
+    def deduplicar(self, anuncios):
+        """
+        Separa los anuncios nuevos o cambiados (se insertan) de los que siguen idénticos al ciclo
+        anterior (solo se referencian). Devuelve (anuncios_a_insertar, presencias, versiones_del_ciclo).
+        """
+        if self.versiones is None:
+            self.versiones = self._cargar_versiones_previas()
+
+        nuevos, fecha_version = [], {} # id reutilizado -> Timestamp de la versión guardada
+        for anuncio in anuncios:
+            previa = self.versiones.get((anuncio.Exchange_Name, anuncio.Asset, anuncio.Fiat, anuncio.Tipo, anuncio.Adv_No))
+            if (anuncio.Adv_No is not None and previa is not None and previa[0] == anuncio.Huella
+                    and anuncio.Timestamp - previa[2] < EDAD_MAXIMA_VERSION):
+                anuncio.id = previa[1]
+                fecha_version[anuncio.id] = previa[2]
+            else:
+                nuevos.append(anuncio)
+        self._reservar_ids(nuevos)
+
+        presencias, versiones_ciclo = {}, {}
+        for anuncio in anuncios:
+            lado = (anuncio.Exchange_Name, anuncio.Asset, anuncio.Fiat, anuncio.Tipo)
+            if lado not in presencias:
+                presencias[lado] = {
+                    'Timestamp': anuncio.Timestamp, 'Exchange_Name': anuncio.Exchange_Name,
+                    'Asset': anuncio.Asset, 'Fiat': anuncio.Fiat, 'Tipo': anuncio.Tipo, 'Anuncio_Ids': [],
+                }
+            presencias[lado]['Anuncio_Ids'].append(anuncio.id)
+            if anuncio.Adv_No is not None:
+                versiones_ciclo[lado + (anuncio.Adv_No,)] = (anuncio.Huella, anuncio.id, fecha_version.get(anuncio.id, anuncio.Timestamp))
+        return nuevos, list(presencias.values()), versiones_ciclo
+
+    def confirmar_versiones(self, versiones_ciclo):
+        """Tras el commit, la foto de cada lado recolectado pasa a ser la referencia del ciclo siguiente."""
+        lados = {clave[:4] for clave in versiones_ciclo}
+        self.versiones = {k: v for k, v in self.versiones.items() if k[:4] not in lados}
+        self.versiones.update(versiones_ciclo)
+
+    def guardar_en_db(self, anuncios, presencias=(), modo=None):
+        """
+        Guarda los anuncios nuevos y la presencia del ciclo en una misma transacción.
+        Devuelve True si hubo commit.
+        """
+        if not anuncios and not presencias:
+            return False
+        try:
+            self._reservar_ids(anuncios)
+        except Exception as e:
+            print(f"<i>[!] Error al reservar ids en BD: {e}</i>")
+            return False
+        if (modo or MODO_INSERCION) == 'copy':
+            try:
+                self._guardar_con_copy(anuncios, presencias)
+                return True
+            except Exception as e:
+                print(f"<i>[!] Error en COPY, reintentando con el ORM: {e}</i>")
+        return self._guardar_con_orm(anuncios, presencias)
+
+    def _guardar_con_copy(self, anuncios, presencias):
+        """Inserta los anuncios con COPY FROM STDIN (CSV en memoria, un solo viaje a PostgreSQL)."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for anuncio in anuncios:
+            ids = anuncio.Metodos_Ids
+            writer.writerow([
+                anuncio.id, anuncio.Timestamp.isoformat(sep=' '), anuncio.Tipo, anuncio.Precio, anuncio.Volumen,
+                anuncio.Volumen_min, anuncio.Volumen_max, anuncio.Metodos_Pago, anuncio.Exchange_Name,
+                '{' + ','.join(map(str, ids)) + '}' if ids is not None else None, # None -> NULL
+                anuncio.Asset, anuncio.Fiat, anuncio.Adv_No, anuncio.Huella,
+            ])
+        buffer.seek(0)
+        columnas = ', '.join(f'"{c}"' for c in COLUMNAS_COPY)
+        # FORCE_NOT_NULL: un Metodos_Pago vacío se guarda como '' (igual que con el ORM), no como NULL
+        sql_copy = f'COPY {TABLE_NAME} ({columnas}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ("Metodos_Pago"))'
+        raw_connection = self.engine.raw_connection()
+        try:
+            with raw_connection.cursor() as cursor:
+                if anuncios:
+                    cursor.copy_expert(sql_copy, buffer)
+                cursor.executemany(
+                    f'''INSERT INTO {TABLE_PRESENCIA} ("Timestamp", "Exchange_Name", "Asset", "Fiat", "Tipo", "Anuncio_Ids")
+                        VALUES (%(Timestamp)s, %(Exchange_Name)s, %(Asset)s, %(Fiat)s, %(Tipo)s, %(Anuncio_Ids)s)''',
+                    presencias
+                )
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            raw_connection.close()
+
+    def _guardar_con_orm(self, anuncios, presencias):
         try:
             self.session_db.add_all(anuncios)
+            self.session_db.add_all([Presencia(**p) for p in presencias])
             self.session_db.commit()
+            return True
         except Exception as e:
             print(f"<i>[!] Error al guardar en BD: {e}</i>")
             self.session_db.rollback()
+            return False
         finally:
             self.session_db.close() # Cerrar sesión después de cada ciclo
 
+    def actualizar_velas(self, velas):
+        """Upsert de las velas pre-agregadas del ciclo."""
+        if not velas:
+            return
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(SQL_UPSERT_VELA, velas)
+        except Exception as e:
+            print(f"<i>[!] Error al actualizar velas en BD: {e}</i>")
+
+    def notificar_ciclo(self, timestamp, nuevos, total):
+        """Anuncia el ciclo confirmado a los dashboards que escuchan CANAL_CICLOS."""
+        payload = json.dumps({'timestamp': timestamp.isoformat(), 'nuevos': nuevos, 'anuncios': total})
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(text("SELECT pg_notify(:canal, :payload)"), {'canal': CANAL_CICLOS, 'payload': payload})
+        except Exception as e:
+            # Sin aviso los dashboards siguen viendo los datos en su refresco periódico
+            print(f"<i>[!] Error al notificar el ciclo: {e}</i>")
+
+    def guardar_ciclo(self, todos_anuncios):
+        """
+        Guarda la foto de un ciclo (todos los mercados y lados): anuncios nuevos o cambiados, presencia,
+        velas y aviso a los dashboards. Devuelve (anuncios insertados, anuncios sin cambios).
+        """
+        telemetria = self.telemetria
+        with telemetria.medir('codificacion'):
+            self.codificar_metodos(todos_anuncios)
+            # Las velas se agregan antes de guardar: el commit expira los objetos ORM
+            velas = agregar_velas(todos_anuncios)
+
+        # Solo se insertan los anuncios nuevos o cambiados; el resto queda referenciado en la presencia
+        total_nuevos = 0
+        try:
+            with telemetria.medir('deduplicacion'):
+                anuncios_nuevos, presencias, versiones_ciclo = self.deduplicar(todos_anuncios)
+        except Exception as e:
+            print(f"<i>[!] Error al deduplicar anuncios: {e}</i>")
+            anuncios_nuevos, presencias, versiones_ciclo = [], [], None
+        guardado = False
+        if versiones_ciclo is not None:
+            with telemetria.medir('insercion'):
+                guardado = self.guardar_en_db(anuncios_nuevos, presencias)
+        if guardado:
+            with telemetria.medir('velas'):
+                self.actualizar_velas(velas)
+            self.confirmar_versiones(versiones_ciclo)
+            total_nuevos = len(anuncios_nuevos)
+            with telemetria.medir('aviso'):
+                self.notificar_ciclo(max(p['Timestamp'] for p in presencias) if presencias else datetime.datetime.now(),
+                                     total_nuevos, len(todos_anuncios))
+        
+        self.total_registros_sesion += total_nuevos
+        return total_nuevos, len(todos_anuncios) - len(anuncios_nuevos)
+
+    def guardar_metricas(self, fila):
+        """Inserta la telemetría del ciclo. Un fallo aquí no afecta a los datos del ciclo."""
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(MetricaCiclo.__table__.insert(), fila)
+        except Exception as e:
+            print(f"<i>[!] Error al guardar la telemetría del ciclo: {e}</i>")
+
     def ejecutar_ciclo(self):
         """Ejecuta un ciclo completo de recolección."""
         print(f"--- Iniciando ciclo de extracción a las {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+        self.telemetria = TelemetriaCiclo()
+        if datetime.date.today() != self.dia_mantenimiento:
+            mantener_particiones(self.engine)
+            self.dia_mantenimiento = datetime.date.today()
         
-        anuncios_demanda, count_d = self.obtener_anuncios("Demanda")
-        anuncios_oferta, count_o = self.obtener_anuncios("Oferta")
-        
-        todos_anuncios = anuncios_demanda + anuncios_oferta
-        self.guardar_en_db(todos_anuncios)
-        
-        total_nuevos = count_d + count_o
-        self.total_registros_sesion += total_nuevos
+        # Todos los (mercado, lado) del ciclo se piden en paralelo: el tiempo de ciclo
+        # depende de la petición más lenta, no del número de mercados.
+        futuros = [
+            self.pool_hilos.submit(self.obtener_anuncios, tipo, asset, fiat)
+            for asset, fiat in self.mercados
+            for tipo in ("Demanda", "Oferta")
+        ]
+        todos_anuncios = []
+        with self.telemetria.medir('descarga'):
+            for futuro in futuros:
+                anuncios, count = futuro.result()
+                todos_anuncios.extend(anuncios)
+        total_nuevos, sin_cambios = self.guardar_ciclo(todos_anuncios)
+        metricas_ciclo = self.telemetria.fila(total_nuevos)
+        self.guardar_metricas(metricas_ciclo)
         
         if total_nuevos > 0:
-            print(f"  📊 \x1b[1;32m¡Éxito! {total_nuevos} nuevos registros añadidos a la BD.\x1b[0m")
+            print(f"  📊 \x1b[1;32m¡Éxito! {total_nuevos} nuevos registros añadidos a la BD ({sin_cambios} anuncios sin cambios).\x1b[0m")
         else:
-            print(f"  📊 ¡Éxito! {total_nuevos} nuevos registros añadidos a la BD.")
+            print(f"  📊 ¡Éxito! {total_nuevos} nuevos registros añadidos a la BD ({sin_cambios} anuncios sin cambios).")
             
         print(f"  ⭐ Total acumulado en esta sesión: {self.total_registros_sesion} registros.")
+        print(f"  ⏱️ {self.telemetria.resumen(metricas_ciclo)}")
+        print(f"  🔌 {conexion_db.informe_pool(self.engine)}")
         print(f"-----------------------------------------------------------------")
 
+# --- PLANIFICADOR DEL MODO DAEMON ---
+def ejecutar_daemon(scraper, intervalo=SCRAPER_INTERVALO_SEGUNDOS, jitter=SCRAPER_JITTER_SEGUNDOS):
+    """
+    Ejecuta ciclos a ritmo fijo hasta recibir SIGTERM/SIGINT.
+    Los ticks se calculan sobre una rejilla fija (sin deriva acumulada), el jitter solo desplaza
+    cada espera, y si un ciclo dura más que el intervalo se saltan los ticks perdidos.
+    """
+    detener = threading.Event()
+
+    def _parar(signum, frame):
+        print(f"[{datetime.datetime.now()}] Señal {signum} recibida. Terminando tras el ciclo actual...")
+        detener.set()
+
+    signal.signal(signal.SIGTERM, _parar)
+    signal.signal(signal.SIGINT, _parar)
+
+    print(f"[{datetime.datetime.now()}] Modo daemon: un ciclo cada {intervalo:.0f}s (jitter ±{jitter:.0f}s).")
+    proximo_tick = time.monotonic()
+    while not detener.is_set():
+        try:
+            scraper.ejecutar_ciclo()
+        except Exception as e:
+            # En modo daemon un ciclo fallido no debe tumbar el proceso
+            print(f"[{datetime.datetime.now()}] ERROR INESPERADO en el ciclo: {e}")
+
+        proximo_tick += intervalo
+        ahora = time.monotonic()
+        if ahora >= proximo_tick:
+            saltados = int((ahora - proximo_tick) // intervalo) + 1
+            proximo_tick += saltados * intervalo
+            print(f"[{datetime.datetime.now()}] Aviso: el ciclo superó el intervalo; se saltan {saltados} tick(s).")
+        espera = proximo_tick - ahora + random.uniform(-jitter, jitter)
+        detener.wait(max(0.0, espera))
+
+    scraper.pool_hilos.shutdown(wait=True)
+    scraper.pool_paginas.shutdown(wait=True)
+    scraper.http.close()
+    print(f"[{datetime.datetime.now()}] Daemon detenido. Total en esta sesión: {scraper.total_registros_sesion} registros.")
+
 # --- PUNTO DE ENTRADA DEL SCRIPT ---
 if __name__ == "__main__":
     
@@ -197,6 +1185,11 @@ if __name__ == "__main__":
     
     scraper = ScraperP2P(ENGINE)
     
+    if SCRAPER_MODO == "daemon" or "--daemon" in sys.argv[1:]:
+        # Modo "Daemon": un solo arranque (imports, engine, reflexión de la BD) para todos los ciclos.
+        ejecutar_daemon(scraper)
+        sys.exit(0)
+
     # Este es el modo "Cron Job": se ejecuta UNA VEZ y termina.
     # Render lo llamará cada 2 minutos.
     try:
@@ -0,0 +1,56 @@
+"""
+Proceso único de precálculo del dashboard.
+
+Con varios workers de gunicorn, cada uno cargaba los agregados de la ventana por su cuenta: la
+carga en la BD y la RAM crecían con el número de workers. Este proceso los carga una vez por ciclo
+del scraper (aviso LISTEN/NOTIFY, o cada SEGUNDOS_PRECALCULO como respaldo) y los publica en la
+caché Arrow de cache_frames, que los workers del dashboard solo leen con memory-map.
+
+Uso (en la misma máquina que el dashboard, que comparte P2P_CACHE_DIR):
+    DASHBOARD_PRECALCULO=externo gunicorn app:server -w 4
+    python worker_precalculo.py
+"""
+import datetime
+import os
+import signal
+import sys
+import threading
+
+import app as dashboard # Reutiliza la capa de agregación y la escucha de ciclos (no arranca el servidor)
+
+# Sin avisos del scraper (LISTEN no disponible o scraper parado) se recalcula igualmente cada tanto
+SEGUNDOS_PRECALCULO = float(os.environ.get("SEGUNDOS_PRECALCULO", 15 * 60))
+
+
+def ejecutar_worker(intervalo=SEGUNDOS_PRECALCULO):
+    """Publica una versión al arrancar y otra tras cada aviso de ciclo, hasta recibir SIGTERM/SIGINT."""
+    detener = threading.Event()
+
+    def _parar(signum, frame):
+        print(f"[{datetime.datetime.now()}] Señal {signum} recibida. Terminando el precálculo...")
+        detener.set()
+        dashboard._aviso_ciclo.set() # Despierta la espera
+
+    signal.signal(signal.SIGTERM, _parar)
+    signal.signal(signal.SIGINT, _parar)
+
+    dashboard._iniciar_escucha()
+    print(f"[{datetime.datetime.now()}] Precálculo: una versión por ciclo del scraper (respaldo cada {intervalo:.0f}s).")
+    while not detener.is_set():
+        dashboard._aviso_ciclo.clear() # Los avisos llegados durante la carga provocan otra
+        try:
+            version, exchange_name = dashboard.publicar_agregados()
+            if version is None:
+                print(f"[{datetime.datetime.now()}] Precálculo: no hay datos recientes de {exchange_name}.")
+        except Exception as e:
+            # Un fallo puntual (BD caída) no debe tumbar el proceso: los workers siguen con la última versión
+            print(f"[{datetime.datetime.now()}] ERROR en el precálculo: {e}")
+        dashboard._aviso_ciclo.wait(intervalo)
+
+
+if __name__ == "__main__":
+    if dashboard.ENGINE is None:
+        print(f"[{datetime.datetime.now()}] No se pudo iniciar el precálculo. Revisa la conexión a la base de datos.")
+        sys.exit(1)
+    ejecutar_worker()
+    sys.exit(0)